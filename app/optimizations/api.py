@@ -17,6 +17,11 @@ store = JSONStore()
 manager = OptimizationManager(datastore=store)
 
 
+@app.on_event("shutdown")
+def flush_store():
+    store.flush()
+
+
 class OptimizeRequest(BaseModel):
     product_id: str
     options: Dict[str, Any] = {}
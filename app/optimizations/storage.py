@@ -1,61 +1,240 @@
+"""JSON file storage for the optimizations prototype.
+
+Each collection (records, snapshots, users, ...) is one JSON array file. A
+collection is read once and then served from memory; writes change the
+in-memory copy, mark the collection dirty and schedule a flush. Dirty
+collections are written back `flush_delay` seconds after their first unflushed
+change, as compact JSON via a temp file and atomic rename, so a burst of writes
+costs one file write. Call `flush()` to write immediately (tests, shutdown);
+pending writes are also flushed at interpreter exit.
+
+Lookups by id use hash indexes (collection -> field value -> entries) that are
+built when a collection is loaded and updated on every write; see `INDEXES`.
+
+All `JSONStore` instances over the same directory share the in-memory
+collections; when they ask for different flush delays the shortest one is
+used. The store assumes a single writer: the files must be written only by
+this process, since a flush replaces a file with the in-memory copy. A flush
+that finds a file changed since it was loaded or last written logs a warning
+before replacing it.
+"""
+import atexit
+import copy
+import datetime
 import json
+import logging
 import os
-from typing import Any, Dict, List, Optional
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data", "optimizations")
+DEFAULT_FLUSH_DELAY = 0.5
+# collection -> field with a hash index
+INDEXES = {
+    "snapshots": "snapshot_id",
+    "users": "api_key",
+    "stores": "store_id",
+    "store_memory": "store_id",
+    "records": "product_id",
+}
 
 
 def _ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
 
+class _Collections:
+    """In-memory collections of one data directory plus their write-behind state."""
+
+    def __init__(self, base: str, flush_delay: float):
+        self.base = base
+        self.flush_delay = flush_delay
+        self.lock = threading.RLock()
+        self.data: Dict[str, List[Any]] = {}
+        # collection -> value of its INDEXES field -> entries in collection order
+        self.indexes: Dict[str, Dict[Any, List[Dict]]] = {}
+        self.dirty: set = set()
+        # collection -> (mtime_ns, size) of its file when last read or written; None if absent
+        self.stamps: Dict[str, Optional[Tuple[int, int]]] = {}
+        self._timer: Optional[threading.Timer] = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.base, f"{name}.json")
+
+    def _stamp(self, name: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def get(self, name: str) -> List[Any]:
+        """The live list for `name`, loaded from disk on first use (caller holds `lock`)."""
+        arr = self.data.get(name)
+        if arr is None:
+            self.stamps[name] = self._stamp(name)
+            try:
+                with open(self.path(name), "r") as f:
+                    arr = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                arr = []
+            self.data[name] = arr
+            if name in INDEXES:
+                index = self.indexes[name] = {}
+                for item in arr:
+                    index.setdefault(item.get(INDEXES[name]), []).append(item)
+        return arr
+
+    def append(self, name: str, item: Dict) -> None:
+        self.get(name).append(item)
+        if name in INDEXES:
+            self.indexes[name].setdefault(item.get(INDEXES[name]), []).append(item)
+        self.mark_dirty(name)
+
+    def replace(self, name: str, field: str, item: Dict) -> None:
+        """Drop entries whose `field` equals the item's, then append the item."""
+        arr = self.get(name)
+        if INDEXES.get(name) == field:
+            stale = {id(x) for x in self.indexes[name].pop(item.get(field), [])}
+            if stale:
+                arr[:] = [x for x in arr if id(x) not in stale]
+        else:
+            arr[:] = [x for x in arr if x.get(field) != item.get(field)]
+            if name in INDEXES:
+                index = self.indexes[name] = {}
+                for x in arr:
+                    index.setdefault(x.get(INDEXES[name]), []).append(x)
+        self.append(name, item)
+
+    def lookup(self, name: str, field: str, value: Any) -> List[Dict]:
+        """Entries whose `field` equals `value` (caller holds `lock`)."""
+        arr = self.get(name)
+        if INDEXES.get(name) == field:
+            return self.indexes[name].get(value, [])
+        return [x for x in arr if x.get(field) == value]
+
+    def mark_dirty(self, name: str) -> None:
+        """Schedule a flush unless one is already pending (caller holds `lock`)."""
+        self.dirty.add(name)
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> None:
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = {name: json.dumps(self.data[name], separators=(",", ":")) for name in self.dirty}
+            self.dirty.clear()
+            if not pending:
+                return
+            _ensure_dir(self.base)
+            # written under the lock so an older flush can never replace a newer file
+            for name, data in pending.items():
+                if self._stamp(name) != self.stamps.get(name):
+                    logger.warning("%s was changed by another writer; replacing it with this process's copy",
+                                   self.path(name))
+                fd, tmp = tempfile.mkstemp(dir=self.base, prefix=f".{name}-", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        f.write(data)
+                    os.replace(tmp, self.path(name))
+                    self.stamps[name] = self._stamp(name)
+                except BaseException:
+                    self.dirty.add(name)
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+                    raise
+
+
+_shared: Dict[str, _Collections] = {}
+_shared_lock = threading.Lock()
+
+
+def _collections_for(base: str, flush_delay: float) -> _Collections:
+    key = os.path.realpath(base)
+    with _shared_lock:
+        collections = _shared.get(key)
+        if collections is None:
+            collections = _shared[key] = _Collections(key, flush_delay)
+        else:
+            collections.flush_delay = min(collections.flush_delay, flush_delay)
+        return collections
+
+
+def flush_all() -> None:
+    with _shared_lock:
+        collections = list(_shared.values())
+    for c in collections:
+        c.flush()
+
+
+atexit.register(flush_all)
+
+
 class JSONStore:
-    def __init__(self, base_dir: Optional[str] = None):
+    def __init__(self, base_dir: Optional[str] = None, flush_delay: float = DEFAULT_FLUSH_DELAY):
         self.base = base_dir or DATA_DIR
         _ensure_dir(self.base)
+        self._collections = _collections_for(self.base, flush_delay)
 
-    def _path(self, name: str) -> str:
-        _ensure_dir(self.base)
-        return os.path.join(self.base, f"{name}.json")
+    def flush(self) -> None:
+        """Write all pending changes to disk now."""
+        self._collections.flush()
+
+    # --- collection primitives; results are copies, so callers cannot change stored state
+
+    def _append(self, name: str, item: Dict) -> None:
+        c = self._collections
+        with c.lock:
+            c.append(name, copy.deepcopy(item))
+
+    def _replace(self, name: str, field: str, item: Dict) -> None:
+        c = self._collections
+        with c.lock:
+            c.replace(name, field, copy.deepcopy(item))
+
+    def _find(self, name: str, field: str, value: Any) -> Optional[Dict]:
+        c = self._collections
+        with c.lock:
+            found = c.lookup(name, field, value)
+            return copy.deepcopy(found[0]) if found else None
+
+    def _select(self, name: str) -> List[Dict]:
+        c = self._collections
+        with c.lock:
+            return copy.deepcopy(c.get(name))
 
     def save_record(self, record: Any):
-        path = self._path("records")
-        arr = self._read(path)
-        arr.append(self._to_dict(record))
-        self._write(path, arr)
+        self._append("records", self._to_dict(record))
 
     def list_records_for_product(self, product_id: str) -> List[Dict]:
-        arr = self._read(self._path("records"))
-        return [r for r in arr if r.get("product_id") == product_id]
+        c = self._collections
+        with c.lock:
+            return copy.deepcopy(c.lookup("records", "product_id", product_id))
 
     def save_snapshot(self, snapshot: Any):
-        path = self._path("snapshots")
-        arr = self._read(path)
-        arr.append(self._to_dict(snapshot))
-        self._write(path, arr)
+        self._append("snapshots", self._to_dict(snapshot))
 
     def get_snapshot(self, snapshot_id: str) -> Optional[Dict]:
-        arr = self._read(self._path("snapshots"))
-        for s in arr:
-            if s.get("snapshot_id") == snapshot_id:
-                return s
-        return None
+        return self._find("snapshots", "snapshot_id", snapshot_id)
 
     def save_abtest(self, test: Any):
-        path = self._path("abtests")
-        arr = self._read(path)
-        arr.append(self._to_dict(test))
-        self._write(path, arr)
+        self._append("abtests", self._to_dict(test))
 
     def list_abtests(self) -> List[Dict]:
-        return self._read(self._path("abtests"))
+        return self._select("abtests")
 
     def save_alert(self, store_id: str, condition: Dict, channels: List[str]) -> str:
-        path = self._path("alerts")
-        arr = self._read(path)
-        alert = {"id": f"alert-{len(arr)+1}", "store_id": store_id, "condition": condition, "channels": channels}
-        arr.append(alert)
-        self._write(path, arr)
+        c = self._collections
+        with c.lock:
+            alert = {"id": f"alert-{len(c.get('alerts'))+1}", "store_id": store_id, "condition": condition, "channels": channels}
+            self._append("alerts", alert)
         return alert["id"]
 
     def _to_dict(self, obj: Any) -> Dict:
@@ -63,98 +242,54 @@ class JSONStore:
             d = obj.__dict__.copy()
             # convert datetimes if present
             for k, v in d.items():
-                try:
-                    import datetime
-
-                    if isinstance(v, datetime.datetime):
-                        d[k] = v.isoformat()
-                except Exception:
-                    pass
+                if isinstance(v, datetime.datetime):
+                    d[k] = v.isoformat()
             return d
         return dict(obj)
 
     def log_ai_feedback(self, product_id: str, feedback: Dict):
-        path = self._path("ai_feedback")
-        arr = self._read(path)
-        arr.append({"product_id": product_id, "feedback": feedback})
-        self._write(path, arr)
+        self._append("ai_feedback", {"product_id": product_id, "feedback": feedback})
 
     def get_store_memory(self, store_id: str) -> Dict:
-        arr = self._read(self._path("store_memory"))
-        for s in arr:
-            if s.get("store_id") == store_id:
-                return s
+        memory = self._find("store_memory", "store_id", store_id)
+        if memory is not None:
+            return memory
         # default memory
         return {"store_id": store_id, "embeddings_uri": None, "last_updated": None, "notes": []}
 
     def save_store_memory(self, memory: Dict):
-        path = self._path("store_memory")
-        arr = self._read(path)
         # simple replace if exists
-        arr = [m for m in arr if m.get("store_id") != memory.get("store_id")]
-        arr.append(memory)
-        self._write(path, arr)
+        self._replace("store_memory", "store_id", memory)
 
     # --- Multi-store and RBAC helpers
     def save_store(self, store: Dict):
-        path = self._path("stores")
-        arr = self._read(path)
-        arr = [s for s in arr if s.get("store_id") != store.get("store_id")]
-        arr.append(store)
-        self._write(path, arr)
+        self._replace("stores", "store_id", store)
 
     def get_store(self, store_id: str) -> Optional[Dict]:
-        arr = self._read(self._path("stores"))
-        for s in arr:
-            if s.get("store_id") == store_id:
-                return s
-        return None
+        return self._find("stores", "store_id", store_id)
 
     def list_stores(self) -> List[Dict]:
-        return self._read(self._path("stores"))
+        return self._select("stores")
 
     def save_user(self, user: Dict):
-        path = self._path("users")
-        arr = self._read(path)
         # users identified by api_key
-        arr = [u for u in arr if u.get("api_key") != user.get("api_key")]
-        arr.append(user)
-        self._write(path, arr)
+        self._replace("users", "api_key", user)
 
     def get_user_by_api_key(self, api_key: str) -> Optional[Dict]:
-        arr = self._read(self._path("users"))
-        for u in arr:
-            if u.get("api_key") == api_key:
-                return u
-        return None
+        return self._find("users", "api_key", api_key)
 
     def list_users(self) -> List[Dict]:
-        return self._read(self._path("users"))
+        return self._select("users")
 
     # --- AI credit usage tracking
     def log_ai_credit_usage(self, store_id: str, credits: float, reason: str = ""):
-        path = self._path("ai_credits")
-        arr = self._read(path)
-        arr.append({"store_id": store_id, "credits": credits, "reason": reason})
-        self._write(path, arr)
+        self._append("ai_credits", {"store_id": store_id, "credits": credits, "reason": reason})
 
     def summarize_ai_credits(self) -> Dict[str, float]:
-        arr = self._read(self._path("ai_credits"))
         summary: Dict[str, float] = {}
-        for e in arr:
-            sid = e.get("store_id")
-            summary[sid] = summary.get(sid, 0.0) + float(e.get("credits", 0.0))
+        c = self._collections
+        with c.lock:
+            for e in c.get("ai_credits"):
+                sid = e.get("store_id")
+                summary[sid] = summary.get(sid, 0.0) + float(e.get("credits", 0.0))
         return summary
-
-    def _read(self, path: str) -> List[Any]:
-        try:
-            with open(path, "r") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return []
-        except json.JSONDecodeError:
-            return []
-
-    def _write(self, path: str, arr: List[Any]):
-        with open(path, "w") as f:
-            json.dump(arr, f, indent=2)
@@ -0,0 +1,125 @@
+"""Materialized snapshots for slow-changing cross-store benchmarks.
+
+A snapshot is a small document computed for one key (benchmark name, niche,
+window). Requests are served from the latest snapshot together with its age.
+A background scheduler recomputes every known key on a fixed cadence, and
+concurrent on-demand refreshes of the same key share a single computation.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+DEFAULT_REFRESH_SECONDS = 300.0
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Tuple[float, Dict[str, Any]]] = None
+        self.error: Optional[BaseException] = None
+
+
+class SnapshotStore:
+    def __init__(self, capacity: int = 256, clock: Callable[[], float] = time.time):
+        self.capacity = capacity
+        self.clock = clock
+        self._lock = threading.Lock()
+        # key -> (computed_at, document, compute function)
+        self._snapshots: "OrderedDict[Hashable, Tuple[float, Dict[str, Any], Callable[[], Dict[str, Any]]]]" = OrderedDict()
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self.computations = 0
+
+    def refresh(self, key: Hashable, compute: Callable[[], Dict[str, Any]]) -> Tuple[float, Dict[str, Any]]:
+        """Recompute `key`; callers arriving while a computation is running wait for it instead."""
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            document = compute()
+            computed_at = self.clock()
+            with self._lock:
+                self.computations += 1
+                self._snapshots[key] = (computed_at, document, compute)
+                self._snapshots.move_to_end(key)
+                while len(self._snapshots) > self.capacity:
+                    self._snapshots.popitem(last=False)
+            flight.result = (computed_at, document)
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+
+    def get(self, key: Hashable, compute: Callable[[], Dict[str, Any]], refresh: bool = False) -> Tuple[Dict[str, Any], float]:
+        """Return `(document, age_seconds)`, computing the snapshot if it does not exist yet."""
+        with self._lock:
+            entry = self._snapshots.get(key)
+            if entry is not None:
+                self._snapshots.move_to_end(key)
+        if entry is None or refresh:
+            computed_at, document = self.refresh(key, compute)
+        else:
+            computed_at, document = entry[0], entry[1]
+        return document, max(0.0, self.clock() - computed_at)
+
+    def refresh_all(self, on_error: Optional[Callable[[BaseException], None]] = None) -> int:
+        """Recompute every known snapshot; returns how many were refreshed.
+        A failing key keeps its previous snapshot and does not stop the others.
+        """
+        with self._lock:
+            entries = [(key, entry[2]) for key, entry in self._snapshots.items()]
+        refreshed = 0
+        for key, compute in entries:
+            try:
+                self.refresh(key, compute)
+                refreshed += 1
+            except Exception as exc:
+                if on_error is not None:
+                    on_error(exc)
+        return refreshed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._snapshots.clear()
+
+
+class SnapshotScheduler:
+    """Daemon thread calling `SnapshotStore.refresh_all` every `interval` seconds."""
+
+    def __init__(self, store: SnapshotStore, interval: float = DEFAULT_REFRESH_SECONDS,
+                 on_error: Optional[Callable[[BaseException], None]] = None):
+        self.store = store
+        self.interval = interval
+        self.on_error = on_error
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="benchmark-snapshots", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.store.refresh_all(self.on_error)
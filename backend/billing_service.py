@@ -1,23 +1,123 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
+import argparse
+import base64
+import binascii
 import os
 import json
+import logging
+import re
+import threading
 from datetime import datetime
 
+from .credit_ledger import (
+    CreditLedger,
+    InsufficientCredits,
+    ReservationAmountError,
+    ReservationNotFound,
+)
+from .invoices import InvoiceJob, invoice_path
+from .rate_limits import DEFAULT_CHECKPOINT_SECONDS, HierarchicalLimiter, LimiterCheckpointer, RateLimited, limits_for
+from .storage import DocumentStore, open_store
+
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Digicloset Billing Service")
 
 STORE_PATH = os.path.join(os.path.dirname(__file__), "billing_store.json")
+LEDGER_DIR = os.path.join(os.path.dirname(__file__), "billing_ledger")
+INVOICES_DIR = os.path.join(os.path.dirname(__file__), "billing_invoices")
+INVOICE_GRACE_DAYS = float(os.getenv("BILLING_INVOICE_GRACE_DAYS", "1"))
+RATE_LIMITS_PATH = os.path.join(os.path.dirname(__file__), "billing_rate_limits.json")
+RATE_LIMIT_CHECKPOINT_SECONDS = float(os.getenv("BILLING_RATE_LIMIT_CHECKPOINT_SECONDS", DEFAULT_CHECKPOINT_SECONDS))
+
+DEFAULT_RESERVATION_TTL_SECONDS = 15 * 60
+MAX_RESERVATION_TTL_SECONDS = 24 * 3600
+MAX_USAGE_BATCH = 1000
+MAX_USAGE_PAGE = 1000
+
+_ledger = CreditLedger(LEDGER_DIR)
+_accounts_cache: Dict[str, Any] = {"sig": None, "accounts": {}}
+_accounts_lock = threading.Lock()
+_limiter = HierarchicalLimiter()
+_limiter_checkpointer: Optional[LimiterCheckpointer] = None
+
+def _store() -> DocumentStore:
+    return open_store(STORE_PATH, "billing")
 
 def load_store():
-    if not os.path.exists(STORE_PATH):
-        return {"accounts": {}, "usage": []}
-    with open(STORE_PATH, "r") as f:
-        return json.load(f)
+    return _store().load()
 
 def save_store(store):
-    with open(STORE_PATH, "w") as f:
-        json.dump(store, f, default=str)
+    _store().save(store)
+
+
+def _get_ledger() -> CreditLedger:
+    """Return the credit ledger, seeding it from the legacy `billing_store.json` on first use:
+    account credits become opening balances and the usage list becomes journal history.
+    """
+    ledger = _ledger
+    if not ledger.initialized:
+        def legacy():
+            store = load_store()
+            accounts = store.get("accounts", {})
+            balances = {shop: acc.get("credits", 0) for shop, acc in accounts.items()}
+            return balances, store.get("usage", [])
+
+        ledger.bootstrap(legacy)
+        store = load_store()
+        if "usage" in store or "usage_counters" in store or any("credits" in a for a in store.get("accounts", {}).values()):
+            store.pop("usage", None)
+            store.pop("usage_counters", None)
+            for acc in store.get("accounts", {}).values():
+                acc.pop("credits", None)
+                acc.pop("charges", None)
+            save_store(store)
+    return ledger
+
+
+def _accounts() -> Dict[str, Any]:
+    """Account settings (plan, hourly rate), re-read only when the store changes."""
+    sig = _store().version()
+    with _accounts_lock:
+        if _accounts_cache["sig"] != sig:
+            _accounts_cache["accounts"] = load_store().get("accounts", {})
+            _accounts_cache["sig"] = sig
+        return _accounts_cache["accounts"]
+
+
+def _plan_limit(shop_id: str, feature: Optional[str]) -> Optional[float]:
+    if not feature:
+        return None
+    return _accounts().get(shop_id, {}).get("plan", {}).get("limits", {}).get(feature)
+
+
+def _rate_limits(shop_id: str, feature: Optional[str]) -> Dict[str, float]:
+    plan = _accounts().get(shop_id, {}).get("plan") or {}
+    return limits_for(plan, feature)
+
+
+def _check_rate(shop_id: str, feature: Optional[str], cost: float) -> None:
+    """Draw `cost` from the shop's token buckets for `feature` (configured by the plan's
+    `rate_limits`, e.g. `{"descriptions": {"second": 5, "hour": 500, "month": 20000}, "*": {...}}`)."""
+    _limiter.acquire(shop_id, feature, cost, _rate_limits(shop_id, feature))
+
+
+def _refund_rate(shop_id: str, feature: Optional[str], cost: float) -> None:
+    """Give back tokens drawn by `_check_rate` when the ledger did not charge the request."""
+    _limiter.refund(shop_id, feature, cost, _rate_limits(shop_id, feature))
+
+
+def _rate_limited(exc: RateLimited) -> HTTPException:
+    headers = {"Retry-After": str(max(1, int(exc.retry_after + 0.999)))} if exc.retry_after != float("inf") else None
+    return HTTPException(status_code=429, detail=str(exc), headers=headers)
+
+
+def rebuild_usage_counters() -> Dict[str, Any]:
+    """Recompute the monthly (shop, feature) usage counters from the full journal history."""
+    return _get_ledger().rebuild_counters()
 
 
 class UsageRecord(BaseModel):
@@ -36,104 +136,280 @@ class ChargeRequest(BaseModel):
     description: Optional[str] = None
 
 
+class ReserveRequest(BaseModel):
+    shop_id: str
+    amount: float
+    feature: Optional[str] = None  # for rate limits; the committed usage names its own feature
+    ttl_seconds: float = DEFAULT_RESERVATION_TTL_SECONDS
+    description: Optional[str] = None
+
+
+class ReservationCommit(BaseModel):
+    amount: float  # credits actually used; the rest of the hold is refunded
+    feature: Optional[str] = None
+    description: Optional[str] = None
+    time_saved_minutes: Optional[float] = None
+
+
 @app.get("/billing/credits")
 def get_credits(shop_id: Optional[str] = None):
-    store = load_store()
-    accounts = store.get("accounts", {})
+    ledger = _get_ledger()
+    ledger.expire_reservations()
+    accounts = _accounts()
     if shop_id:
-        acc = accounts.get(shop_id, {"credits": 1000.0, "plan": {"name":"free","limits":{}}, "hourly_rate":50.0})
-        return {"shop_id": shop_id, "credits": acc.get("credits", 0), "plan": acc.get("plan"), "hourly_rate": acc.get("hourly_rate", 50.0)}
+        acc = accounts.get(shop_id, {"plan": {"name":"free","limits":{}}, "hourly_rate":50.0})
+        return {"shop_id": shop_id, "credits": ledger.balance(shop_id), "plan": acc.get("plan"), "hourly_rate": acc.get("hourly_rate", 50.0)}
     # return all
-    return accounts
+    balances = ledger.balances()
+    return {shop: {**accounts.get(shop, {}), "credits": balances.get(shop, ledger.default_credits)}
+            for shop in sorted(set(accounts) | set(balances))}
 
 
 @app.post("/billing/charge")
 def charge_account(req: ChargeRequest):
-    store = load_store()
-    accounts = store.setdefault("accounts", {})
-    acc = accounts.setdefault(req.shop_id, {"credits": 1000.0, "charges": []})
-    if acc.get("credits", 0) < req.amount:
+    if req.amount <= 0:
+        raise HTTPException(status_code=422, detail="amount must be positive")
+    usage = {"shop_id": req.shop_id, "type": "ai_credit_charge", "amount": req.amount, "description": req.description, "timestamp": str(datetime.utcnow())}
+    try:
+        entry = _get_ledger().submit(req.shop_id, "charge", -req.amount, usage=usage, description=req.description, require_funds=True)
+    except InsufficientCredits:
         raise HTTPException(status_code=402, detail="Insufficient credits")
-    acc["credits"] = acc.get("credits", 0) - req.amount
-    entry = {"amount": req.amount, "description": req.description, "timestamp": str(datetime.utcnow())}
-    acc.setdefault("charges", []).append(entry)
-    store.setdefault("usage", []).append({"shop_id": req.shop_id, "type": "ai_credit_charge", "amount": req.amount, "description": req.description, "timestamp": str(datetime.utcnow())})
-    save_store(store)
-    return {"status": "ok", "credits": acc["credits"]}
+    return {"status": "ok", "credits": entry["balance"]}
 
 
-@app.post("/billing/usage")
-def record_usage(rec: UsageRecord):
-    store = load_store()
+def _usage_op(rec: UsageRecord) -> Dict[str, Any]:
     timestamp = rec.timestamp or datetime.utcnow()
     entry = {"shop_id": rec.shop_id, "type": rec.type, "amount": rec.amount, "description": rec.description, "feature": rec.feature, "time_saved_minutes": rec.time_saved_minutes, "timestamp": str(timestamp)}
-    store.setdefault("usage", []).append(entry)
-    save_store(store)
-    # enforce plan-level limits per feature (monthly)
-    if rec.shop_id and rec.type == "ai_credit":
-        accounts = store.setdefault("accounts", {})
-        acc = accounts.setdefault(rec.shop_id, {"credits": 1000.0, "charges": [], "plan": {"name":"free","limits":{}}, "hourly_rate":50.0})
-        # calculate current month usage for this feature
-        feature = rec.feature
-        if feature:
-            now = timestamp
-            month_start = datetime(now.year, now.month, 1)
-            usage = [u for u in store.get("usage", []) if u.get("shop_id") == rec.shop_id and u.get("feature") == feature]
-            monthly_total = 0.0
-            for u in usage:
-                try:
-                    t = datetime.fromisoformat(u.get("timestamp"))
-                except Exception:
-                    continue
-                if t >= month_start:
-                    monthly_total += float(u.get("amount", 0))
-            limit = acc.get("plan", {}).get("limits", {}).get(feature)
-            if limit is not None and monthly_total > limit:
-                raise HTTPException(status_code=402, detail=f"Feature limit exceeded for {feature}")
-        # deduct credits
-        acc["credits"] = acc.get("credits", 0) - rec.amount
-        save_store(store)
+    if not (rec.shop_id and rec.type == "ai_credit"):
+        return {"shop_id": rec.shop_id, "kind": "usage", "usage": entry}
+    # the usage row is recorded either way; credits are deducted only within the plan's
+    # monthly feature limit, checked against the running counter when the entry commits
+    return {"shop_id": rec.shop_id, "kind": "usage", "delta": -rec.amount, "usage": entry,
+            "limit": _plan_limit(rec.shop_id, rec.feature)}
+
+
+@app.post("/billing/usage")
+def record_usage(rec: UsageRecord):
+    ledger = _get_ledger()
+    op = _usage_op(rec)
+    if op.get("delta") is None:
+        ledger.submit(**op)
+        return {"status": "ok"}
+    if rec.amount <= 0:
+        raise HTTPException(status_code=422, detail="amount must be positive")
+    try:
+        _check_rate(rec.shop_id, rec.feature, rec.amount)
+    except RateLimited as exc:
+        raise _rate_limited(exc)
+    try:
+        with ledger.shop_lock(rec.shop_id):
+            committed = ledger.submit(**op)
+    except Exception:
+        _refund_rate(rec.shop_id, rec.feature, rec.amount)
+        raise
+    if committed.get("limit_exceeded"):
+        _refund_rate(rec.shop_id, rec.feature, rec.amount)
+        raise HTTPException(status_code=402, detail=f"Feature limit exceeded for {rec.feature}")
     return {"status": "ok"}
 
 
+@app.post("/billing/usage_batch")
+def record_usage_batch(records: List[UsageRecord]):
+    """Record many usage rows in one journal commit.
+
+    Feature limits are enforced per row in request order, so a row sees the usage of
+    the rows before it; rows over the limit are recorded without deducting credits.
+    Rows refused by the shop's rate limits, and charged rows without a positive
+    amount, are not recorded.
+    """
+    if len(records) > MAX_USAGE_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_USAGE_BATCH} records per batch")
+    ops, refused, charged = [], {}, set()
+    for i, rec in enumerate(records):
+        op = _usage_op(rec)
+        if op.get("delta") is not None:
+            if rec.amount <= 0:
+                refused[i] = {"status": "error", "detail": "amount must be positive"}
+                continue
+            try:
+                _check_rate(rec.shop_id, rec.feature, rec.amount)
+            except RateLimited as exc:
+                refused[i] = {"status": "rate_limited", "detail": str(exc)}
+                continue
+            charged.add(i)
+        ops.append(op)
+    try:
+        results = iter(_get_ledger().submit_many(ops) if ops else [])
+    except Exception:
+        for i in charged:
+            _refund_rate(records[i].shop_id, records[i].feature, records[i].amount)
+        raise
+    rows = []
+    for i, rec in enumerate(records):
+        if i in refused:
+            rows.append({"index": i, **refused[i]})
+            continue
+        committed = next(results)
+        if isinstance(committed, Exception):
+            rows.append({"index": i, "status": "error", "detail": str(committed)})
+        else:
+            rows.append({"index": i, "status": "limit_exceeded" if committed.get("limit_exceeded") else "ok"})
+        if i in charged and rows[-1]["status"] != "ok":
+            _refund_rate(rec.shop_id, rec.feature, rec.amount)
+    return {"status": "ok", "accepted": sum(r["status"] == "ok" for r in rows), "results": rows}
+
+
+@app.post("/billing/reserve")
+def reserve_credits(req: ReserveRequest):
+    """Hold credits for a long-running job. Settle the hold once with
+    `/billing/reserve/{id}/commit` or `/release`; unsettled holds are released after `ttl_seconds`.
+    """
+    if req.amount <= 0:
+        raise HTTPException(status_code=422, detail="amount must be positive")
+    if not 0 < req.ttl_seconds <= MAX_RESERVATION_TTL_SECONDS:
+        raise HTTPException(status_code=422, detail=f"ttl_seconds must be between 0 and {MAX_RESERVATION_TTL_SECONDS}")
+    try:
+        _check_rate(req.shop_id, req.feature, req.amount)
+    except RateLimited as exc:
+        raise _rate_limited(exc)
+    try:
+        entry = _get_ledger().reserve(req.shop_id, req.amount, req.ttl_seconds, req.description)
+    except InsufficientCredits:
+        _refund_rate(req.shop_id, req.feature, req.amount)
+        raise HTTPException(status_code=402, detail="Insufficient credits")
+    except Exception:
+        _refund_rate(req.shop_id, req.feature, req.amount)
+        raise
+    res = entry["reservation"]
+    return {"status": "ok", "reservation_id": res["id"], "amount": res["amount"],
+            "expires_at": datetime.utcfromtimestamp(res["expires_at"]).isoformat(), "credits": entry["balance"]}
+
+
+def _settle(reservation_id: str, used: float, usage: Optional[Dict[str, Any]] = None, description: Optional[str] = None):
+    try:
+        return _get_ledger().settle(reservation_id, used, usage, description)
+    except ReservationNotFound:
+        raise HTTPException(status_code=404, detail="Reservation not found or expired")
+    except ReservationAmountError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+
+@app.post("/billing/reserve/{reservation_id}/commit")
+def commit_reservation(reservation_id: str, req: ReservationCommit):
+    """Charge the credits actually used (recorded as `ai_credit` usage) and refund the rest of the hold."""
+    usage = {"type": "ai_credit", "amount": req.amount, "description": req.description, "feature": req.feature,
+             "time_saved_minutes": req.time_saved_minutes, "timestamp": str(datetime.utcnow())}
+    entry = _settle(reservation_id, req.amount, usage, req.description)
+    return {"status": "ok", "committed": req.amount, "released": entry["delta"], "credits": entry["balance"]}
+
+
+@app.post("/billing/reserve/{reservation_id}/release")
+def release_reservation(reservation_id: str):
+    entry = _settle(reservation_id, 0.0)
+    return {"status": "ok", "released": entry["delta"], "credits": entry["balance"]}
+
+
+def _encode_cursor(shop_id: Optional[str], before: int) -> str:
+    raw = json.dumps({"shop": shop_id, "before": before}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str, shop_id: Optional[str]) -> int:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        before = data["before"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+    if data.get("shop") != shop_id or not isinstance(before, int) or before < 0:
+        raise HTTPException(status_code=422, detail="Cursor does not belong to this query")
+    return before
+
+
 @app.get("/billing/usage")
-def get_usage(shop_id: Optional[str] = None, limit: int = 100):
-    store = load_store()
-    usage = store.get("usage", [])
-    if shop_id:
-        usage = [u for u in usage if u.get("shop_id") == shop_id]
-    return {"usage": usage[-limit:][::-1]}
+def get_usage(shop_id: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None):
+    """Usage rows newest first. Pass `next_cursor` back as `cursor` to fetch the next page."""
+    if not 1 <= limit <= MAX_USAGE_PAGE:
+        raise HTTPException(status_code=422, detail=f"limit must be between 1 and {MAX_USAGE_PAGE}")
+    before = _decode_cursor(cursor, shop_id) if cursor else None
+    usage, next_before = _get_ledger().usage_page(shop_id or None, limit, before)
+    return {"usage": usage, "next_cursor": _encode_cursor(shop_id, next_before) if next_before is not None else None}
+
+
+def _check_month(month: Optional[str]) -> None:
+    if month is not None and not re.fullmatch(r"\d{4}-\d{2}", month):
+        raise HTTPException(status_code=422, detail="month must be formatted YYYY-MM")
 
 
 @app.get("/billing/usage_per_feature")
-def get_usage_per_feature(shop_id: Optional[str] = None):
-    store = load_store()
-    usage = store.get("usage", [])
-    if shop_id:
-        usage = [u for u in usage if u.get("shop_id") == shop_id]
-    per_feature: Dict[str, Dict[str, float]] = {}
-    for u in usage:
-        f = u.get("feature") or "unknown"
-        rec = per_feature.setdefault(f, {"count": 0, "credits": 0.0, "time_saved_minutes": 0.0})
-        rec["count"] += 1
-        rec["credits"] += float(u.get("amount", 0))
-        rec["time_saved_minutes"] += float(u.get("time_saved_minutes", 0) or 0)
-    return {"per_feature": per_feature}
+def get_usage_per_feature(shop_id: Optional[str] = None, month: Optional[str] = None):
+    """Lifetime usage per feature, or for one `month` (YYYY-MM)."""
+    _check_month(month)
+    return {"per_feature": _get_ledger().feature_totals(shop_id, month)}
 
 
 @app.get("/billing/savings_estimate")
-def get_savings_estimate(shop_id: Optional[str] = None):
-    store = load_store()
-    accounts = store.get("accounts", {})
-    acc = accounts.get(shop_id, {}) if shop_id else {}
+def get_savings_estimate(shop_id: Optional[str] = None, month: Optional[str] = None):
+    _check_month(month)
+    acc = _accounts().get(shop_id, {}) if shop_id else {}
     hourly_rate = acc.get("hourly_rate", 50.0)
-    usage = [u for u in store.get("usage", []) if (not shop_id) or u.get("shop_id") == shop_id]
-    total_minutes = sum(float(u.get("time_saved_minutes", 0) or 0) for u in usage)
+    totals = _get_ledger().feature_totals(shop_id, month)
+    total_minutes = sum(t["time_saved_minutes"] for t in totals.values())
     estimated_savings = (total_minutes / 60.0) * hourly_rate
-    per_feature = {}
-    for u in usage:
-        f = u.get("feature") or "unknown"
-        pf = per_feature.setdefault(f, {"time_saved_minutes": 0.0, "credits_spent": 0.0})
-        pf["time_saved_minutes"] += float(u.get("time_saved_minutes", 0) or 0)
-        pf["credits_spent"] += float(u.get("amount", 0) or 0)
+    per_feature = {f: {"time_saved_minutes": t["time_saved_minutes"], "credits_spent": t["credits"]} for f, t in totals.items()}
     return {"estimated_savings": estimated_savings, "hourly_rate": hourly_rate, "per_feature": per_feature}
+
+
+def generate_invoices() -> Dict[str, Any]:
+    """Run the incremental monthly invoice job over usage recorded since its last run."""
+    return InvoiceJob(_get_ledger(), INVOICES_DIR, grace_days=INVOICE_GRACE_DAYS).run()
+
+
+@app.get("/billing/invoices/{shop_id}/{month}")
+def get_invoice(shop_id: str, month: str, format: str = "json"):
+    """An invoice written by the invoice job (`python -m backend.billing_service invoices`)."""
+    _check_month(month)
+    if format not in ("json", "csv"):
+        raise HTTPException(status_code=422, detail="format must be json or csv")
+    path = invoice_path(INVOICES_DIR, shop_id, month, format)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    if format == "csv":
+        return FileResponse(path, media_type="text/csv", filename=f"invoice-{shop_id}-{month}.csv")
+    with open(path) as f:
+        return json.load(f)
+
+
+@app.on_event("startup")
+def start_rate_limit_checkpoints() -> None:
+    """Restore token buckets from the last checkpoint and keep checkpointing them."""
+    global _limiter_checkpointer
+    if _limiter.restore(RATE_LIMITS_PATH):
+        logger.info("Restored rate limit buckets from %s", RATE_LIMITS_PATH)
+    _limiter_checkpointer = LimiterCheckpointer(
+        _limiter, RATE_LIMITS_PATH, RATE_LIMIT_CHECKPOINT_SECONDS,
+        on_error=lambda exc: logger.error("Rate limit checkpoint failed: %s", exc),
+    )
+    _limiter_checkpointer.start()
+
+
+@app.on_event("shutdown")
+def stop_rate_limit_checkpoints() -> None:
+    if _limiter_checkpointer is not None:
+        _limiter_checkpointer.stop(timeout=5)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Billing store maintenance")
+    parser.add_argument("command", choices=["rebuild-counters", "invoices"])
+    args = parser.parse_args(argv)
+    if args.command == "rebuild-counters":
+        counters = rebuild_usage_counters()
+        print(f"rebuilt usage counters for {len(counters)} shops")
+    elif args.command == "invoices":
+        result = generate_invoices()
+        print(f"processed {result['records']} usage records, wrote {result['invoices_written']} invoices; "
+              f"closed months: {', '.join(result['closed_months']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
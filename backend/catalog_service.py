@@ -4,23 +4,27 @@ from typing import List, Optional, Dict, Any
 import threading
 import time
 import uuid
-import json
 import os
 from typing import Dict, Any
 
+from .profile_store import ProfileStore
+from .storage import DocumentStore, open_store
+
 app = FastAPI(title="Digicloset Catalog Service")
 
 STORE_PATH = os.path.join(os.path.dirname(__file__), "catalog_store.json")
 
+# merchant profiles are written by the metrics service
+profiles = ProfileStore()
+
+def _store() -> DocumentStore:
+    return open_store(STORE_PATH, "catalog")
+
 def load_store():
-    if not os.path.exists(STORE_PATH):
-        return {"jobs": [], "items": []}
-    with open(STORE_PATH, "r") as f:
-        return json.load(f)
+    return _store().load()
 
 def save_store(store):
-    with open(STORE_PATH, "w") as f:
-        json.dump(store, f, default=str)
+    _store().save(store)
 
 
 class BulkActionRequest(BaseModel):
@@ -114,8 +118,7 @@ def compute_quality_score(item: Dict[str, Any]) -> Dict[str, Any]:
 
 @app.get("/catalog/quality")
 def catalog_quality_summary():
-    store = load_store()
-    items = store.get("items", [])
+    items = _store().find("items")
     results = []
     for it in items:
         q = compute_quality_score(it)
@@ -127,30 +130,26 @@ def catalog_quality_summary():
 
 @app.get("/catalog/item/{item_id}/quality")
 def item_quality(item_id: str):
-    store = load_store()
-    items = store.get("items", [])
-    item = next((it for it in items if it.get("id") == item_id), None)
+    item = _store().get("items", item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     return compute_quality_score(item)
 
 
 def run_job(job: Dict[str, Any]):
-    store = load_store()
-    items = store.setdefault("items", [])
-    job_id = job["job_id"]
+    store = _store()
     action = job["action"]
-    target_ids = job.get("item_ids") or [i.get("id") for i in items]
+    target_ids = job.get("item_ids") or [i.get("id") for i in store.find("items")]
+    items = store.get_many("items", target_ids)
     total = len(target_ids)
     job["status"] = "running"
     job["progress"] = 0
     job["total"] = total
     job["snapshots"] = {}
-    save_store(store)
+    store.put("jobs", job)
 
     for idx, item_id in enumerate(target_ids):
-        # find item
-        item = next((it for it in items if it.get("id") == item_id), None)
+        item = items.get(item_id)
         if not item:
             continue
         # snapshot before change for undo
@@ -166,22 +165,20 @@ def run_job(job: Dict[str, Any]):
         if action in ("optimize_all", "regen_descriptions"):
             regen_description(item)
 
-        # update progress
+        # update progress; the item and the job are saved in one write
         job["progress"] = idx + 1
-        save_store(store)
+        store.put_batch({"items": [item], "jobs": [job]})
 
     job["status"] = "completed"
     job["results"] = {"processed": job["progress"]}
-    save_store(store)
+    store.put("jobs", job)
 
 
 @app.post("/catalog/bulk_action")
 def start_bulk_action(req: BulkActionRequest, background_tasks: BackgroundTasks):
-    store = load_store()
     job_id = str(uuid.uuid4())
     job = {"job_id": job_id, "action": req.action, "status": "queued", "progress": 0, "total": 0, "item_ids": req.item_ids}
-    store.setdefault("jobs", []).append(job)
-    save_store(store)
+    _store().put("jobs", job)
 
     # start background thread
     t = threading.Thread(target=run_job, args=(job,))
@@ -193,8 +190,7 @@ def start_bulk_action(req: BulkActionRequest, background_tasks: BackgroundTasks)
 
 @app.get("/catalog/job/{job_id}")
 def get_job(job_id: str):
-    store = load_store()
-    job = next((j for j in store.get("jobs", []) if j.get("job_id") == job_id), None)
+    job = _store().get("jobs", job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     return job
@@ -202,22 +198,21 @@ def get_job(job_id: str):
 
 @app.get("/catalog/jobs")
 def list_jobs():
-    store = load_store()
-    return store.get("jobs", [])
+    return _store().find("jobs")
 
 
 @app.post("/catalog/job/{job_id}/undo")
 def undo_job(job_id: str):
-    store = load_store()
-    job = next((j for j in store.get("jobs", []) if j.get("job_id") == job_id), None)
+    store = _store()
+    job = store.get("jobs", job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     if not job.get("snapshots"):
         raise HTTPException(status_code=400, detail="No snapshots available to undo")
 
-    items = store.setdefault("items", [])
+    items = store.get_many("items", list(job["snapshots"]))
     for item_id, snap in job["snapshots"].items():
-        item = next((it for it in items if it.get("id") == item_id), None)
+        item = items.get(item_id)
         if not item:
             continue
         # restore fields
@@ -225,16 +220,18 @@ def undo_job(job_id: str):
             item[k] = v
 
     job["status"] = "undone"
-    save_store(store)
+    store.put_many("items", list(items.values()))
+    store.put("jobs", job)
     return {"status": "ok"}
 
 
 @app.post("/catalog/items/load_sample")
 def load_sample_items():
     # create example items if none
-    store = load_store()
-    if store.get("items"):
-        return {"count": len(store.get("items"))}
+    store = _store()
+    count = store.count("items")
+    if count:
+        return {"count": count}
     sample = []
     for i in range(1, 21):
         sample.append({
@@ -244,27 +241,25 @@ def load_sample_items():
             "image": f"/images/sample-{i}.jpg",
             "price": 29.99 + i,
         })
-    store["items"] = sample
-    save_store(store)
+    store.put_many("items", sample)
     return {"count": len(sample)}
 
 
+def _learning_adjustments(item: Dict[str, Any]) -> Dict[str, float]:
+    """Merchant learning adjustments from the shared profile store (shop taken from the item id)."""
+    shop = (item.get("id") or "").split(":")[0]
+    try:
+        prof = profiles.get(shop) or {}
+    except Exception:
+        return {}
+    return prof.get("learning_adjustments") or {}
+
+
 def generate_description_variants(item: Dict[str, Any], n: int = 3) -> List[Dict[str, Any]]:
     base = item.get("description", "")
     variants = []
     # try to load merchant learning adjustments if available
-    adjustments: Dict[str, float] = {}
-    try:
-        metrics_path = os.path.join(os.path.dirname(__file__), "metrics_store.json")
-        if os.path.exists(metrics_path):
-            with open(metrics_path, "r") as mf:
-                mstore = json.load(mf)
-                profiles = mstore.get("merchant_profiles", {})
-                shop = (item.get("id") or "").split(":")[0]
-                prof = profiles.get(shop, {})
-                adjustments = prof.get("learning_adjustments") or {}
-    except Exception:
-        adjustments = {}
+    adjustments = _learning_adjustments(item)
 
     for i in range(n):
         if i == 0:
@@ -288,18 +283,7 @@ def generate_title_variants(item: Dict[str, Any], n: int = 5) -> List[Dict[str,
     variants = []
     endings = ["— Best Seller", "| New Arrival", "— Limited Edition", "| Comfortable Fit", "— Editor's Pick"]
     # load learning adjustments
-    adjustments: Dict[str, float] = {}
-    try:
-        metrics_path = os.path.join(os.path.dirname(__file__), "metrics_store.json")
-        if os.path.exists(metrics_path):
-            with open(metrics_path, "r") as mf:
-                mstore = json.load(mf)
-                profiles = mstore.get("merchant_profiles", {})
-                shop = (item.get("id") or "").split(":")[0]
-                prof = profiles.get(shop, {})
-                adjustments = prof.get("learning_adjustments") or {}
-    except Exception:
-        adjustments = {}
+    adjustments = _learning_adjustments(item)
 
     for i in range(n):
         title = f"{name} {endings[i % len(endings)]}"
@@ -319,11 +303,10 @@ def generate_title_variants(item: Dict[str, Any], n: int = 5) -> List[Dict[str,
 
 
 def suggest_upsell_bundles(shop_id: Optional[str], item_id: str, top_n: int = 3) -> List[Dict[str, Any]]:
-    store = load_store()
-    items = store.get("items", [])
+    store = _store()
     # pick top revenue products (simple) and exclude the source item
     revenue_map = {}
-    for e in store.get("events", []):
+    for e in store.find("events", product_prefix=f"{shop_id}:" if shop_id else None):
         pid = e.get("product_id")
         if not pid:
             continue
@@ -341,7 +324,7 @@ def suggest_upsell_bundles(shop_id: Optional[str], item_id: str, top_n: int = 3)
             break
     # fallback: random other items
     if len(suggestions) < top_n:
-        for it in items:
+        for it in store.find("items"):
             pid = it.get("id")
             if pid == item_id:
                 continue
@@ -359,8 +342,7 @@ def suggest_price_adjustment(item: Dict[str, Any]) -> Dict[str, Any]:
         price = float(item.get("price", 0) or 0)
     except Exception:
         price = 0.0
-    store = load_store()
-    prices = [float(it.get("price", 0) or 0) for it in store.get("items", []) if it.get("price")]
+    prices = [float(it.get("price", 0) or 0) for it in _store().find("items") if it.get("price")]
     avg_price = sum(prices) / len(prices) if prices else 0
     suggestion = {"current_price": price, "avg_price": round(avg_price, 2)}
     if price <= 0:
@@ -378,9 +360,7 @@ def suggest_price_adjustment(item: Dict[str, Any]) -> Dict[str, Any]:
 
 @app.get("/catalog/item/{item_id}/suggestions")
 def item_suggestions(item_id: str, shop_id: Optional[str] = None):
-    store = load_store()
-    items = store.get("items", [])
-    item = next((it for it in items if it.get("id") == item_id), None)
+    item = _store().get("items", item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
 
@@ -416,17 +396,17 @@ def estimate_item_impact(item_before: Dict[str, Any], item_after: Dict[str, Any]
 def optimize_and_deliver(req: BulkActionRequest):
     """Run requested optimizations synchronously (demo) and create a delivery record for the merchant with estimated lifts.
     Returns a summary including estimatedRevenueLift, conversionRateImpact, timeSavedMinutes, and a roiStatement."""
-    store = load_store()
-    items = store.setdefault("items", [])
+    store = _store()
     shop_id = req.shop_id
-    target_ids = req.item_ids or [i.get("id") for i in items]
+    target_ids = req.item_ids or [i.get("id") for i in store.find("items")]
+    items = store.get_many("items", target_ids)
     processed = 0
     total_revenue_lift = 0.0
     total_time_saved = 0.0
     details = []
 
     for item_id in target_ids:
-        item = next((it for it in items if it.get("id") == item_id), None)
+        item = items.get(item_id)
         if not item:
             continue
         before_snapshot = dict(item)
@@ -456,8 +436,8 @@ def optimize_and_deliver(req: BulkActionRequest):
         "details": details,
         "timestamp": str(time.time())
     }
-    store.setdefault("deliveries", []).append(delivery)
-    save_store(store)
+    store.put_many("items", list(items.values()))
+    store.put("deliveries", delivery)
 
     # create merchant-facing ROI statement
     roi_statement = f"Estimated monthly revenue lift ${delivery['total_revenue_lift']:,} and ~{int(delivery['total_time_saved_minutes'])} minutes saved across {processed} products."
@@ -477,5 +457,4 @@ def optimize_and_deliver(req: BulkActionRequest):
 
 @app.get("/catalog/deliveries/{shop_id}")
 def get_deliveries(shop_id: str):
-    store = load_store()
-    return [d for d in store.get("deliveries", []) if d.get("shop_id") == shop_id]
+    return _store().find("deliveries", shop_id=shop_id)
@@ -0,0 +1,701 @@
+"""Journaled credit ledger for the billing service.
+
+Every balance change (charges, usage debits, grants) is an entry appended to a
+JSON-lines journal segment; usage records ride along in the same entry, so a
+debit and its usage row are written atomically. Balances, the monthly
+per-feature usage counters and the per-feature usage aggregates live in memory
+and are rebuilt from the latest snapshot plus the live segment.
+
+Writes are group-committed: concurrent callers queue their operations, one of
+them validates the whole batch against current balances, appends it and calls
+fsync once for everyone. Several worker processes can share a ledger
+directory: commits hold an exclusive `flock` on `ledger.lock` and first catch
+up on entries other processes appended. Every `snapshot_every` entries the
+state is checkpointed and the journal rolls to a new segment, so recovery only
+replays the live segment. Sealed segments are kept as the usage history.
+
+Reservations place a hold on credits (a debit recorded with a reservation id
+and expiry). Settling one refunds whatever was not used; holds past their
+expiry are released by the next commit.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process safety only
+    fcntl = None
+
+DEFAULT_CREDITS = 1000.0
+SNAPSHOT_EVERY = 10_000
+LIFETIME = "all"
+_SNAPSHOT = "snapshot.json"
+_LOCK = "ledger.lock"
+
+
+class InsufficientCredits(Exception):
+    pass
+
+
+class ReservationNotFound(KeyError):
+    """The reservation does not exist, was already settled or has expired."""
+
+
+class ReservationAmountError(ValueError):
+    pass
+
+
+_SETTLE_KINDS = ("reserve_commit", "reserve_release", "reserve_expire")
+
+
+def month_key(timestamp) -> Optional[str]:
+    """Billing month ("YYYY-MM") of a datetime or stored ISO timestamp, None if unparseable."""
+    if not isinstance(timestamp, datetime):
+        try:
+            timestamp = datetime.fromisoformat(str(timestamp))
+        except (TypeError, ValueError):
+            return None
+    return f"{timestamp.year:04d}-{timestamp.month:02d}"
+
+
+def _segment_name(n: int) -> str:
+    return f"journal-{n:06d}.jsonl"
+
+
+class LedgerState:
+    """Balances and per-(shop, feature, month) usage totals derived from journal entries."""
+
+    def __init__(self, default_credits: float = DEFAULT_CREDITS):
+        self.default_credits = default_credits
+        self.balances: Dict[str, float] = {}
+        self.usage_counters: Dict[str, Dict[str, Dict[str, float]]] = {}
+        # shop ("" for none) -> feature -> period (LIFETIME or "YYYY-MM") -> [count, credits, time saved minutes]
+        self.feature_stats: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+        # reservation id -> {"shop_id", "amount", "expires_at"}
+        self.reservations: Dict[str, Dict[str, Any]] = {}
+        self.next_expiry = float("inf")
+
+    def balance(self, shop_id: str) -> float:
+        return self.balances.get(shop_id, self.default_credits)
+
+    def usage_total(self, shop_id: str, feature: str, month: str) -> float:
+        return self.usage_counters.get(shop_id, {}).get(feature, {}).get(month, 0.0)
+
+    def count_usage(self, usage: Dict[str, Any]) -> None:
+        """Usage without a shop, feature or parseable timestamp is not counted."""
+        month = month_key(usage.get("timestamp"))
+        if not usage.get("shop_id") or not usage.get("feature") or month is None:
+            return
+        per_month = self.usage_counters.setdefault(usage["shop_id"], {}).setdefault(usage["feature"], {})
+        per_month[month] = per_month.get(month, 0.0) + float(usage.get("amount", 0))
+
+    def aggregate_usage(self, usage: Dict[str, Any]) -> None:
+        """Add a usage row to its shop's per-feature totals, lifetime and for its month."""
+        per_period = self.feature_stats.setdefault(usage.get("shop_id") or "", {}).setdefault(usage.get("feature") or "unknown", {})
+        credits = float(usage.get("amount", 0) or 0)
+        minutes = float(usage.get("time_saved_minutes", 0) or 0)
+        month = month_key(usage.get("timestamp"))
+        for period in (LIFETIME, month) if month else (LIFETIME,):
+            stats = per_period.setdefault(period, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += credits
+            stats[2] += minutes
+
+    def feature_totals(self, shop_id: Optional[str] = None, month: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """Usage count, credits and time saved per feature for one shop (all shops if None)."""
+        shops = [self.feature_stats.get(shop_id, {})] if shop_id else self.feature_stats.values()
+        totals: Dict[str, Dict[str, float]] = {}
+        for features in shops:
+            for feature, per_period in features.items():
+                stats = per_period.get(month or LIFETIME)
+                if stats is None:
+                    continue
+                rec = totals.setdefault(feature, {"count": 0, "credits": 0.0, "time_saved_minutes": 0.0})
+                rec["count"] += stats[0]
+                rec["credits"] += stats[1]
+                rec["time_saved_minutes"] += stats[2]
+        return totals
+
+    def apply(self, entry: Dict[str, Any]) -> None:
+        shop_id = entry.get("shop_id")
+        if shop_id and entry.get("delta"):
+            self.balances[shop_id] = self.balance(shop_id) + entry["delta"]
+        if entry.get("usage"):
+            self.count_usage(entry["usage"])
+            self.aggregate_usage(entry["usage"])
+        kind = entry.get("kind")
+        if kind == "reserve":
+            res = entry["reservation"]
+            self.reservations[res["id"]] = {"shop_id": shop_id, "amount": res["amount"], "expires_at": res["expires_at"]}
+            self.next_expiry = min(self.next_expiry, res["expires_at"])
+        elif kind in _SETTLE_KINDS:
+            self.reservations.pop(entry["reservation"]["id"], None)
+
+    def expired_reservations(self, now: float) -> List[str]:
+        if now < self.next_expiry:
+            return []
+        expired = [rid for rid, res in self.reservations.items() if res["expires_at"] <= now]
+        self.next_expiry = min((res["expires_at"] for rid, res in self.reservations.items() if res["expires_at"] > now),
+                               default=float("inf"))
+        return expired
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"balances": self.balances, "usage_counters": self.usage_counters,
+                "feature_stats": self.feature_stats, "reservations": self.reservations}
+
+    def load(self, data: Dict[str, Any]) -> None:
+        self.balances = dict(data.get("balances", {}))
+        self.usage_counters = data.get("usage_counters", {})
+        self.feature_stats = data.get("feature_stats", {})
+        self.reservations = data.get("reservations", {})
+        self.next_expiry = min((r["expires_at"] for r in self.reservations.values()), default=float("inf"))
+
+
+class UsageIndex:
+    """Journal positions of usage entries, overall and per shop, in commit order.
+
+    Positions are packed into int64 (`segment << 40 | byte offset`) and kept in
+    compact arrays, so a page of one shop's history can be read with a few seeks.
+    """
+
+    def __init__(self):
+        self._all = array("q")
+        self._shops: Dict[str, array] = {}
+        self._high_water = (0, -1)
+
+    def add(self, segment: int, offset: int, shop_id: Optional[str]) -> None:
+        # replays after a snapshot reload revisit the live segment; skip what is indexed already
+        if (segment, offset) <= self._high_water:
+            return
+        self._high_water = (segment, offset)
+        pointer = segment << 40 | offset
+        self._all.append(pointer)
+        if shop_id:
+            self._shops.setdefault(shop_id, array("q")).append(pointer)
+
+    @property
+    def high_water(self) -> Tuple[int, int]:
+        return self._high_water
+
+    def pointers(self, shop_id: Optional[str]) -> array:
+        if shop_id is None:
+            return self._all
+        return self._shops.get(shop_id, array("q"))
+
+
+class _Op:
+    __slots__ = ("shop_id", "kind", "delta", "usage", "description", "require_funds", "limit", "extra",
+                 "reservation_id", "done", "entry", "error")
+
+    def __init__(self, shop_id, kind, delta=0.0, usage=None, description=None, require_funds=False, limit=None,
+                 extra=None, reservation_id=None):
+        self.shop_id = shop_id
+        self.kind = kind
+        self.delta = delta
+        self.usage = usage
+        self.description = description
+        self.require_funds = require_funds
+        self.limit = limit
+        self.extra = extra
+        # for settling kinds: the reservation to settle; `delta` is then the amount used
+        self.reservation_id = reservation_id
+        self.done = threading.Event()
+        self.entry: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+
+
+class CreditLedger:
+    def __init__(self, base_dir: str, default_credits: float = DEFAULT_CREDITS,
+                 snapshot_every: int = SNAPSHOT_EVERY, fsync: bool = True):
+        self.base_dir = base_dir
+        self.default_credits = default_credits
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.state = LedgerState(default_credits)
+        # guards the in-memory state and the journal position; held across a commit
+        self._io_lock = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._queue: List[_Op] = []
+        self._shop_locks: Dict[str, threading.Lock] = {}
+        self._opened = False
+        self._seq = 0
+        self._segment = 1
+        self._offset = 0
+        self._snapshot_sig: Optional[Tuple[int, int, int]] = None
+        self._since_snapshot = 0
+        self._usage_index: Optional[UsageIndex] = None
+        self.commits = 0
+
+    # -- files and cross-process locking ------------------------------------------
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.base_dir, name)
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(self._path(_LOCK), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _snapshot_signature(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self._path(_SNAPSHOT))
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _segments(self) -> List[str]:
+        try:
+            names = os.listdir(self.base_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n.startswith("journal-") and n.endswith(".jsonl"))
+
+    @property
+    def initialized(self) -> bool:
+        return os.path.exists(self._path(_SNAPSHOT))
+
+    def _write_snapshot(self) -> None:
+        data = {"seq": self._seq, "segment": self._segment, "state": self.state.to_dict()}
+        fd, tmp = tempfile.mkstemp(dir=self.base_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self._path(_SNAPSHOT))
+        self._snapshot_sig = self._snapshot_signature()
+
+    def _reload(self) -> None:
+        """Rebuild the state from the snapshot and the live segment (caller holds a file lock)."""
+        self.state = LedgerState(self.default_credits)
+        self._seq, self._segment, self._offset = 0, 1, 0
+        self._snapshot_sig = self._snapshot_signature()
+        if self._snapshot_sig is not None:
+            with open(self._path(_SNAPSHOT)) as f:
+                data = json.load(f)
+            self._seq = data["seq"]
+            self._segment = data["segment"]
+            self.state.load(data["state"])
+            if "feature_stats" not in data["state"]:
+                # snapshot predates the aggregates; derive them from the segments it covers
+                for usage in self._iter_sealed_usage(self._segment):
+                    self.state.aggregate_usage(usage)
+        self._since_snapshot = 0
+        if self._usage_index is not None:
+            # another worker may have appended to earlier segments before rolling them
+            self._scan_usage(self._usage_index, self._segment, 0)
+        self._read_tail(repair=False)
+        self._opened = True
+
+    def _read_tail(self, repair: bool) -> None:
+        """Apply entries appended to the live segment since `_offset`."""
+        path = self._path(_segment_name(self._segment))
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    if repair:  # torn write from a crashed process; drop it
+                        with open(path, "r+b") as w:
+                            w.truncate(self._offset)
+                    break
+                entry = json.loads(line)
+                self.state.apply(entry)
+                self._index(entry, self._segment, self._offset)
+                self._seq = max(self._seq, entry["seq"])
+                self._offset += len(line)
+                self._since_snapshot += 1
+
+    def _index(self, entry: Dict[str, Any], segment: int, offset: int) -> None:
+        if self._usage_index is not None and entry.get("usage"):
+            self._usage_index.add(segment, offset, entry["usage"].get("shop_id"))
+
+    def _sync(self, repair: bool = False) -> None:
+        if not self._opened or self._snapshot_signature() != self._snapshot_sig:
+            self._reload()
+        self._read_tail(repair)
+
+    # -- bootstrap ---------------------------------------------------------------
+
+    def bootstrap(self, source: Callable[[], Tuple[Dict[str, float], List[Dict[str, Any]]]]) -> None:
+        """Initialize an empty ledger from `source() -> (balances, historical usage records)`.
+
+        Historical usage goes into sealed segment 0 without changing balances.
+        Does nothing if the ledger already has a snapshot.
+        """
+        with self._io_lock, self._file_lock(exclusive=True):
+            if self.initialized:
+                return
+            balances, usage = source()
+            self.state = LedgerState(self.default_credits)
+            self.state.balances = {k: float(v) for k, v in balances.items()}
+            self._seq = 0
+            if usage:
+                with open(self._path(_segment_name(0)), "w") as f:
+                    for u in usage:
+                        self._seq += 1
+                        entry = {"seq": self._seq, "at": str(u.get("timestamp")), "shop_id": u.get("shop_id"),
+                                 "kind": "import", "delta": 0.0, "usage": u}
+                        self.state.apply(entry)
+                        f.write(json.dumps(entry, default=str, separators=(",", ":")) + "\n")
+            self._segment, self._offset = 1, 0
+            self._write_snapshot()
+            self._opened = True
+
+    # -- writes ----------------------------------------------------------------
+
+    @contextmanager
+    def shop_lock(self, shop_id: str):
+        """Serialize a multi-step operation on one shop within this process."""
+        with self._queue_lock:
+            lock = self._shop_locks.setdefault(shop_id, threading.Lock())
+        with lock:
+            yield
+
+    def submit(self, shop_id: Optional[str], kind: str, delta: float = 0.0, usage: Optional[Dict[str, Any]] = None,
+               description: Optional[str] = None, require_funds: bool = False,
+               limit: Optional[float] = None, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Durably append one entry and return it (with the resulting `balance`).
+
+        `require_funds` rejects a debit that would take the balance below zero with
+        `InsufficientCredits`. With `limit`, usage that would push the shop's monthly total
+        for the usage's feature above it is still recorded but not debited, and the entry
+        is marked `limit_exceeded`.
+        """
+        return self._submit(_Op(shop_id, kind, float(delta), usage, description, require_funds, limit, extra))
+
+    def submit_many(self, entries: List[Dict[str, Any]]) -> List[Any]:
+        """Append several entries (each a dict of `submit` keyword arguments) in one commit.
+
+        Entries are validated in order, so each sees the effect of the ones before it.
+        Returns, per entry, the committed entry or the exception that rejected it.
+        """
+        ops = [_Op(e["shop_id"], e["kind"], float(e.get("delta", 0.0)), e.get("usage"), e.get("description"),
+                   e.get("require_funds", False), e.get("limit"), e.get("extra")) for e in entries]
+        self._run(ops)
+        return [op.error if op.error is not None else op.entry for op in ops]
+
+    def _run(self, ops: List[_Op]) -> None:
+        with self._queue_lock:
+            self._queue.extend(ops)
+        with self._io_lock:
+            if not ops[-1].done.is_set():
+                with self._queue_lock:
+                    batch, self._queue = self._queue, []
+                self._commit(batch)
+        for op in ops:
+            op.done.wait()
+
+    def _submit(self, op: _Op) -> Dict[str, Any]:
+        self._run([op])
+        if op.error is not None:
+            raise op.error
+        return op.entry
+
+    def reserve(self, shop_id: str, amount: float, ttl_seconds: float,
+                description: Optional[str] = None) -> Dict[str, Any]:
+        """Hold `amount` credits for `ttl_seconds`; the entry's `reservation` has the id and expiry."""
+        if amount <= 0 or ttl_seconds <= 0:
+            raise ReservationAmountError("amount and ttl must be positive")
+        reservation = {"id": uuid.uuid4().hex, "amount": float(amount), "expires_at": time.time() + ttl_seconds}
+        return self._submit(_Op(shop_id, "reserve", -float(amount), description=description, require_funds=True,
+                                extra={"reservation": reservation}))
+
+    def settle(self, reservation_id: str, used: float = 0.0, usage: Optional[Dict[str, Any]] = None,
+               description: Optional[str] = None) -> Dict[str, Any]:
+        """Commit `used` credits of a reservation (0 releases it) and refund the rest.
+        Raises `ReservationNotFound` or `ReservationAmountError` if `used` exceeds the hold.
+        """
+        if used < 0:
+            raise ReservationAmountError("used amount must not be negative")
+        kind = "reserve_commit" if used > 0 else "reserve_release"
+        return self._submit(_Op(None, kind, float(used), usage=usage, description=description,
+                                reservation_id=reservation_id))
+
+    def reservation(self, reservation_id: str) -> Optional[Dict[str, Any]]:
+        return self._read(lambda s: dict(s.reservations[reservation_id]) if reservation_id in s.reservations else None)
+
+    def expire_reservations(self) -> int:
+        """Release holds past their expiry now instead of at the next commit; returns how many."""
+        now = time.time()
+        with self._io_lock, self._file_lock(exclusive=False):
+            self._sync()
+            due = any(res["expires_at"] <= now for res in self.state.reservations.values())
+        if not due:
+            return 0
+        with self._io_lock:
+            return self._commit([])
+
+    def _expiry_entries(self) -> List[Dict[str, Any]]:
+        entries = []
+        for rid in self.state.expired_reservations(time.time()):
+            res = self.state.reservations[rid]
+            self._seq += 1
+            entries.append({"seq": self._seq, "at": str(datetime.utcnow()), "shop_id": res["shop_id"],
+                            "kind": "reserve_expire", "delta": res["amount"], "reservation": {"id": rid}})
+        return entries
+
+    def _prepare_settle(self, op: _Op) -> Dict[str, Any]:
+        res = self.state.reservations.get(op.reservation_id)
+        if res is None:
+            raise ReservationNotFound(op.reservation_id)
+        used = op.delta
+        if used > res["amount"] + 1e-9:
+            raise ReservationAmountError(f"used {used} exceeds the reserved {res['amount']}")
+        op.shop_id = res["shop_id"]
+        self._seq += 1
+        entry = {"seq": self._seq, "at": str(datetime.utcnow()), "shop_id": op.shop_id, "kind": op.kind,
+                 "delta": res["amount"] - used, "reservation": {"id": op.reservation_id, "used": used}}
+        if op.description is not None:
+            entry["description"] = op.description
+        if op.usage is not None:
+            entry["usage"] = {**op.usage, "shop_id": op.shop_id}
+        return entry
+
+    def _prepare(self, op: _Op) -> Dict[str, Any]:
+        if op.reservation_id is not None:
+            return self._prepare_settle(op)
+        delta = op.delta
+        limit_exceeded = False
+        if op.limit is not None and op.usage and op.shop_id and op.usage.get("feature"):
+            month = month_key(op.usage.get("timestamp"))
+            total = self.state.usage_total(op.shop_id, op.usage["feature"], month) + float(op.usage.get("amount", 0))
+            if total > op.limit:
+                limit_exceeded = True
+                delta = 0.0
+        if op.require_funds and op.shop_id and delta < 0 and self.state.balance(op.shop_id) + delta < 0:
+            raise InsufficientCredits(op.shop_id)
+        self._seq += 1
+        entry = {"seq": self._seq, "at": str(datetime.utcnow()), "shop_id": op.shop_id, "kind": op.kind, "delta": delta}
+        if op.description is not None:
+            entry["description"] = op.description
+        if op.usage is not None:
+            entry["usage"] = op.usage
+        if limit_exceeded:
+            entry["limit_exceeded"] = True
+        if op.extra:
+            entry.update(op.extra)
+        return entry
+
+    def _commit(self, batch: List[_Op]) -> int:
+        """Validate, append and fsync `batch` plus any due reservation expiries; returns entries written.
+
+        Waiters are released as soon as the append is durable; a failing checkpoint
+        after that is logged and does not fail the committed operations.
+        """
+        durable = False
+        try:
+            with self._file_lock(exclusive=True):
+                self._sync(repair=True)
+                lines = []
+                written = []
+                for entry in self._expiry_entries():
+                    self.state.apply(entry)
+                    lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+                    written.append(entry)
+                for op in batch:
+                    try:
+                        entry = self._prepare(op)
+                    except (InsufficientCredits, ReservationNotFound, ReservationAmountError) as exc:
+                        op.error = exc
+                        continue
+                    self.state.apply(entry)
+                    if op.shop_id:
+                        entry["balance"] = self.state.balance(op.shop_id)
+                    lines.append(json.dumps(entry, default=str, separators=(",", ":")) + "\n")
+                    written.append(entry)
+                    op.entry = entry
+                if lines:
+                    encoded = [line.encode("utf-8") for line in lines]
+                    with open(self._path(_segment_name(self._segment)), "ab") as f:
+                        f.write(b"".join(encoded))
+                        f.flush()
+                        if self.fsync:
+                            os.fsync(f.fileno())
+                    for entry, line in zip(written, encoded):
+                        self._index(entry, self._segment, self._offset)
+                        self._offset += len(line)
+                    self._since_snapshot += len(lines)
+                    self.commits += 1
+                durable = True
+                for op in batch:
+                    op.done.set()
+                if lines and self._since_snapshot >= self.snapshot_every:
+                    try:
+                        self._checkpoint()
+                    except Exception:
+                        logger.exception("Ledger checkpoint failed in %s; the journal is intact", self.base_dir)
+                        # segment and snapshot may be half-rolled; resync from disk on next use
+                        self._opened = False
+                return len(lines)
+        except BaseException as exc:
+            # the in-memory state may be ahead of the journal; rebuild it on next use
+            self._opened = False
+            if not durable:
+                for op in batch:
+                    if op.error is None:
+                        op.error, op.entry = exc, None
+            raise
+        finally:
+            for op in batch:
+                op.done.set()
+
+    def _checkpoint(self) -> None:
+        """Snapshot the state and roll the journal to a new, empty segment."""
+        self._segment += 1
+        self._offset = 0
+        open(self._path(_segment_name(self._segment)), "a").close()
+        self._write_snapshot()
+        self._since_snapshot = 0
+
+    def checkpoint(self) -> None:
+        with self._io_lock, self._file_lock(exclusive=True):
+            self._sync(repair=True)
+            self._checkpoint()
+
+    # -- reads -----------------------------------------------------------------
+
+    def _read(self, fn: Callable[[LedgerState], Any]) -> Any:
+        with self._io_lock, self._file_lock(exclusive=False):
+            self._sync()
+            return fn(self.state)
+
+    def balance(self, shop_id: str) -> float:
+        return self._read(lambda s: s.balance(shop_id))
+
+    def balances(self) -> Dict[str, float]:
+        return self._read(lambda s: dict(s.balances))
+
+    def usage_total(self, shop_id: str, feature: str, month: str) -> float:
+        return self._read(lambda s: s.usage_total(shop_id, feature, month))
+
+    def iter_entries(self) -> Iterator[Dict[str, Any]]:
+        """All committed entries, oldest first, across sealed and live segments."""
+        for _, entry in self.iter_positions():
+            yield entry
+
+    def iter_positions(self, start: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[Tuple[int, int], Dict[str, Any]]]:
+        """Committed entries after journal position `start` (from the beginning if None),
+        each with the `(segment, offset)` position just past it, to resume from later."""
+        with self._io_lock, self._file_lock(exclusive=False):
+            self._sync()
+            last, end = self._segment, self._offset
+        start_segment, start_offset = start or (-1, 0)
+        for name in self._segments():
+            n = int(name[len("journal-"):-len(".jsonl")])
+            if n < start_segment:
+                continue
+            if n > last:
+                break
+            with open(self._path(name), "rb") as f:
+                read = start_offset if n == start_segment else 0
+                f.seek(read)
+                for line in f:
+                    if (n == last and read + len(line) > end) or not line.endswith(b"\n"):
+                        break
+                    read += len(line)
+                    yield (n, read), json.loads(line)
+
+    def iter_usage(self) -> Iterator[Dict[str, Any]]:
+        for entry in self.iter_entries():
+            if entry.get("usage"):
+                yield entry["usage"]
+
+    def _scan_usage(self, index: UsageIndex, end_segment: int, end_offset: int) -> None:
+        """Index usage entries after the index's high-water mark, up to `(end_segment, end_offset)`."""
+        start_segment, start_offset = index.high_water
+        for name in self._segments():
+            n = int(name[len("journal-"):-len(".jsonl")])
+            if n < start_segment:
+                continue
+            if n > end_segment or (n == end_segment and end_offset == 0):
+                break
+            with open(self._path(name), "rb") as f:
+                offset = max(start_offset, 0) if n == start_segment else 0
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n") or (n == end_segment and offset + len(line) > end_offset):
+                        break
+                    usage = json.loads(line).get("usage")
+                    if usage:
+                        index.add(n, offset, usage.get("shop_id"))
+                    offset += len(line)
+
+    def _ensure_usage_index(self) -> UsageIndex:
+        """Build the usage index from the journal on first use (caller holds `_io_lock`);
+        commits and catch-up keep it current afterwards."""
+        if self._usage_index is None:
+            index = UsageIndex()
+            self._scan_usage(index, self._segment, self._offset)
+            self._usage_index = index
+        return self._usage_index
+
+    def _read_at(self, pointer: int) -> Dict[str, Any]:
+        with open(self._path(_segment_name(pointer >> 40)), "rb") as f:
+            f.seek(pointer & ((1 << 40) - 1))
+            return json.loads(f.readline())
+
+    def usage_page(self, shop_id: Optional[str], limit: int, before: Optional[int] = None):
+        """Newest-first page of usage records for one shop (or all shops).
+
+        `before` is a position returned by a previous page; returns `(records, next_before)`
+        where `next_before` is None on the last page.
+        """
+        with self._io_lock, self._file_lock(exclusive=False):
+            self._sync()
+            pointers = self._ensure_usage_index().pointers(shop_id)
+            end = len(pointers) if before is None else max(0, min(before, len(pointers)))
+            start = max(0, end - limit)
+            selected = pointers[start:end]
+        records = [self._read_at(p)["usage"] for p in reversed(selected)]
+        return records, (start if start > 0 else None)
+
+    def _iter_sealed_usage(self, end_segment: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Usage rows of complete journal lines in segments before `end_segment` (all if None)."""
+        for name in self._segments():
+            if end_segment is not None and int(name[len("journal-"):-len(".jsonl")]) >= end_segment:
+                break
+            with open(self._path(name), "rb") as f:
+                for line in f:
+                    if line.endswith(b"\n"):
+                        usage = json.loads(line).get("usage")
+                        if usage:
+                            yield usage
+
+    def feature_totals(self, shop_id: Optional[str] = None, month: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        return self._read(lambda s: s.feature_totals(shop_id, month))
+
+    def rebuild_counters(self) -> Dict[str, Any]:
+        """Recompute usage counters and per-feature aggregates from the full journal history
+        and checkpoint them."""
+        with self._io_lock, self._file_lock(exclusive=True):
+            self._sync(repair=True)
+            fresh = LedgerState(self.default_credits)
+            for usage in self._iter_sealed_usage():
+                fresh.count_usage(usage)
+                fresh.aggregate_usage(usage)
+            self.state.usage_counters = fresh.usage_counters
+            self.state.feature_stats = fresh.feature_stats
+            self._checkpoint()
+            return self.state.usage_counters
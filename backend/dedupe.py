@@ -0,0 +1,122 @@
+"""Bounded-memory idempotency filter for event ingestion.
+
+Keys are remembered exactly in a bounded recent-key map; keys it has to evict
+for lack of space move into two rotating Bloom filter generations that together
+cover at least one `window_seconds`. A key is a certain duplicate if it is in
+the recent map. It is a probable duplicate if only the Bloom filter has it and
+the recent map has had to evict keys still inside the window; otherwise a Bloom
+hit is a false positive and the event is accepted. Because only evicted keys
+reach the Bloom filter, a key that was just accepted can still be `discard`ed
+when storing its event fails.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.bits_count = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.bits_count / capacity * math.log(2)))
+        self.bits = np.zeros((self.bits_count + 7) // 8, dtype=np.uint8)
+
+    def _indexes(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits_count for i in range(self.hash_count)]
+
+    def add(self, key: str) -> None:
+        for i in self._indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+    def fill_ratio(self) -> float:
+        return float(np.unpackbits(self.bits).sum()) / self.bits_count
+
+
+class IdempotencyFilter:
+    def __init__(self, window_seconds: float = 24 * 3600, capacity: int = 1_000_000,
+                 error_rate: float = 0.001, recent_size: int = 100_000):
+        self.window = window_seconds
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.recent_size = recent_size
+        self._lock = threading.Lock()
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous: Optional[BloomFilter] = None
+        self._rotated_at: Optional[float] = None
+        self._recent: "OrderedDict[str, float]" = OrderedDict()
+        # newest timestamp of a key evicted from `_recent` for lack of space
+        self._evicted_until = -math.inf
+        self.accepted = 0
+        self.duplicates_exact = 0
+        self.duplicates_probable = 0
+
+    def _rotate(self, now: float) -> None:
+        if self._rotated_at is None:
+            self._rotated_at = now
+        elif now - self._rotated_at >= self.window:
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = now
+        cutoff = now - self.window
+        while self._recent:
+            key, ts = next(iter(self._recent.items()))
+            if ts >= cutoff:
+                break
+            self._recent.popitem(last=False)
+
+    def _remember(self, key: str, now: float) -> None:
+        self._recent[key] = now
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.recent_size:
+            evicted, ts = self._recent.popitem(last=False)
+            self._current.add(evicted)
+            self._evicted_until = max(self._evicted_until, ts)
+
+    def check_and_add(self, key: str, now: Optional[float] = None) -> Optional[str]:
+        """Record `key`; return None if it is new, else "exact" or "probable" for a duplicate."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._rotate(now)
+            if key in self._recent:
+                self.duplicates_exact += 1
+                return "exact"
+            in_bloom = key in self._current or (self._previous is not None and key in self._previous)
+            if in_bloom and self._evicted_until >= now - self.window:
+                self.duplicates_probable += 1
+                return "probable"
+            self._remember(key, now)
+            self.accepted += 1
+            return None
+
+    def discard(self, key: str) -> None:
+        """Forget a key accepted by `check_and_add` whose event could not be stored."""
+        with self._lock:
+            if self._recent.pop(key, None) is not None:
+                self.accepted -= 1
+
+    def add(self, key: str, at: float) -> None:
+        """Seed the filter with a key seen at `at` (used when replaying stored history)."""
+        with self._lock:
+            if at >= time.time() - self.window:
+                self._remember(key, at)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "accepted": self.accepted,
+                "duplicates_exact": self.duplicates_exact,
+                "duplicates_probable": self.duplicates_probable,
+                "recent_keys": len(self._recent),
+                "bloom_fill_ratio": round(self._current.fill_ratio(), 4),
+                "window_seconds": self.window,
+            }
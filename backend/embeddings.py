@@ -0,0 +1,77 @@
+"""Hash-based text embeddings for merchant style profiles.
+
+Embeddings are computed for many descriptions at once into a float32 NumPy
+matrix and persisted per shop as a `.npy` sidecar that can be memory-mapped,
+so merchant profiles only carry a reference instead of nested float lists.
+"""
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .util import safe_name
+
+DEFAULT_DIM = 64
+
+
+@lru_cache(maxsize=200_000)
+def _token_bucket(token: str, dim: int) -> Tuple[int, float]:
+    """Map a token to its (bucket index, weight); cached since vocabularies repeat heavily."""
+    h = hashlib.md5(token.encode("utf-8")).digest()
+    val = int.from_bytes(h[:8], "little", signed=False)
+    return val % dim, (val % 1000) / 1000.0
+
+
+def batch_text_embeddings(texts: Sequence[str], dim: int = DEFAULT_DIM) -> np.ndarray:
+    """Embed `texts` into an L2-normalised `(len(texts), dim)` float32 matrix."""
+    if dim <= 0:
+        raise ValueError("dim must be positive")
+    rows: List[int] = []
+    cols: List[int] = []
+    weights: List[float] = []
+    for row, text in enumerate(texts):
+        if not text:
+            continue
+        for token in text.lower().split():
+            idx, weight = _token_bucket(token, dim)
+            rows.append(row)
+            cols.append(idx)
+            weights.append(weight)
+    mat = np.zeros((len(texts), dim), dtype=np.float32)
+    if rows:
+        np.add.at(mat, (np.asarray(rows), np.asarray(cols)), np.asarray(weights, dtype=np.float32))
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    mat /= norms
+    return mat
+
+
+def embeddings_path(base_dir: str, shop_id: str) -> str:
+    return os.path.join(base_dir, f"{safe_name(shop_id)}.npy")
+
+
+def save_embeddings(base_dir: str, shop_id: str, matrix: np.ndarray) -> str:
+    """Atomically write the shop's embedding matrix and return its path."""
+    os.makedirs(base_dir, exist_ok=True)
+    path = embeddings_path(base_dir, shop_id)
+    fd, tmp = tempfile.mkstemp(dir=base_dir, suffix=".npy.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+
+def load_embeddings(base_dir: str, shop_id: str, mmap: bool = True) -> Optional[np.ndarray]:
+    """Return the shop's embedding matrix (memory-mapped by default) or None if absent."""
+    path = embeddings_path(base_dir, shop_id)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r" if mmap else None)
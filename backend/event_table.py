@@ -0,0 +1,138 @@
+"""Compact columnar in-memory table of metrics events.
+
+Events are stored column-wise in fixed-size NumPy chunks instead of as dicts:
+epoch seconds (int64), an interned event-type code (uint8), revenue and time
+saved (float32) and a dictionary-encoded product id (int32). That is about 21
+bytes per event, and aggregations over the table are vectorized.
+"""
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .product_index import shop_of
+from .util import to_timestamp
+
+DEFAULT_CHUNK_SIZE = 65_536
+# events without a parseable timestamp count as current, so they pass every cutoff
+MISSING_TS = np.iinfo(np.int64).max
+_NO_PRODUCT = -1
+
+_DTYPES = {
+    "ts": np.int64,
+    "type": np.uint8,
+    "revenue": np.float32,
+    "time_saved": np.float32,
+    "product": np.int32,
+}
+
+
+class _Chunk:
+    __slots__ = ("columns", "size")
+
+    def __init__(self, capacity: int):
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in _DTYPES.items()}
+        self.size = 0
+
+    def view(self, name: str) -> np.ndarray:
+        return self.columns[name][: self.size]
+
+
+class EventTable:
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._chunks: List[_Chunk] = []
+        self._types: Dict[str, int] = {}
+        self._type_names: List[str] = []
+        self._products: Dict[str, int] = {}
+        # shop prefix -> codes of its products
+        self._shop_products: Dict[str, List[int]] = {}
+
+    def _intern_type(self, name: str) -> int:
+        code = self._types.get(name)
+        if code is None:
+            if len(self._type_names) > np.iinfo(np.uint8).max:
+                raise ValueError("too many distinct event types")
+            code = self._types[name] = len(self._type_names)
+            self._type_names.append(name)
+        return code
+
+    def _intern_product(self, product_id: str) -> int:
+        code = self._products.get(product_id)
+        if code is None:
+            code = self._products[product_id] = len(self._products)
+            shop = shop_of(product_id)
+            if shop is not None:
+                self._shop_products.setdefault(shop, []).append(code)
+        return code
+
+    def append(self, event: Dict[str, Any]) -> None:
+        raw_ts = event.get("timestamp")
+        ts = to_timestamp(raw_ts, default=float("nan")) if raw_ts else float("nan")
+        product_id = event.get("product_id")
+        with self._lock:
+            if not self._chunks or self._chunks[-1].size == self.chunk_size:
+                self._chunks.append(_Chunk(self.chunk_size))
+            chunk = self._chunks[-1]
+            i = chunk.size
+            cols = chunk.columns
+            cols["ts"][i] = MISSING_TS if ts != ts else int(ts)
+            cols["type"][i] = self._intern_type(str(event.get("type")))
+            cols["revenue"][i] = float(event.get("revenue") or 0)
+            cols["time_saved"][i] = float(event.get("time_saved_minutes") or 0)
+            if product_id is None:
+                cols["product"][i] = _NO_PRODUCT
+            else:
+                cols["product"][i] = self._intern_product(product_id)
+            chunk.size = i + 1
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(c.size for c in self._chunks)
+
+    @property
+    def nbytes(self) -> int:
+        """Allocated bytes of the column arrays (the last chunk is preallocated)."""
+        with self._lock:
+            return sum(col.nbytes for c in self._chunks for col in c.columns.values())
+
+    def totals(self, product_id: Optional[str] = None, since: Optional[float] = None,
+               shop_id: Optional[str] = None) -> Dict[str, Any]:
+        """Event counts per type plus revenue and time-saved sums, optionally for one
+        product, one shop's products and/or events at or after `since` (epoch seconds)."""
+        revenue = 0.0
+        time_saved = 0.0
+        with self._lock:
+            n_types = len(self._type_names)
+            type_names = list(self._type_names)
+            product = self._products.get(product_id) if product_id is not None else None
+            chunks = [] if product_id is not None and product is None else self._chunks
+            shop_codes = None
+            if shop_id is not None:
+                shop_codes = np.array(self._shop_products.get(shop_id, []), dtype=np.int32)
+                if not len(shop_codes):
+                    chunks = []
+            counts = np.zeros(n_types, dtype=np.int64)
+            # aggregate under the lock: the current chunk is filled in place by `append`
+            for chunk in chunks:
+                types, rev, saved = chunk.view("type"), chunk.view("revenue"), chunk.view("time_saved")
+                mask = None
+                if product is not None:
+                    mask = chunk.view("product") == product
+                if shop_codes is not None:
+                    in_shop = np.isin(chunk.view("product"), shop_codes)
+                    mask = in_shop if mask is None else mask & in_shop
+                if since is not None:
+                    recent = chunk.view("ts") >= since
+                    mask = recent if mask is None else mask & recent
+                if mask is not None:
+                    types, rev, saved = types[mask], rev[mask], saved[mask]
+                counts += np.bincount(types, minlength=n_types)[:n_types]
+                revenue += float(rev.sum(dtype=np.float64))
+                time_saved += float(saved.sum(dtype=np.float64))
+        return {
+            "counts": {name: int(counts[i]) for i, name in enumerate(type_names)},
+            "revenue": round(revenue, 2),
+            "time_saved_minutes": round(time_saved, 2),
+        }
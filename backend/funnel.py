@@ -0,0 +1,139 @@
+"""Streaming view -> try-on -> conversion funnel joined by session or visitor id.
+
+Each session keeps a small per-product state (first view, latest try-on)
+for `window_seconds` after its last event. A conversion or revenue event is
+attributed to the try-on only if the same session tried that product on within
+the window. Session state is bounded: sessions expire against the event-time
+watermark and the least recently active sessions are evicted beyond
+`max_sessions`.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from .product_index import shop_of
+from .util import to_timestamp
+
+DEFAULT_WINDOW_SECONDS = 24 * 3600
+_MAX_PRODUCTS_PER_SESSION = 64
+_UNSCOPED = "_unscoped"
+
+
+class _Session:
+    __slots__ = ("last_seen", "products")
+
+    def __init__(self, ts: float):
+        self.last_seen = ts
+        # product_id -> {"viewed": bool, "tryon_at": Optional[float]}
+        self.products: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def _new_stats() -> Dict[str, float]:
+    return {"views": 0, "tryons": 0, "conversions": 0, "tryon_conversions": 0, "attributed_revenue": 0.0}
+
+
+class FunnelEngine:
+    def __init__(self, window_seconds: float = DEFAULT_WINDOW_SECONDS, max_sessions: int = 100_000):
+        self.window = window_seconds
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._watermark = float("-inf")
+        # shop -> product -> counters
+        self._stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+        self.untracked_events = 0
+
+    def _expire(self) -> None:
+        cutoff = self._watermark - self.window
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_seen >= cutoff and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.popitem(last=False)
+
+    def add_event(self, event: Dict[str, Any]) -> None:
+        key = event.get("session_id") or event.get("visitor_id")
+        product_id = event.get("product_id")
+        etype = event.get("type")
+        if not key or not product_id or etype not in ("view", "tryon", "conversion", "revenue"):
+            with self._lock:
+                self.untracked_events += 1
+            return
+        ts = to_timestamp(event.get("timestamp"))
+        with self._lock:
+            self._watermark = max(self._watermark, ts)
+            session = self._sessions.get(key)
+            if session is None or ts - session.last_seen > self.window:
+                session = self._sessions[key] = _Session(ts)
+            session.last_seen = max(session.last_seen, ts)
+            self._sessions.move_to_end(key)
+
+            state = session.products.get(product_id)
+            if state is None:
+                state = session.products[product_id] = {"viewed": False, "tryon_at": None}
+                if len(session.products) > _MAX_PRODUCTS_PER_SESSION:
+                    session.products.popitem(last=False)
+            stats = self._stats.setdefault(shop_of(product_id) or _UNSCOPED, {}).setdefault(product_id, _new_stats())
+
+            if etype == "view":
+                if not state["viewed"]:
+                    state["viewed"] = True
+                    stats["views"] += 1
+            elif etype == "tryon":
+                if state["tryon_at"] is None:
+                    stats["tryons"] += 1
+                state["tryon_at"] = ts
+            else:
+                tried = state["tryon_at"] is not None and 0 <= ts - state["tryon_at"] <= self.window
+                if etype == "conversion":
+                    stats["conversions"] += 1
+                    if tried:
+                        stats["tryon_conversions"] += 1
+                if tried:
+                    stats["attributed_revenue"] += float(event.get("revenue") or 0)
+            self._expire()
+
+    @property
+    def active_sessions(self) -> int:
+        return len(self._sessions)
+
+    def report(self, shop_id: Optional[str] = None, top_n: int = 50) -> Dict[str, Any]:
+        """Funnel counts and attributed revenue per product for one shop (or all shops)."""
+        with self._lock:
+            if shop_id is not None:
+                per_product = dict(self._stats.get(shop_id, {}))
+            else:
+                per_product = {pid: st for shop in self._stats.values() for pid, st in shop.items()}
+            per_product = {pid: dict(st) for pid, st in per_product.items()}
+            active = len(self._sessions)
+        totals = _new_stats()
+        for st in per_product.values():
+            for k in totals:
+                totals[k] += st[k]
+        products: List[Dict[str, Any]] = []
+        for pid, st in sorted(per_product.items(), key=lambda x: x[1]["attributed_revenue"], reverse=True)[:top_n]:
+            products.append({"product_id": pid, **_with_rates(st)})
+        return {
+            "shop_id": shop_id or "all",
+            "window_seconds": self.window,
+            "active_sessions": active,
+            "totals": _with_rates(totals),
+            "products": products,
+        }
+
+
+def _with_rates(st: Dict[str, float]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {k: (round(v, 2) if k == "attributed_revenue" else int(v)) for k, v in st.items()}
+    out["view_to_tryon_pct"] = round(st["tryons"] / st["views"] * 100, 2) if st["views"] else 0.0
+    out["tryon_to_conversion_pct"] = round(st["tryon_conversions"] / st["tryons"] * 100, 2) if st["tryons"] else 0.0
+    return out
+
+
+def replay(events, window_seconds: float = DEFAULT_WINDOW_SECONDS, shop_id: Optional[str] = None) -> FunnelEngine:
+    """Build a funnel from historical events, streamed in event-time order
+    (e.g. `ShardedMetricsStore.iter_by_time`); nothing is buffered here."""
+    engine = FunnelEngine(window_seconds)
+    for e in events:
+        if shop_id is None or shop_of(e.get("product_id")) == shop_id:
+            engine.add_event(e)
+    return engine
@@ -0,0 +1,157 @@
+"""Monthly invoice generation from the credit ledger's usage history.
+
+`InvoiceJob.run` streams journal entries once, from where the previous run
+stopped, and folds each usage row into a per-(month, shop) aggregate of line
+items keyed by usage type and feature. Only aggregates of months that are
+still open are kept (in `state.json`), so memory is bounded by open months x
+shops x features rather than by history length.
+
+A month closes once the clock passes its end (plus `grace_days`): its invoices
+are written as final JSON and CSV documents under `<out_dir>/<YYYY-MM>/` and
+never recomputed. Open months get provisional invoices, rewritten on every run.
+Rows the ledger refused for exceeding the plan's feature limit are not billed.
+Usage that arrives for an already closed month is billed on the shop's invoice
+for the current month as a separate line carrying its `service_month`.
+"""
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .credit_ledger import CreditLedger, month_key
+from .util import safe_name
+
+_STATE = "state.json"
+CSV_FIELDS = ("type", "feature", "service_month", "quantity", "amount", "time_saved_minutes")
+
+
+def _month_end(month: str) -> datetime:
+    year, mon = (int(p) for p in month.split("-"))
+    return datetime(year + mon // 12, mon % 12 + 1, 1)
+
+
+def _write_atomic(path: str, data: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".invoice-", suffix=".tmp")
+    with os.fdopen(fd, "w", newline="") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _line_key(usage: Dict[str, Any], service_month: Optional[str]) -> str:
+    # JSON-encoded so types and features may contain any character; state.json needs string keys
+    return json.dumps([str(usage.get("type") or "unknown"), str(usage.get("feature") or ""), service_month or ""])
+
+
+def _parse_line_key(key: str) -> List[str]:
+    if key.startswith("["):
+        return json.loads(key)
+    return key.split("|", 2)  # written by an older version
+
+
+def invoice_path(out_dir: str, shop_id: str, month: str, fmt: str) -> str:
+    """Where the job writes a shop's invoice; the shop id is mapped through `safe_name`."""
+    return os.path.join(out_dir, month, f"{safe_name(shop_id)}.{fmt}")
+
+
+def invoice_document(shop_id: str, month: str, lines: Dict[str, List[float]], status: str) -> Dict[str, Any]:
+    items = []
+    for key in sorted(lines):
+        usage_type, feature, service_month = _parse_line_key(key)
+        quantity, amount, minutes = lines[key]
+        items.append({"type": usage_type, "feature": feature or None, "service_month": service_month or month,
+                      "quantity": int(quantity), "amount": round(amount, 4), "time_saved_minutes": round(minutes, 2)})
+    return {
+        "invoice_id": f"{shop_id}-{month}",
+        "shop_id": shop_id,
+        "month": month,
+        "status": status,
+        "generated_at": datetime.utcnow().isoformat(),
+        "lines": items,
+        "totals": {
+            "quantity": sum(i["quantity"] for i in items),
+            "amount": round(sum(i["amount"] for i in items), 4),
+            "time_saved_minutes": round(sum(i["time_saved_minutes"] for i in items), 2),
+        },
+    }
+
+
+def invoice_csv(document: Dict[str, Any]) -> str:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for line in document["lines"]:
+        writer.writerow(line)
+    return buf.getvalue()
+
+
+class InvoiceJob:
+    def __init__(self, ledger: CreditLedger, out_dir: str, grace_days: float = 0.0,
+                 clock: Callable[[], float] = time.time):
+        self.ledger = ledger
+        self.out_dir = out_dir
+        self.grace_days = grace_days
+        self.clock = clock
+
+    def _load_state(self) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self.out_dir, _STATE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"position": None, "closed": [], "open": {}}
+
+    def _is_closed(self, month: str, now: datetime) -> bool:
+        return now >= _month_end(month) + timedelta(days=self.grace_days)
+
+    def _write(self, document: Dict[str, Any]) -> None:
+        shop_id, month = document["shop_id"], document["month"]
+        _write_atomic(invoice_path(self.out_dir, shop_id, month, "json"), json.dumps(document, indent=2))
+        _write_atomic(invoice_path(self.out_dir, shop_id, month, "csv"), invoice_csv(document))
+
+    def run(self) -> Dict[str, Any]:
+        """Fold new usage into the open months, close finished months and write invoices.
+        Returns counts of what this run did."""
+        state = self._load_state()
+        now = datetime.utcfromtimestamp(self.clock())
+        current = month_key(now)
+        closed = set(state["closed"])
+        open_months: Dict[str, Dict[str, Dict[str, List[float]]]] = state["open"]
+        position: Optional[Tuple[int, int]] = tuple(state["position"]) if state["position"] else None
+        records = late = 0
+
+        for position, entry in self.ledger.iter_positions(position):
+            usage = entry.get("usage")
+            if not usage or not usage.get("shop_id") or entry.get("limit_exceeded"):
+                continue  # rows over the plan's feature limit were refused and never debited
+            month = month_key(usage.get("timestamp")) or month_key(entry.get("at")) or current
+            service_month = None
+            if month in closed:
+                # the month's invoice is final; bill the late row on the current one
+                service_month, month = month, current
+                late += 1
+            shop_lines = open_months.setdefault(month, {}).setdefault(usage["shop_id"], {})
+            line = shop_lines.setdefault(_line_key(usage, service_month), [0, 0.0, 0.0])
+            line[0] += 1
+            line[1] += float(usage.get("amount", 0) or 0)
+            line[2] += float(usage.get("time_saved_minutes", 0) or 0)
+            records += 1
+
+        closing = sorted(m for m in open_months if self._is_closed(m, now))
+        invoices = 0
+        for month in sorted(open_months):
+            status = "closed" if month in closing else "open"
+            for shop_id, lines in open_months[month].items():
+                self._write(invoice_document(shop_id, month, lines, status))
+                invoices += 1
+        for month in closing:
+            del open_months[month]
+            closed.add(month)
+
+        state = {"position": list(position) if position else None, "closed": sorted(closed), "open": open_months}
+        _write_atomic(os.path.join(self.out_dir, _STATE), json.dumps(state))
+        return {"records": records, "late_records": late, "invoices_written": invoices,
+                "closed_months": closing, "open_months": sorted(open_months)}
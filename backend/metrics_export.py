@@ -0,0 +1,220 @@
+"""Columnar export of metrics events, ratings and edits (Parquet or Arrow IPC).
+
+Records are streamed from the metrics store, filtered by shop and time range
+while they are read, and converted to Arrow record batches of `batch_size`
+rows. Only one batch per open partition is held in memory.
+
+Usage:
+
+    python -m backend.metrics_export --out exports/ --format parquet --shop-id demo-shop --from 2026-01-01
+
+`pyarrow` is an optional dependency, needed only for exports.
+"""
+import argparse
+import io
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .product_index import shop_of
+from .util import safe_name, to_timestamp
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = None
+
+KINDS = ("events", "ratings", "edits")
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+DEFAULT_BATCH_SIZE = 10_000
+_MAX_OPEN_PARTITIONS = 32
+
+# column name -> arrow type name; "timestamp" and "shop_id" are derived for every kind
+_COLUMNS: Dict[str, List[Tuple[str, str]]] = {
+    "events": [("product_id", "string"), ("type", "string"), ("revenue", "float64"),
+               ("time_saved_minutes", "float64"), ("visitor_id", "string"), ("session_id", "string"),
+               ("idempotency_key", "string")],
+    "ratings": [("product_id", "string"), ("output_type", "string"), ("rating", "int32"), ("notes", "string")],
+    "edits": [("product_id", "string"), ("field", "string"), ("original", "string"), ("edited", "string"),
+              ("time_saved_minutes", "float64")],
+}
+
+RecordSource = Callable[[str, Optional[str]], Iterable[Dict[str, Any]]]
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise RuntimeError("pyarrow is required for columnar export (pip install pyarrow)")
+
+
+def schema_for(kind: str):
+    _require_pyarrow()
+    fields = [pa.field("timestamp", pa.timestamp("us", tz="UTC")), pa.field("shop_id", pa.string())]
+    fields += [pa.field(name, getattr(pa, type_name)()) for name, type_name in _COLUMNS[kind]]
+    return pa.schema(fields)
+
+
+def _record_shop(kind: str, rec: Dict[str, Any]) -> Optional[str]:
+    return shop_of(rec.get("product_id")) if kind == "events" else rec.get("shop_id")
+
+
+def iter_rows(kind: str, records: Iterable[Dict[str, Any]], shop_id: Optional[str] = None,
+              start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """Yield flattened export rows, applying the shop and `[start, end)` predicates."""
+    for rec in records:
+        shop = _record_shop(kind, rec)
+        if shop_id is not None and shop != shop_id:
+            continue
+        raw_ts = rec.get("timestamp")
+        ts = to_timestamp(raw_ts, default=float("nan")) if raw_ts else None
+        if ts is not None and ts != ts:
+            ts = None
+        if (start is not None or end is not None) and ts is None:
+            continue
+        if start is not None and ts < start:
+            continue
+        if end is not None and ts >= end:
+            continue
+        row = {"timestamp": datetime.fromtimestamp(ts, tz=timezone.utc) if ts is not None else None, "shop_id": shop}
+        for name, _ in _COLUMNS[kind]:
+            row[name] = rec.get(name)
+        yield row
+
+
+def _to_batch(schema, rows: List[Dict[str, Any]]):
+    return pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that collects bytes so they can be yielded as a stream."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _open_writer(sink, schema, fmt: str):
+    if fmt == "parquet":
+        return pq.ParquetWriter(sink, schema, compression="zstd")
+    return ipc.new_stream(sink, schema)
+
+
+def stream_export(kind: str, records: Iterable[Dict[str, Any]], fmt: str = "parquet",
+                  shop_id: Optional[str] = None, start: Optional[float] = None, end: Optional[float] = None,
+                  batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[bytes]:
+    """Yield one Parquet/Arrow IPC file of `kind` as byte chunks, one per written batch."""
+    _require_pyarrow()
+    schema = schema_for(kind)
+    sink = _ChunkSink()
+    writer = _open_writer(pa.PythonFile(sink, mode="w"), schema, fmt)
+    rows: List[Dict[str, Any]] = []
+    for row in iter_rows(kind, records, shop_id, start, end):
+        rows.append(row)
+        if len(rows) >= batch_size:
+            writer.write_batch(_to_batch(schema, rows))
+            rows = []
+            yield sink.drain()
+    if rows:
+        writer.write_batch(_to_batch(schema, rows))
+    writer.close()
+    yield sink.drain()
+
+
+def _partition_dir(out_dir: str, kind: str, row: Dict[str, Any]) -> str:
+    day = row["timestamp"].date().isoformat() if row["timestamp"] else "unknown"
+    # the shop id comes from stored records; map it so it cannot name a path outside out_dir
+    shop = safe_name(row["shop_id"]) if row["shop_id"] else "_unscoped"
+    return os.path.join(out_dir, kind, f"shop_id={shop}", f"date={day}")
+
+
+def export_partitioned(out_dir: str, source: RecordSource, fmt: str = "parquet", kinds: Iterable[str] = KINDS,
+                       shop_id: Optional[str] = None, start: Optional[float] = None, end: Optional[float] = None,
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, int]:
+    """Write hive-style `<kind>/shop_id=<shop>/date=<day>/part-N` files and return row counts per kind.
+
+    `source(kind, shop_id)` yields stored records; it may use `shop_id` to skip other shops' data.
+    `<shop>` is the shop id mapped through `util.safe_name`.
+    At most `_MAX_OPEN_PARTITIONS` partition writers (and their row buffers) are open at once.
+    """
+    _require_pyarrow()
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {sorted(FORMATS)}")
+    counts: Dict[str, int] = {}
+    for kind in kinds:
+        schema = schema_for(kind)
+        open_parts: "OrderedDict[str, Tuple[Any, List[Dict[str, Any]]]]" = OrderedDict()
+        part_numbers: Dict[str, int] = {}
+
+        def flush(path: str, close: bool = False) -> None:
+            writer, buf = open_parts[path]
+            if buf:
+                writer.write_batch(_to_batch(schema, buf))
+                buf.clear()
+            if close:
+                writer.close()
+                del open_parts[path]
+
+        counts[kind] = 0
+        for row in iter_rows(kind, source(kind, shop_id), shop_id, start, end):
+            path = _partition_dir(out_dir, kind, row)
+            if path not in open_parts:
+                if len(open_parts) >= _MAX_OPEN_PARTITIONS:
+                    flush(next(iter(open_parts)), close=True)
+                os.makedirs(path, exist_ok=True)
+                n = part_numbers.get(path, 0)
+                part_numbers[path] = n + 1
+                open_parts[path] = (_open_writer(os.path.join(path, f"part-{n}{FORMATS[fmt]}"), schema, fmt), [])
+            open_parts.move_to_end(path)
+            buf = open_parts[path][1]
+            buf.append(row)
+            counts[kind] += 1
+            if len(buf) >= batch_size:
+                flush(path)
+        for path in list(open_parts):
+            flush(path, close=True)
+    return counts
+
+
+def _parse_date(value: Optional[str]) -> Optional[float]:
+    return to_timestamp(value) if value else None
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from . import metrics_service
+
+    parser = argparse.ArgumentParser(description="Export metrics data to partitioned Parquet/Arrow files")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="comma-separated subset of events,ratings,edits")
+    parser.add_argument("--shop-id", default=None)
+    parser.add_argument("--from", dest="start", default=None, help="ISO date/time, inclusive")
+    parser.add_argument("--to", dest="end", default=None, help="ISO date/time, exclusive")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    kinds = [k for k in args.kinds.split(",") if k]
+    unknown = set(kinds) - set(KINDS)
+    if unknown:
+        parser.error(f"unknown kinds: {', '.join(sorted(unknown))}")
+    counts = export_partitioned(args.out, metrics_service.iter_records, args.format, kinds, args.shop_id,
+                                _parse_date(args.start), _parse_date(args.end), args.batch_size)
+    for kind, n in counts.items():
+        print(f"{kind}: {n} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,207 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
-import json
+import logging
 import os
-import hashlib
-import math
+import threading
+import time
 from typing import Dict, Any
 
+import numpy as np
+
+from .benchmark_snapshots import DEFAULT_REFRESH_SECONDS, SnapshotScheduler, SnapshotStore
+from .dedupe import IdempotencyFilter
+from .event_table import EventTable
+from .embeddings import DEFAULT_DIM, batch_text_embeddings, load_embeddings, save_embeddings
+from . import metrics_export
+from .funnel import DEFAULT_WINDOW_SECONDS, FunnelEngine, replay as replay_funnel
+from .metrics_shards import Shard, ShardedMetricsStore
+from .product_index import ProductRevenueIndex, shop_of
+from .profile_store import ProfileStore
+from .similarity_index import SimilarityRegistry
+from .sketches import MetricSketches
+from .storage import open_store
+from .timeseries import BUCKET_SECONDS, DEFAULT_MAX_POINTS, RollupIndex
+from .token_index import DecayedTokenTrends, TokenStatsIndex
+from .util import to_timestamp
+
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Digicloset Metrics Service")
 
 STORE_PATH = os.path.join(os.path.dirname(__file__), "metrics_store.json")
+EMBEDDINGS_DIR = os.path.join(os.path.dirname(__file__), "embeddings")
+SHARDS_DIR = os.path.join(os.path.dirname(__file__), "metrics_shards")
+
+_similarity = SimilarityRegistry()
+_profiles = ProfileStore(legacy_store=STORE_PATH)
+_shards = ShardedMetricsStore(SHARDS_DIR)
+# guards moving data out of the legacy single-document store
+_migration_lock = threading.Lock()
+
+# how stale the in-memory indexes may get relative to appends by other worker processes
+SYNC_SECONDS = float(os.getenv("METRICS_SYNC_SECONDS", "1.0"))
+BENCHMARK_REFRESH_SECONDS = float(os.getenv("METRICS_BENCHMARK_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS))
+_snapshots = SnapshotStore()
+_scheduler = SnapshotScheduler(
+    _snapshots, BENCHMARK_REFRESH_SECONDS, on_error=lambda exc: logger.error("Benchmark snapshot refresh failed: %s", exc)
+)
 
 def load_store():
-    if not os.path.exists(STORE_PATH):
-        return {"events": []}
-    with open(STORE_PATH, "r") as f:
-        return json.load(f)
+    return open_store(STORE_PATH, "metrics").load()
 
 def save_store(store):
-    with open(STORE_PATH, "w") as f:
-        json.dump(store, f, default=str)
+    open_store(STORE_PATH, "metrics").save(store)
+
+
+_SHARDED_KINDS = ("events", "ratings", "edits", "monthly_summaries")
+
+
+def _shard_key(kind: str, record: dict) -> Optional[str]:
+    """Events are sharded by the shop prefix of their product id, ratings and edits by
+    `shop_id`; monthly summaries and unscoped records go to the global shard (None).
+    """
+    if kind == "events":
+        shop = shop_of(record.get("product_id"))
+    elif kind in ("ratings", "edits"):
+        shop = record.get("shop_id")
+    else:
+        shop = None
+    return shop or None
+
+
+def _get_shards() -> ShardedMetricsStore:
+    """Return the sharded metrics store, moving events, ratings, edits and monthly
+    summaries out of the legacy single-document store on first use.
+    """
+    shards = _shards
+    if not shards.migrated:
+        with _migration_lock:
+            if not shards.migrated:
+                store = load_store()
+                legacy = {kind: store.pop(kind, None) or [] for kind in _SHARDED_KINDS}
+                shards.import_legacy(legacy, _shard_key)
+                if any(legacy.values()):
+                    save_store(store)
+    return shards
+
+
+def _shard_for(kind: str, record: dict) -> Shard:
+    return _get_shards().shard(_shard_key(kind, record))
+
+
+def _append(kind: str, record: dict) -> None:
+    _shard_for(kind, record).append(kind, record)
+
+
+def iter_records(kind: str, shop_id: Optional[str] = None):
+    """Yield stored records of `kind` ('events', 'ratings' or 'edits').
+    With `shop_id` only that shop's shard is read; callers still filter rows themselves
+    (unscoped records live in the global shard and are skipped).
+    """
+    yield from _get_shards().iter(kind, shop_id)
+
+
+class _DerivedState:
+    """In-memory indexes derived from the persisted history.
+
+    They are built from the shards once per process and then kept current by
+    reading each shard's tail past the last position consumed: a write catches up
+    on the shard it wrote to, and reads catch up on all shards at most every
+    `SYNC_SECONDS`, so appends by other worker processes are picked up too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = False
+        self.synced_at = 0.0
+        # kind -> shard name -> position past the last record indexed
+        self.positions: Dict[str, Dict[str, Any]] = {kind: {} for kind in _INDEXED_KINDS}
+        self.events = EventTable()
+        self.token_stats = TokenStatsIndex()
+        self.trends = DecayedTokenTrends()
+        self.product_revenue = ProductRevenueIndex()
+        self.sketches = MetricSketches()
+        # lighter per-shop sketches keep memory bounded as the number of shops grows
+        self.shop_sketches: Dict[str, MetricSketches] = {}
+        self.rollups = RollupIndex()
+        self.dedupe = IdempotencyFilter()
+        self.funnel = FunnelEngine()
+
+    def sketches_for(self, shop_id: Optional[str]) -> Optional[MetricSketches]:
+        if shop_id is None:
+            return self.sketches
+        return self.shop_sketches.get(shop_id)
+
+
+_INDEXED_KINDS = ("events", "ratings", "edits")
+_derived = _DerivedState()
+
+
+def _index_event(event: dict) -> None:
+    _derived.events.append(event)
+    _derived.product_revenue.add(event.get("product_id"), event.get("revenue"))
+    _derived.sketches.add_event(event)
+    _derived.rollups.add_event(event)
+    _derived.funnel.add_event(event)
+    shop = shop_of(event.get("product_id"))
+    if shop is not None:
+        sketches = _derived.shop_sketches.get(shop)
+        if sketches is None:
+            sketches = _derived.shop_sketches.setdefault(
+                shop, MetricSketches(hll_precision=10, compression=50, cms_width=512, top_k=10)
+            )
+        sketches.add_event(event)
+
+
+def _index_rating(rating: dict) -> None:
+    _derived.token_stats.add_rating(rating.get("notes"), rating.get("rating"), rating.get("timestamp"))
+
+
+def _index_edit(edit: dict) -> None:
+    _derived.token_stats.add_edit(edit.get("edited"), edit.get("timestamp"))
+    _derived.trends.add(edit.get("edited"), edit.get("timestamp"))
+
+
+def _index_stored_event(event: dict) -> None:
+    _index_event(event)
+    if event.get("idempotency_key"):
+        _derived.dedupe.add(event["idempotency_key"], to_timestamp(event.get("timestamp")))
+
+
+_INDEXERS = {"events": _index_stored_event, "ratings": _index_rating, "edits": _index_edit}
+
+
+def _catch_up(kinds=_INDEXED_KINDS, shards: Optional[List[Shard]] = None) -> None:
+    """Index records appended (by any process) since the last catch-up; caller holds `_derived.lock`."""
+    store = _get_shards()
+    for kind in kinds:
+        positions = _derived.positions[kind]
+        # merged by time so the funnel watermark advances evenly across shops
+        for shard, record, position in store.tail_by_time(kind, positions, shards):
+            _INDEXERS[kind](record)
+            positions[shard.name] = position
+
+
+def _ensure_derived() -> _DerivedState:
+    derived = _derived
+    if derived.ready and time.monotonic() - derived.synced_at < SYNC_SECONDS:
+        return derived
+    with derived.lock:
+        if not derived.ready or time.monotonic() - derived.synced_at >= SYNC_SECONDS:
+            _catch_up()
+            derived.synced_at = time.monotonic()
+            derived.ready = True
+    return derived
+
+
+def _store_and_index(kind: str, record: dict) -> None:
+    """Append a record and index it together with anything else new in its shard."""
+    with _derived.lock:
+        _append(kind, record)
+        _catch_up((kind,), [_shard_for(kind, record)])
 
 class Event(BaseModel):
     timestamp: datetime
@@ -28,6 +209,9 @@ class Event(BaseModel):
     revenue: Optional[float] = None
     time_saved_minutes: Optional[float] = None
     product_id: Optional[str] = None
+    visitor_id: Optional[str] = None
+    session_id: Optional[str] = None
+    idempotency_key: Optional[str] = None  # client-generated; retries reuse it
 
 class MonthlySummary(BaseModel):
     month: str
@@ -69,21 +253,46 @@ class EditRecord(BaseModel):
 
 @app.post("/metrics/record")
 def record_event(event: Event):
-    store = load_store()
-    store.setdefault("events", []).append(event.dict())
-    save_store(store)
+    derived = _ensure_derived()
+    entry = event.dict()
+    if event.idempotency_key:
+        with derived.lock:
+            # see keys other workers stored for this shop before checking
+            _catch_up(("events",), [_shard_for("events", entry)])
+            duplicate = derived.dedupe.check_and_add(event.idempotency_key)
+        if duplicate:
+            return {"status": "duplicate", "match": duplicate}
+    try:
+        _store_and_index("events", entry)
+    except BaseException:
+        # the event was not stored, so a retry with the same key must be accepted
+        if event.idempotency_key:
+            derived.dedupe.discard(event.idempotency_key)
+        raise
     return {"status": "ok"}
 
+@app.get("/metrics/dedupe_stats")
+def dedupe_stats():
+    """Counters for idempotency-key checks on `/metrics/record`."""
+    return _ensure_derived().dedupe.stats()
+
+
 @app.get("/metrics/summary")
-def metrics_summary(product_id: Optional[str] = None):
-    store = load_store()
-    events = [e for e in store.get("events", []) if (product_id is None or e.get("product_id") == product_id)]
+def metrics_summary(product_id: Optional[str] = None, shop_id: Optional[str] = None):
+    """Exact lifetime totals plus an `approximate` block of streaming-sketch estimates
+    with error bounds. `shop_id` scopes both to one shop's products; `product_id`
+    narrows the exact totals to one product. Monthly summaries are always global.
+    """
+    derived = _ensure_derived()
+    sketches = derived.sketches_for(shop_id)
+    totals = derived.events.totals(product_id=product_id, shop_id=shop_id)
+    counts = totals["counts"]
 
-    views = sum(1 for e in events if e.get("type") == "view")
-    tryons = sum(1 for e in events if e.get("type") == "tryon")
-    conversions = sum(1 for e in events if e.get("type") == "conversion")
-    revenue = sum(e.get("revenue", 0) or 0 for e in events)
-    time_saved_total = sum(e.get("time_saved_minutes", 0) or 0 for e in events)
+    views = counts.get("view", 0)
+    tryons = counts.get("tryon", 0)
+    conversions = counts.get("conversion", 0)
+    revenue = totals["revenue"]
+    time_saved_total = totals["time_saved_minutes"]
 
     # Simple heuristics for demo purposes
     estimated_revenue_lift = revenue * 0.2  # assume 20% attributable
@@ -91,7 +300,7 @@ def metrics_summary(product_id: Optional[str] = None):
     avg_time_saved = (time_saved_total / tryons) if tryons else 0
 
     # build last 3 months summary from stored monthlySummaries if present
-    monthly_summaries = store.get("monthly_summaries") or []
+    monthly_summaries = list(_get_shards().global_shard().iter("monthly_summaries"))
 
     roi_statement = f"Estimated incremental revenue: ${estimated_revenue_lift:.0f} — conversion uplift {conversion_rate_impact:.2f}%"
 
@@ -101,321 +310,309 @@ def metrics_summary(product_id: Optional[str] = None):
         "timeSavedMinutes": round(avg_time_saved, 1),
         "monthlyAiSummary": monthly_summaries[-3:],
         "roiStatement": roi_statement,
-        "raw": {"views": views, "tryons": tryons, "conversions": conversions, "revenue": revenue}
+        "raw": {"views": views, "tryons": tryons, "conversions": conversions, "revenue": revenue},
+        "approximate": {"scope": shop_id or "all", **(sketches.summary() if sketches else {})},
     }
 
+@app.get("/metrics/funnel")
+def metrics_funnel(shop_id: Optional[str] = None, top_n: int = 50):
+    """Live view -> try-on -> conversion funnel per product, joined by session/visitor id."""
+    return _ensure_derived().funnel.report(shop_id, top_n)
+
+
+@app.post("/metrics/funnel/replay")
+def metrics_funnel_replay(shop_id: Optional[str] = None, window_seconds: float = DEFAULT_WINDOW_SECONDS, top_n: int = 50):
+    """Recompute the funnel from stored events, e.g. with a different attribution window."""
+    if window_seconds <= 0:
+        raise HTTPException(status_code=422, detail="window_seconds must be positive")
+    return replay_funnel(_get_shards().iter_by_time("events", shop_id), window_seconds, shop_id).report(shop_id, top_n)
+
+
+@app.get("/metrics/timeseries")
+def metrics_timeseries(
+    bucket: str = "1d",
+    shop_id: Optional[str] = None,
+    product_id: Optional[str] = None,
+    type: Optional[str] = None,
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+    max_points: int = DEFAULT_MAX_POINTS,
+):
+    """Event counts, revenue and time saved per bucket, served from ingest-time rollups.
+    Adjacent buckets are merged when the range would return more than `max_points` points.
+    """
+    if bucket not in BUCKET_SECONDS:
+        raise HTTPException(status_code=422, detail=f"bucket must be one of {sorted(BUCKET_SECONDS)}")
+    if not 1 <= max_points <= 5000:
+        raise HTTPException(status_code=422, detail="max_points must be between 1 and 5000")
+    end = to.timestamp() if to else datetime.utcnow().timestamp()
+    default_span = 7 if bucket == "1h" else 90
+    start = from_.timestamp() if from_ else end - default_span * 24 * 3600
+    if start >= end:
+        raise HTTPException(status_code=422, detail="from must be before to")
+    return _ensure_derived().rollups.query(
+        bucket, start, end, shop_id=shop_id, product_id=product_id, event_type=type, max_points=max_points
+    )
+
+
+@app.get("/metrics/export")
+def export_metrics(
+    kind: str = "events",
+    format: str = "parquet",
+    shop_id: Optional[str] = None,
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+):
+    """Stream stored events, ratings or edits as a Parquet or Arrow IPC file, filtered by shop and time range."""
+    if kind not in metrics_export.KINDS:
+        raise HTTPException(status_code=422, detail=f"kind must be one of {list(metrics_export.KINDS)}")
+    if format not in metrics_export.FORMATS:
+        raise HTTPException(status_code=422, detail=f"format must be one of {sorted(metrics_export.FORMATS)}")
+    if metrics_export.pa is None:
+        raise HTTPException(status_code=501, detail="Columnar export requires pyarrow")
+    chunks = metrics_export.stream_export(
+        kind,
+        iter_records(kind, shop_id),
+        format,
+        shop_id=shop_id,
+        start=from_.timestamp() if from_ else None,
+        end=to.timestamp() if to else None,
+    )
+    media_type = "application/vnd.apache.parquet" if format == "parquet" else "application/vnd.apache.arrow.stream"
+    filename = f"{kind}{metrics_export.FORMATS[format]}"
+    return StreamingResponse(chunks, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
 @app.post("/metrics/monthly_summary")
 def add_monthly_summary(summary: MonthlySummary):
-    store = load_store()
-    store.setdefault("monthly_summaries", []).append(summary.dict())
-    save_store(store)
+    _append("monthly_summaries", summary.dict())
     return {"status": "ok"}
 
 
-def simple_text_embedding(text: str, dim: int = 64) -> List[float]:
+def simple_text_embedding(text: str, dim: int = DEFAULT_DIM) -> List[float]:
     """Deterministic lightweight embedding based on hashing tokens.
     This is a fast, dependency-free placeholder for a production embedding model.
+    Use `batch_text_embeddings` when embedding more than one text.
     """
-    if not text:
-        return [0.0] * dim
-    tokens = text.lower().split()
-    vec = [0.0] * dim
-    for i, t in enumerate(tokens):
-        h = hashlib.md5(t.encode('utf-8')).digest()
-        # convert first 8 bytes into an integer then into a float
-        val = int.from_bytes(h[:8], 'little', signed=False)
-        idx = val % dim
-        vec[idx] += (val % 1000) / 1000.0
-    # normalize
-    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
-    return [x / norm for x in vec]
+    return batch_text_embeddings([text], dim)[0].tolist()
+
+
+def _store_style_embeddings(shop_id: str, profile: dict, embeddings) -> None:
+    """Persist the embedding matrix as a sidecar and keep only a reference in the profile."""
+    save_embeddings(EMBEDDINGS_DIR, shop_id, embeddings)
+    _similarity.update(shop_id, embeddings)
+    profile.pop("style_embeddings", None)
+    profile["style_embeddings_count"] = int(embeddings.shape[0])
+    profile["style_embeddings_dim"] = int(embeddings.shape[1])
+    if embeddings.shape[0]:
+        profile["store_style_embedding"] = embeddings.mean(axis=0).tolist()
+
+
+def load_style_embeddings(shop_id: str):
+    """Return the memory-mapped per-product embedding matrix for a shop, or None."""
+    return load_embeddings(EMBEDDINGS_DIR, shop_id)
 
 
 @app.post("/merchant/{shop_id}/profile")
 def upsert_merchant_profile(shop_id: str, profile: MerchantProfile):
-    store = load_store()
-    profiles = store.setdefault("merchant_profiles", {})
-    profiles[shop_id] = profile.dict()
-    save_store(store)
-    return {"status": "ok", "profile": profiles[shop_id]}
+    data = profile.dict()
+    embeddings = data.pop("style_embeddings", None)
+    if embeddings:
+        _store_style_embeddings(shop_id, data, np.asarray(embeddings, dtype=np.float32))
+    _profiles.put(shop_id, data)
+    return {"status": "ok", "profile": data}
 
 
 @app.get("/merchant/{shop_id}/profile")
 def get_merchant_profile(shop_id: str):
-    store = load_store()
-    profiles = store.get("merchant_profiles", {})
-    p = profiles.get(shop_id)
+    p = _profiles.get(shop_id)
     if not p:
         raise HTTPException(status_code=404, detail="Profile not found")
     return p
 
 
 @app.post("/merchant/{shop_id}/compute_embeddings")
-def compute_and_store_embeddings(shop_id: str, descriptions: List[str]):
+def compute_and_store_embeddings(shop_id: str, descriptions: List[str], dim: int = DEFAULT_DIM):
     """Compute per-product embeddings and a store-wide style embedding (average).
-    Stores results in the merchant profile under `style_embeddings` and `store_style_embedding`.
+    Per-product embeddings are written to a memory-mappable `.npy` sidecar; the merchant
+    profile keeps `store_style_embedding` plus the sidecar's shape.
     """
-    store = load_store()
-    profiles = store.setdefault("merchant_profiles", {})
-    profile = profiles.get(shop_id, {})
-    embeddings = [simple_text_embedding(d) for d in descriptions]
-    # store as lists
-    profile["style_embeddings"] = embeddings
-    # average embedding
-    if embeddings:
-        dim = len(embeddings[0])
-        avg = [0.0] * dim
-        for e in embeddings:
-            for i in range(dim):
-                avg[i] += e[i]
-        avg = [x / len(embeddings) for x in avg]
-        profile["store_style_embedding"] = avg
-    profiles[shop_id] = profile
-    save_store(store)
-    return {"status": "ok", "count": len(embeddings)}
+    if dim <= 0:
+        raise HTTPException(status_code=422, detail="dim must be positive")
+    embeddings = batch_text_embeddings(descriptions, dim)
+    _profiles.update(shop_id, lambda profile: _store_style_embeddings(shop_id, profile, embeddings))
+    return {"status": "ok", "count": len(descriptions)}
+
+
+@app.get("/merchant/{shop_id}/similar")
+def similar_products(shop_id: str, text: str, k: int = 10):
+    """Return the `k` stored product embeddings most similar (cosine) to `text`.
+    Results reference positions in the last `compute_embeddings` payload.
+    """
+    if k <= 0:
+        raise HTTPException(status_code=422, detail="k must be positive")
+    index = _similarity.get(shop_id, load_style_embeddings)
+    if index is None or len(index) == 0:
+        raise HTTPException(status_code=404, detail="No embeddings for shop")
+    query = batch_text_embeddings([text], index.dim)[0]
+    results = index.search(query, k)
+    return {
+        "shop_id": shop_id,
+        "approximate": index.approximate,
+        "results": [{"index": i, "score": round(score, 4)} for i, score in results],
+    }
 
 
 @app.post("/metrics/rate_output")
 def rate_output(rec: RatingRecord):
-    store = load_store()
-    store.setdefault("ratings", []).append(rec.dict())
+    _ensure_derived()
+    entry = rec.dict()
+    _store_and_index("ratings", entry)
+
     # update merchant profile aggregate
-    profiles = store.setdefault("merchant_profiles", {})
-    profile = profiles.get(rec.shop_id, {})
-    ratings = profile.get("ratings", {})
-    key = rec.output_type
-    stat = ratings.get(key, {"count": 0, "sum": 0})
-    stat["count"] = stat.get("count", 0) + 1
-    stat["sum"] = stat.get("sum", 0) + rec.rating
-    stat["avg"] = stat["sum"] / stat["count"]
-    ratings[key] = stat
-    profile["ratings"] = ratings
-    profiles[rec.shop_id] = profile
-    save_store(store)
-    return {"status": "ok", "ratings": ratings}
+    def apply(profile: dict) -> None:
+        ratings = profile.setdefault("ratings", {})
+        stat = ratings.get(rec.output_type, {"count": 0, "sum": 0})
+        stat["count"] = stat.get("count", 0) + 1
+        stat["sum"] = stat.get("sum", 0) + rec.rating
+        stat["avg"] = stat["sum"] / stat["count"]
+        ratings[rec.output_type] = stat
+
+    profile = _profiles.update(rec.shop_id, apply)
+    return {"status": "ok", "ratings": profile["ratings"]}
 
 
 @app.post("/metrics/record_edit")
 def record_edit(rec: EditRecord):
-    store = load_store()
+    _ensure_derived()
     entry = rec.dict()
     entry["timestamp"] = str(rec.timestamp or datetime.utcnow())
-    store.setdefault("edits", []).append(entry)
+    _store_and_index("edits", entry)
+
     # reinforcement: update merchant profile learning_adjustments if enabled
-    profiles = store.setdefault("merchant_profiles", {})
-    profile = profiles.get(rec.shop_id, {})
-    settings = profile.get("settings", {}) or {}
-    improve = settings.get("improve_future_outputs", False)
-    if improve:
+    profiles = _profiles
+    settings = (profiles.get(rec.shop_id) or {}).get("settings", {}) or {}
+    if settings.get("improve_future_outputs", False):
         # simple token-diff heuristic: tokens in edited text but not in original get +1, removed tokens get -1
         orig_tokens = set((rec.original or "").lower().split())
         edited_tokens = set((rec.edited or "").lower().split())
         adds = edited_tokens - orig_tokens
         removes = orig_tokens - edited_tokens
-        adjustments = profile.get("learning_adjustments", {}) or {}
-        for t in adds:
-            adjustments[t] = adjustments.get(t, 0) + 1
-        for t in removes:
-            adjustments[t] = adjustments.get(t, 0) - 0.5
-        profile["learning_adjustments"] = adjustments
-        profiles[rec.shop_id] = profile
-        save_store(store)
-
-    save_store(store)
+
+        def apply(profile: dict) -> None:
+            adjustments = profile.get("learning_adjustments", {}) or {}
+            for t in adds:
+                adjustments[t] = adjustments.get(t, 0) + 1
+            for t in removes:
+                adjustments[t] = adjustments.get(t, 0) - 0.5
+            profile["learning_adjustments"] = adjustments
+
+        profiles.update(rec.shop_id, apply)
+
     return {"status": "ok"}
 
 
 @app.get("/merchant/{shop_id}/settings")
 def get_merchant_settings(shop_id: str):
-    store = load_store()
-    profiles = store.get("merchant_profiles", {})
-    profile = profiles.get(shop_id, {})
+    profile = _profiles.get(shop_id) or {}
     settings = profile.get("settings", {"improve_future_outputs": False, "learning_adjustments": {}})
     return {"settings": settings, "learning_adjustments": profile.get("learning_adjustments", {})}
 
 
 @app.post("/merchant/{shop_id}/settings")
 def set_merchant_settings(shop_id: str, payload: dict):
-    store = load_store()
-    profiles = store.setdefault("merchant_profiles", {})
-    profile = profiles.get(shop_id, {})
-    settings = profile.get("settings", {}) or {}
-    settings.update(payload)
-    profile["settings"] = settings
-    profiles[shop_id] = profile
-    save_store(store)
-    return {"status": "ok", "settings": settings}
+    def apply(profile: dict) -> None:
+        settings = profile.get("settings", {}) or {}
+        settings.update(payload)
+        profile["settings"] = settings
+
+    profile = _profiles.update(shop_id, apply)
+    return {"status": "ok", "settings": profile["settings"]}
 
 
 @app.get("/merchant/{shop_id}/best_products")
 def best_products(shop_id: str, top_n: int = 5):
     """Return top-performing products for a shop based on revenue in recorded events.
-    Also generates simple 'best patterns' (most common token prefixes in product ids/titles).
+    Also returns simple 'best patterns' (most common token prefixes in product ids/titles).
+    Both are served from the ingest-time product revenue index; this endpoint does not write.
     """
-    store = load_store()
-    events = [e for e in store.get("events", []) if e.get("product_id")]
-    # filter by shop_id encoded in product_id as 'shopid:productid' if present
-    shop_events = [e for e in events if (str(e.get("product_id") or "")).startswith(f"{shop_id}:")]
-    revenue_by_product = {}
-    for e in shop_events:
-        pid = e.get("product_id")
-        revenue_by_product.setdefault(pid, 0.0)
-        revenue_by_product[pid] += float(e.get("revenue", 0) or 0)
-
-    sorted_products = sorted(revenue_by_product.items(), key=lambda x: x[1], reverse=True)[:top_n]
-
-    # simple pattern detection: token frequency in product ids
-    token_counts = {}
-    for pid in revenue_by_product.keys():
-        parts = pid.split(":")[-1].split("-")
-        for p in parts:
-            token_counts[p] = token_counts.get(p, 0) + 1
-    common_tokens = sorted(token_counts.items(), key=lambda x: x[1], reverse=True)[:10]
-
-    patterns = [{"token": t, "count": c} for t, c in common_tokens]
-
-    # persist patterns into merchant profile
-    profiles = store.setdefault("merchant_profiles", {})
-    profile = profiles.get(shop_id, {})
-    profile["best_patterns"] = patterns
-    profiles[shop_id] = profile
-    save_store(store)
-
-    return {"topProducts": [{"product_id": p, "revenue": r} for p, r in sorted_products], "patterns": patterns}
+    index = _ensure_derived().product_revenue
+    top = index.top_products(shop_id, top_n)
+    patterns = index.patterns(shop_id)
+    return {"topProducts": [{"product_id": p, "revenue": r} for p, r in top], "patterns": patterns}
 
 
-@app.get("/benchmarks/description_styles")
-def benchmark_description_styles(niche: Optional[str] = None, top_n: int = 5, recent_days: int = 90):
-    """Anonymous cross-store benchmarking for description styles.
-    Scans recorded edits and ratings across all shops and reports top-performing tokens/phrases.
-    """
-    store = load_store()
-    ratings = store.get("ratings", [])
-    edits = store.get("edits", [])
-    # collect scored tokens from ratings and edits within recent_days
+# Styles kept per description-styles snapshot; requests slice their `top_n` from it.
+SNAPSHOT_TOP_STYLES = 100
+
+
+def _snapshot_meta(age: float) -> Dict[str, Any]:
+    return {"computed_at": datetime.utcfromtimestamp(_snapshots.clock() - age).isoformat(), "age_seconds": round(age, 3)}
+
+
+def _description_styles_snapshot(niche: Optional[str], recent_days: int) -> Dict[str, Any]:
+    # niche filtering is best-effort only and currently not applied (demo)
     cutoff = datetime.utcnow().timestamp() - recent_days * 24 * 3600
-    token_scores = {}
-    token_counts = {}
-
-    def tokenize(text: str):
-        if not text:
-            return []
-        toks = [t.strip('.,!?:;').lower() for t in text.split() if len(t) > 2]
-        return toks
-
-    # use ratings to associate tokens with quality
-    for r in ratings:
-        try:
-            ts = datetime.fromisoformat(r.get("timestamp")).timestamp() if r.get("timestamp") else datetime.utcnow().timestamp()
-        except Exception:
-            ts = datetime.utcnow().timestamp()
-        if ts < cutoff:
-            continue
-        # if niche filter is provided, skip entries that don't match known niche tokens (best-effort)
-        product_id = r.get("product_id") or ""
-        if niche and niche.lower() not in product_id.lower() and niche.lower() not in (r.get("notes") or "").lower():
-            # still include — this is demo, do not strictly filter
-            pass
-        # gather tokens from notes
-        tokens = tokenize(r.get("notes") or "")
-        if not tokens:
-            continue
-        for t in tokens:
-            token_scores[t] = token_scores.get(t, 0.0) + (r.get("rating", 0) or 0)
-            token_counts[t] = token_counts.get(t, 0) + 1
-
-    # include edits (assume edited text contains good tokens merchants preferred)
-    for e in edits:
-        try:
-            ts = datetime.fromisoformat(e.get("timestamp")).timestamp() if e.get("timestamp") else datetime.utcnow().timestamp()
-        except Exception:
-            ts = datetime.utcnow().timestamp()
-        if ts < cutoff:
-            continue
-        edited = e.get("edited") or ""
-        tokens = tokenize(edited)
-        for t in tokens:
-            token_scores[t] = token_scores.get(t, 0.0) + 3.0  # small boost
-            token_counts[t] = token_counts.get(t, 0) + 1
-
-    # compute average score per token
-    token_avg = []
-    for t, s in token_scores.items():
-        cnt = max(1, token_counts.get(t, 1))
-        token_avg.append((t, s / cnt, cnt))
-
-    token_avg.sort(key=lambda x: x[1], reverse=True)
-    results = [{"token": t, "avg_score": round(avg, 2), "count": cnt} for t, avg, cnt in token_avg[:top_n]]
+    results = _ensure_derived().token_stats.top_styles(cutoff, SNAPSHOT_TOP_STYLES)
     return {"niche": niche or "all", "top_styles": results}
 
 
-@app.get("/benchmarks/industry_trends")
-def industry_trends(niche: Optional[str] = None, period_days: int = 90):
-    """Return simple trend signals across stores: rising tokens and high-level conversion stats.
-    This endpoint purposely anonymizes shop ids and returns aggregated stats.
+@app.get("/benchmarks/description_styles")
+def benchmark_description_styles(niche: Optional[str] = None, top_n: int = 5, recent_days: int = 90, refresh: bool = False):
+    """Anonymous cross-store benchmarking for description styles.
+    Reads the token-stats index built from recorded edits and ratings across all shops
+    and reports top-performing tokens/phrases. Served from a snapshot per niche and window
+    (at most `SNAPSHOT_TOP_STYLES` styles); `refresh=true` recomputes it first.
     """
-    store = load_store()
-    events = store.get("events", [])
-    edits = store.get("edits", [])
+    snapshot, age = _snapshots.get(
+        ("description_styles", niche, recent_days), lambda: _description_styles_snapshot(niche, recent_days), refresh
+    )
+    return {**snapshot, "top_styles": snapshot["top_styles"][:top_n], "snapshot": _snapshot_meta(age)}
+
+
+def _industry_trends_snapshot(niche: Optional[str], period_days: int) -> Dict[str, Any]:
     now = datetime.utcnow().timestamp()
     cutoff = now - period_days * 24 * 3600
 
-    # conversions and tryons per shop anonymized
-    conv_total = 0
-    tryon_total = 0
-    revenue_total = 0.0
-    for e in events:
-        try:
-            ts = datetime.fromisoformat(e.get("timestamp")).timestamp() if e.get("timestamp") else now
-        except Exception:
-            ts = now
-        if ts < cutoff:
-            continue
-        t = e.get("type")
-        if t == "conversion":
-            conv_total += 1
-        if t == "tryon":
-            tryon_total += 1
-        revenue_total += float(e.get("revenue", 0) or 0)
-
-    # rising tokens: compare last third vs first two-thirds
-    def collect_token_freq(entries):
-        freq = {}
-        for ent in entries:
-            txt = (ent.get("edited") or ent.get("notes") or "")
-            toks = [t.strip('.,!?:;').lower() for t in txt.split() if len(t) > 3]
-            for tk in toks:
-                freq[tk] = freq.get(tk, 0) + 1
-        return freq
-
-    # split edits into early and recent
-    edits_recent = []
-    edits_early = []
-    if edits:
-        # sort by timestamp
-        def ts_of(x):
-            try:
-                return datetime.fromisoformat(x.get("timestamp")).timestamp()
-            except Exception:
-                return 0
-        edits_sorted = sorted(edits, key=ts_of)
-        split = max(1, int(len(edits_sorted) * 2 / 3))
-        edits_early = edits_sorted[:split]
-        edits_recent = edits_sorted[split:]
-
-    freq_early = collect_token_freq(edits_early)
-    freq_recent = collect_token_freq(edits_recent)
-    rising = []
-    for tk, cnt in freq_recent.items():
-        prev = freq_early.get(tk, 0)
-        delta = cnt - prev
-        if delta > 0:
-            rising.append((tk, delta, cnt))
-    rising.sort(key=lambda x: x[1], reverse=True)
-    top_rising = [{"token": t, "increase": inc, "recent_count": c} for t, inc, c in rising[:20]]
+    # conversions and tryons across all shops (anonymized), from the in-memory event table
+    totals = _ensure_derived().events.totals(since=cutoff)
+    conv_total = totals["counts"].get("conversion", 0)
+    tryon_total = totals["counts"].get("tryon", 0)
+    revenue_total = totals["revenue"]
+
+    # rising tokens: decayed edit frequency over the short vs the long horizon covering the period
+    trends = _ensure_derived().trends
+    _, short_days, long_days = trends.pair_for(period_days)
+    top_rising = trends.rising(period_days, 20, now)
 
     # anonymized conversion rate estimate
     conv_rate = (conv_total / tryon_total * 100) if tryon_total else 0.0
 
-    return {"niche": niche or "fashion", "period_days": period_days, "conversions": conv_total, "tryons": tryon_total, "revenue": round(revenue_total,2), "conversion_rate_pct": round(conv_rate,2), "rising_tokens": top_rising}
+    # lifetime cross-store distributions from the ingest sketches (shop ids never exposed)
+    approx = _ensure_derived().sketches.summary()
+    approx.pop("heavyHitterProducts", None)
+
+    return {"niche": niche or "fashion", "period_days": period_days, "conversions": conv_total, "tryons": tryon_total, "revenue": round(revenue_total,2), "conversion_rate_pct": round(conv_rate,2), "rising_tokens": top_rising, "trend_window_days": {"short": short_days, "long": long_days}, "approximate": approx}
+
+
+@app.get("/benchmarks/industry_trends")
+def industry_trends(niche: Optional[str] = None, period_days: int = 90, refresh: bool = False):
+    """Return simple trend signals across stores: rising tokens and high-level conversion stats.
+    This endpoint purposely anonymizes shop ids and returns aggregated stats.
+    Served from a snapshot per niche and period; `refresh=true` recomputes it first.
+    """
+    snapshot, age = _snapshots.get(
+        ("industry_trends", niche, period_days), lambda: _industry_trends_snapshot(niche, period_days), refresh
+    )
+    return {**snapshot, "snapshot": _snapshot_meta(age)}
+
+
+@app.on_event("startup")
+def start_benchmark_scheduler() -> None:
+    """Keep materialized benchmark snapshots fresh in the background."""
+    _scheduler.start()
+
 
+@app.on_event("shutdown")
+def stop_benchmark_scheduler() -> None:
+    _scheduler.stop(timeout=5)
@@ -0,0 +1,174 @@
+"""Per-shop sharded storage for metrics events, ratings and edits.
+
+Every shop gets its own shard directory holding append-only JSON-lines
+segment files per record kind (`events-000000.jsonl`, ...). Appends take only
+that shard's lock, so one busy merchant no longer serializes every other
+merchant's writes on a single JSON document. Cross-shop reads stream the
+shards one after another; aggregate queries are answered from the columnar
+`EventTable` and sketches kept by `metrics_service`, not by scanning shards.
+"""
+import heapq
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .util import safe_name, to_timestamp
+
+# directory of the global shard; `safe_name` never produces it, so no shop can share it
+GLOBAL_SHARD = "~global"
+_LEGACY_GLOBAL_SHARD = "_global"
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+_MIGRATION_MARKER = ".migrated"
+
+# read position in a shard's segments of one kind: (segment number, byte offset)
+Position = Tuple[int, int]
+
+
+class Shard:
+    def __init__(self, base_dir: str, dirname: str):
+        self.name = dirname
+        self.dir = os.path.join(base_dir, dirname)
+        self.lock = threading.Lock()
+        self._segment: Dict[str, int] = {}
+
+    def _segments(self, kind: str) -> List[str]:
+        try:
+            names = os.listdir(self.dir)
+        except FileNotFoundError:
+            return []
+        prefix = f"{kind}-"
+        return sorted(os.path.join(self.dir, n) for n in names if n.startswith(prefix) and n.endswith(".jsonl"))
+
+    @staticmethod
+    def _segment_number(kind: str, path: str) -> int:
+        return int(os.path.basename(path)[len(kind) + 1:-6])
+
+    def _current_segment(self, kind: str) -> str:
+        n = self._segment.get(kind)
+        if n is None:
+            existing = self._segments(kind)
+            n = self._segment_number(kind, existing[-1]) if existing else 0
+        path = os.path.join(self.dir, f"{kind}-{n:06d}.jsonl")
+        if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_MAX_BYTES:
+            n += 1
+            path = os.path.join(self.dir, f"{kind}-{n:06d}.jsonl")
+        self._segment[kind] = n
+        return path
+
+    def append_many(self, kind: str, records: Iterable[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(r, default=str, separators=(",", ":")) + "\n" for r in records)
+        if not data:
+            return
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            with open(self._current_segment(kind), "a") as f:
+                f.write(data)
+
+    def append(self, kind: str, record: Dict[str, Any]) -> None:
+        self.append_many(kind, [record])
+
+    def iter(self, kind: str) -> Iterator[Dict[str, Any]]:
+        for record, _ in self.tail(kind):
+            yield record
+
+    def tail(self, kind: str, position: Optional[Position] = None) -> Iterator[Tuple[Dict[str, Any], Position]]:
+        """Yield complete records appended after `position` (from the start if None),
+        each with the position just past it, so a reader can resume where it stopped."""
+        start_segment, start_offset = position or (0, 0)
+        for path in self._segments(kind):
+            n = self._segment_number(kind, path)
+            if n < start_segment:
+                continue
+            with open(path, "rb") as f:
+                offset = start_offset if n == start_segment else 0
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        return  # partially written tail of a concurrent append
+                    offset += len(line)
+                    yield json.loads(line), (n, offset)
+
+
+class ShardedMetricsStore:
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        self._lock = threading.Lock()
+        self._shards: Dict[str, Shard] = {}
+        self._legacy_global_checked = False
+
+    def shard(self, shard_id: Optional[str]) -> Shard:
+        """The shard of a shop; `None` is the global shard for unscoped records."""
+        return self._shard_in(safe_name(shard_id)) if shard_id is not None else self.global_shard()
+
+    def global_shard(self) -> Shard:
+        if not self._legacy_global_checked:
+            # stores written before the global shard got a reserved name keep it in `_global`
+            legacy = os.path.join(self.base_dir, _LEGACY_GLOBAL_SHARD)
+            if os.path.isdir(legacy) and not os.path.exists(os.path.join(self.base_dir, GLOBAL_SHARD)):
+                try:
+                    os.rename(legacy, os.path.join(self.base_dir, GLOBAL_SHARD))
+                except OSError:
+                    pass  # another worker renamed it first
+            self._legacy_global_checked = True
+        return self._shard_in(GLOBAL_SHARD)
+
+    def _shard_in(self, dirname: str) -> Shard:
+        with self._lock:
+            shard = self._shards.get(dirname)
+            if shard is None:
+                shard = self._shards[dirname] = Shard(self.base_dir, dirname)
+            return shard
+
+    def shard_ids(self) -> List[str]:
+        """Directory names of the shards present on disk (shop ids mapped through `safe_name`,
+        plus `GLOBAL_SHARD`)."""
+        try:
+            names = os.listdir(self.base_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if os.path.isdir(os.path.join(self.base_dir, n)))
+
+    def iter(self, kind: str, shard_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        shards = [self.shard(shard_id)] if shard_id is not None else [self._shard_in(d) for d in self.shard_ids()]
+        for shard in shards:
+            yield from shard.iter(kind)
+
+    def iter_by_time(self, kind: str, shard_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Like `iter`, but k-way merges the shards by record timestamp with `heapq.merge`.
+        Each shard is still read lazily in append order, so memory holds one pending
+        record per shard instead of the whole history."""
+        shards = [self.shard(shard_id)] if shard_id is not None else [self._shard_in(d) for d in self.shard_ids()]
+        return heapq.merge(*(s.iter(kind) for s in shards),
+                           key=lambda r: to_timestamp(r.get("timestamp"), default=0.0))
+
+    def tail_by_time(self, kind: str, positions: Dict[str, Position],
+                     shards: Optional[List[Shard]] = None) -> Iterator[Tuple[Shard, Dict[str, Any], Position]]:
+        """Records appended to `shards` (default: all) after their `positions` (keyed by
+        shard name), merged by timestamp, each with its shard and the position past it."""
+        if shards is None:
+            shards = [self._shard_in(d) for d in self.shard_ids()]
+
+        def stream(shard: Shard) -> Iterator[Tuple[Shard, Dict[str, Any], Position]]:
+            for record, position in shard.tail(kind, positions.get(shard.name)):
+                yield shard, record, position
+
+        return heapq.merge(*(stream(s) for s in shards),
+                           key=lambda item: to_timestamp(item[1].get("timestamp"), default=0.0))
+
+    @property
+    def migrated(self) -> bool:
+        return os.path.exists(os.path.join(self.base_dir, _MIGRATION_MARKER))
+
+    def import_legacy(self, records: Dict[str, List[Dict[str, Any]]], shard_key: Callable[[str, Dict[str, Any]], Optional[str]]) -> None:
+        """Distribute records from the single-document store into shards and mark the store migrated.
+        `shard_key` returns a record's shop id, or None for the global shard."""
+        for kind, recs in records.items():
+            grouped: Dict[Optional[str], List[Dict[str, Any]]] = {}
+            for r in recs:
+                grouped.setdefault(shard_key(kind, r), []).append(r)
+            for sid, group in grouped.items():
+                self.shard(sid).append_many(kind, group)
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(os.path.join(self.base_dir, _MIGRATION_MARKER), "w") as f:
+            f.write("ok")
@@ -0,0 +1,59 @@
+"""Per-shop product revenue index maintained at event ingest.
+
+Product ids are scoped by shop as `shopid:productid`. Top products are a heap
+selection over one shop's products, and the derived token patterns are cached
+per shop until that shop's revenue or product set changes.
+"""
+import heapq
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def shop_of(product_id: Optional[str]) -> Optional[str]:
+    """Return the shop prefix of a namespaced product id, or None if it is not namespaced."""
+    if not product_id or ":" not in product_id:
+        return None
+    return product_id.split(":", 1)[0]
+
+
+class ProductRevenueIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._revenue: Dict[str, Dict[str, float]] = {}
+        self._versions: Dict[str, int] = {}
+        self._patterns: Dict[str, Tuple[int, List[Dict[str, Any]]]] = {}
+
+    def add(self, product_id: Optional[str], revenue: Optional[float]) -> None:
+        shop = shop_of(product_id)
+        if shop is None:
+            return
+        amount = float(revenue or 0)
+        with self._lock:
+            products = self._revenue.setdefault(shop, {})
+            is_new = product_id not in products
+            products[product_id] = products.get(product_id, 0.0) + amount
+            if is_new or amount:
+                self._versions[shop] = self._versions.get(shop, 0) + 1
+
+    def top_products(self, shop_id: str, top_n: int) -> List[Tuple[str, float]]:
+        with self._lock:
+            items = list(self._revenue.get(shop_id, {}).items())
+        return heapq.nlargest(top_n, items, key=lambda x: x[1])
+
+    def patterns(self, shop_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Most common `-`-separated tokens in the shop's product ids (cached per revenue version)."""
+        with self._lock:
+            version = self._versions.get(shop_id, 0)
+            cached = self._patterns.get(shop_id)
+            if cached and cached[0] == version:
+                return cached[1][:limit]
+            product_ids = list(self._revenue.get(shop_id, {}))
+        token_counts: Dict[str, int] = {}
+        for pid in product_ids:
+            for p in pid.split(":")[-1].split("-"):
+                token_counts[p] = token_counts.get(p, 0) + 1
+        common = sorted(token_counts.items(), key=lambda x: x[1], reverse=True)
+        patterns = [{"token": t, "count": c} for t, c in common]
+        with self._lock:
+            self._patterns[shop_id] = (version, patterns)
+        return patterns[:limit]
@@ -0,0 +1,139 @@
+"""Keyed merchant-profile store shared by the metrics and catalog services.
+
+Each shop's profile lives in its own small JSON file, so reading or updating a
+profile never touches the metrics event store. Reads go through an in-memory
+LRU cache that is revalidated against the file's mtime (other processes may
+write the same directory); writes are atomic and write-through.
+
+Profiles used to be kept in the metrics store's `merchant_profiles` map. The
+first access through any `ProfileStore` moves that map into the store, so every
+consumer (metrics or catalog) sees migrated profiles.
+"""
+import copy
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .storage import open_store
+from .util import safe_name
+
+DEFAULT_PROFILES_DIR = os.path.join(os.path.dirname(__file__), "merchant_profiles")
+DEFAULT_LEGACY_STORE = os.path.join(os.path.dirname(__file__), "metrics_store.json")
+_MIGRATION_MARKER = ".migrated"
+
+
+class ProfileStore:
+    def __init__(self, base_dir: Optional[str] = None, capacity: int = 1024, legacy_store: Optional[str] = None):
+        self.base_dir = base_dir or DEFAULT_PROFILES_DIR
+        self.capacity = capacity
+        # metrics store whose `merchant_profiles` are imported on first access
+        self.legacy_store = legacy_store or DEFAULT_LEGACY_STORE
+        self._cache: "OrderedDict[str, Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._shop_locks: Dict[str, threading.Lock] = {}
+        self._migration_lock = threading.Lock()
+        self._checked_migration = False
+
+    def _path(self, shop_id: str) -> str:
+        return os.path.join(self.base_dir, f"{safe_name(shop_id)}.json")
+
+    def _shop_lock(self, shop_id: str) -> threading.Lock:
+        with self._lock:
+            return self._shop_locks.setdefault(shop_id, threading.Lock())
+
+    def _remember(self, shop_id: str, mtime: int, profile: Dict[str, Any]) -> None:
+        with self._lock:
+            self._cache[shop_id] = (mtime, profile)
+            self._cache.move_to_end(shop_id)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def _read(self, shop_id: str) -> Optional[Dict[str, Any]]:
+        path = self._path(shop_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                self._cache.pop(shop_id, None)
+            return None
+        with self._lock:
+            cached = self._cache.get(shop_id)
+            if cached and cached[0] == mtime:
+                self._cache.move_to_end(shop_id)
+                return cached[1]
+        with open(path, "r") as f:
+            profile = json.load(f)
+        self._remember(shop_id, mtime, profile)
+        return profile
+
+    def get(self, shop_id: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the shop's profile, or None if it has none."""
+        self._ensure_migrated()
+        profile = self._read(shop_id)
+        return copy.deepcopy(profile) if profile is not None else None
+
+    def put(self, shop_id: str, profile: Dict[str, Any]) -> None:
+        self._ensure_migrated()
+        with self._shop_lock(shop_id):
+            self._write(shop_id, profile)
+
+    def update(self, shop_id: str, fn: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+        """Apply `fn` to a copy of the profile (empty if missing) under the shop's lock and persist it."""
+        self._ensure_migrated()
+        with self._shop_lock(shop_id):
+            profile = self.get(shop_id) or {}
+            fn(profile)
+            self._write(shop_id, profile)
+            return profile
+
+    def _write(self, shop_id: str, profile: Dict[str, Any]) -> None:
+        os.makedirs(self.base_dir, exist_ok=True)
+        path = self._path(shop_id)
+        fd, tmp = tempfile.mkstemp(dir=self.base_dir, suffix=".json.tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(profile, f, default=str, separators=(",", ":"))
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        stored = copy.deepcopy(profile)
+        self._remember(shop_id, os.stat(path).st_mtime_ns, stored)
+
+    @property
+    def migrated(self) -> bool:
+        return os.path.exists(os.path.join(self.base_dir, _MIGRATION_MARKER))
+
+    def _ensure_migrated(self) -> None:
+        """Move the legacy store's `merchant_profiles` into this store once."""
+        if self._checked_migration:
+            return
+        with self._migration_lock:
+            if not self._checked_migration:
+                if not self.migrated:
+                    store = open_store(self.legacy_store, "metrics")
+                    document = store.load()
+                    legacy = document.pop("merchant_profiles", None)
+                    self.import_legacy(legacy or {})
+                    if legacy is not None:
+                        store.save(document)
+                self._checked_migration = True
+
+    def import_legacy(self, profiles: Dict[str, Dict[str, Any]]) -> int:
+        """Import profiles from the legacy `merchant_profiles` map and mark the store migrated.
+        Profiles that already exist in this store are kept.
+        """
+        imported = 0
+        for shop_id, profile in profiles.items():
+            with self._shop_lock(shop_id):
+                if self._read(shop_id) is None:
+                    self._write(shop_id, profile)
+                    imported += 1
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(os.path.join(self.base_dir, _MIGRATION_MARKER), "w") as f:
+            f.write(str(imported))
+        return imported
@@ -0,0 +1,187 @@
+"""Hierarchical token buckets for per-shop, per-feature burst and quota control.
+
+Each (shop, feature) pair has one bucket per configured level (per second, per
+hour, per month). A bucket holds up to `limit` tokens and refills continuously
+at `limit / period`. A request for `cost` tokens succeeds only if every level
+can cover it, and then draws from all of them, so a shop can burst up to its
+per-second allowance without outrunning its hourly or monthly share.
+
+Buckets live in memory (one process's view; each worker limits on its own) and
+can be checkpointed to a JSON file so a restart does not hand out a fresh quota.
+Timestamps are wall-clock, so time spent down counts as refill.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# level name -> refill period in seconds
+LEVELS: Tuple[Tuple[str, float], ...] = (("second", 1.0), ("hour", 3600.0), ("month", 30 * 86400.0))
+_PERIODS = dict(LEVELS)
+DEFAULT_CHECKPOINT_SECONDS = 30.0
+
+
+class _Bucket:
+    __slots__ = ("limit", "rate", "tokens", "updated")
+
+    def __init__(self, limit: float, period: float, now: float):
+        self.limit = limit
+        self.rate = limit / period
+        self.tokens = limit
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def resize(self, limit: float, period: float) -> None:
+        self.limit = limit
+        self.rate = limit / period
+        self.tokens = min(self.tokens, limit)
+
+
+class RateLimited(Exception):
+    def __init__(self, level: str, retry_after: float):
+        super().__init__(f"{level} rate limit exceeded; retry after {retry_after:.3f}s")
+        self.level = level
+        self.retry_after = retry_after
+
+
+def limits_for(plan: Dict[str, Any], feature: Optional[str]) -> Dict[str, float]:
+    """Level limits for `feature` from a plan's `rate_limits` (falling back to its `"*"` entry)."""
+    rate_limits = plan.get("rate_limits") or {}
+    configured = rate_limits.get(feature) if feature in rate_limits else rate_limits.get("*")
+    return {level: float(v) for level, v in (configured or {}).items() if level in _PERIODS and v is not None}
+
+
+class HierarchicalLimiter:
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (shop_id, feature) -> level -> bucket
+        self._buckets: Dict[Tuple[str, str], Dict[str, _Bucket]] = {}
+
+    def acquire(self, shop_id: str, feature: Optional[str], cost: float, limits: Dict[str, float]) -> None:
+        """Take `cost` tokens from every configured level or raise `RateLimited` (taking none).
+
+        `limits` maps level names to their limit; levels missing from it are not enforced.
+        """
+        if not limits:
+            return
+        now = self.clock()
+        key = (shop_id, feature or "")
+        with self._lock:
+            buckets = self._buckets.setdefault(key, {})
+            blocked: Optional[Tuple[str, float]] = None
+            for level, limit in limits.items():
+                bucket = buckets.get(level)
+                if bucket is None:
+                    bucket = buckets[level] = _Bucket(limit, _PERIODS[level], now)
+                else:
+                    bucket.refill(now)
+                    if bucket.limit != limit:  # plan changed
+                        bucket.resize(limit, _PERIODS[level])
+                if bucket.tokens < cost:
+                    wait = (cost - bucket.tokens) / bucket.rate if cost <= bucket.limit else float("inf")
+                    if blocked is None or wait > blocked[1]:
+                        blocked = (level, wait)
+            if blocked is not None:
+                raise RateLimited(*blocked)
+            for level in limits:
+                buckets[level].tokens -= cost
+
+    def refund(self, shop_id: str, feature: Optional[str], cost: float, limits: Dict[str, float]) -> None:
+        """Return `cost` tokens taken by `acquire` for a request that was not carried out."""
+        if not limits:
+            return
+        now = self.clock()
+        with self._lock:
+            buckets = self._buckets.get((shop_id, feature or ""), {})
+            for level in limits:
+                bucket = buckets.get(level)
+                if bucket is not None:
+                    bucket.refill(now)
+                    bucket.tokens = min(bucket.limit, bucket.tokens + cost)
+
+    def remaining(self, shop_id: str, feature: Optional[str]) -> Dict[str, float]:
+        now = self.clock()
+        with self._lock:
+            buckets = self._buckets.get((shop_id, feature or ""), {})
+            for bucket in buckets.values():
+                bucket.refill(now)
+            return {level: round(b.tokens, 6) for level, b in buckets.items()}
+
+    # -- checkpoints ---------------------------------------------------------------
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"buckets": [[shop, feature, {level: [b.limit, b.tokens, b.updated] for level, b in levels.items()}]
+                                for (shop, feature), levels in self._buckets.items()]}
+
+    def checkpoint(self, path: str) -> None:
+        data = json.dumps(self.to_dict(), separators=(",", ":"))
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".limits-", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def restore(self, path: str) -> bool:
+        """Load buckets from a checkpoint; returns False if there is none."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        buckets: Dict[Tuple[str, str], Dict[str, _Bucket]] = {}
+        for shop, feature, levels in data.get("buckets", []):
+            restored = buckets[(shop, feature)] = {}
+            for level, (limit, tokens, updated) in levels.items():
+                if level in _PERIODS:
+                    bucket = restored[level] = _Bucket(limit, _PERIODS[level], updated)
+                    bucket.tokens = tokens
+        with self._lock:
+            self._buckets = buckets
+        return True
+
+
+class LimiterCheckpointer:
+    """Daemon thread checkpointing a limiter every `interval` seconds (and once on stop)."""
+
+    def __init__(self, limiter: HierarchicalLimiter, path: str, interval: float = DEFAULT_CHECKPOINT_SECONDS,
+                 on_error: Optional[Callable[[BaseException], None]] = None):
+        self.limiter = limiter
+        self.path = path
+        self.interval = interval
+        self.on_error = on_error
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rate-limit-checkpoints", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._checkpoint()
+
+    def _checkpoint(self) -> None:
+        try:
+            self.limiter.checkpoint(self.path)
+        except Exception as exc:
+            if self.on_error is not None:
+                self.on_error(exc)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._checkpoint()
@@ -0,0 +1,169 @@
+"""Per-shop nearest-neighbour search over style embeddings.
+
+`ExactIndex` scores every vector with a single BLAS matrix-vector product and is
+the default for small shops. `IVFIndex` clusters vectors with spherical k-means and
+only scores the `n_probe` closest clusters, which keeps large shops in the
+millisecond range at the cost of approximate recall.
+"""
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Shops with at least this many embeddings get an approximate index by default.
+APPROX_MIN_VECTORS = 50_000
+_ASSIGN_CHUNK = 16_384
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < scores.shape[0]:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(scores.shape[0])
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+class ExactIndex:
+    approximate = False
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = _normalize(vectors)
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        scores = self.vectors @ _normalize(query)
+        return [(int(i), float(scores[i])) for i in _top_k(scores, k)]
+
+
+class IVFIndex:
+    """Inverted-file index: vectors are bucketed by their nearest k-means centroid."""
+
+    approximate = True
+
+    def __init__(self, vectors: np.ndarray, n_lists: Optional[int] = None, n_probe: int = 8,
+                 train_iters: int = 10, seed: int = 0):
+        self.vectors = _normalize(vectors)
+        n = self.vectors.shape[0]
+        self.n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        self.n_probe = max(1, n_probe)
+        self.trained_size = n
+        self.centroids = self._train(train_iters, np.random.default_rng(seed))
+        self._build_lists()
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        out = np.empty(vectors.shape[0], dtype=np.int32)
+        for start in range(0, vectors.shape[0], _ASSIGN_CHUNK):
+            chunk = vectors[start:start + _ASSIGN_CHUNK]
+            out[start:start + chunk.shape[0]] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return out
+
+    def _train(self, iters: int, rng: np.random.Generator) -> np.ndarray:
+        n = self.vectors.shape[0]
+        sample_size = min(n, self.n_lists * 64)
+        sample = self.vectors[rng.choice(n, size=sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, size=self.n_lists, replace=False)].copy()
+        for _ in range(iters):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+        return centroids
+
+    def _build_lists(self) -> None:
+        labels = self._assign(self.vectors)
+        self.order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=self.n_lists)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def reassigned(self, vectors: np.ndarray) -> "IVFIndex":
+        """Return a copy over a recomputed matrix that reuses the trained centroids."""
+        clone = object.__new__(IVFIndex)
+        clone.__dict__.update(self.__dict__)
+        clone.vectors = _normalize(vectors)
+        clone._build_lists()
+        return clone
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        q = _normalize(query)
+        probe = _top_k(self.centroids @ q, self.n_probe)
+        candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+        if candidates.size == 0:
+            return []
+        scores = self.vectors[candidates] @ q
+        return [(int(candidates[i]), float(scores[i])) for i in _top_k(scores, k)]
+
+
+def build_index(vectors: np.ndarray, approximate: Optional[bool] = None):
+    if approximate is None:
+        approximate = vectors.shape[0] >= APPROX_MIN_VECTORS
+    if approximate and vectors.shape[0] > 0:
+        return IVFIndex(vectors)
+    return ExactIndex(vectors)
+
+
+class SimilarityRegistry:
+    """Keeps one index per shop in memory and refreshes it when embeddings change."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes: Dict[str, object] = {}
+
+    def get(self, shop_id: str, loader) -> Optional[object]:
+        with self._lock:
+            index = self._indexes.get(shop_id)
+        if index is not None:
+            return index
+        vectors = loader(shop_id)
+        if vectors is None:
+            return None
+        index = build_index(vectors)
+        with self._lock:
+            return self._indexes.setdefault(shop_id, index)
+
+    def update(self, shop_id: str, vectors: np.ndarray) -> None:
+        """Refresh a shop's index after its embeddings were recomputed.
+
+        An existing IVF index keeps its centroids and only reassigns vectors unless the
+        shop has more than doubled since training or the dimension changed.
+        """
+        with self._lock:
+            current = self._indexes.get(shop_id)
+        if (
+            isinstance(current, IVFIndex)
+            and vectors.shape[1] == current.dim
+            and vectors.shape[0] <= 2 * current.trained_size
+        ):
+            index = current.reassigned(vectors)
+        else:
+            index = build_index(vectors)
+        with self._lock:
+            self._indexes[shop_id] = index
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
@@ -0,0 +1,250 @@
+"""Bounded-memory streaming sketches for high-cardinality metrics.
+
+- `HyperLogLog` estimates distinct counts (unique products, visitors).
+- `TDigest` estimates quantiles of value distributions (revenue, time saved).
+- `HeavyHitters` pairs a Count-Min sketch with a small heap of candidates to
+  track the most frequent items (heavy-hitter products).
+
+Each sketch reports the error bound that goes with its estimate.
+"""
+import hashlib
+import heapq
+import math
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+_MASK64 = (1 << 64) - 1
+
+
+def _hash128(item: str) -> Tuple[int, int]:
+    digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = 12):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def add(self, item: str) -> None:
+        x = _hash128(item)[0]
+        idx = x >> (64 - self.p)
+        w = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - w.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def estimate(self) -> float:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(np.exp2(-self.registers.astype(np.float64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+        return raw
+
+    @property
+    def relative_error(self) -> float:
+        """Standard error of the estimate (about 1.04 / sqrt(m))."""
+        return 1.04 / math.sqrt(self.m)
+
+    def summary(self) -> Dict[str, Any]:
+        return {"estimate": round(self.estimate()), "relativeError": round(self.relative_error, 4)}
+
+
+class TDigest:
+    """Merging t-digest using the arcsine (k1) scale function."""
+
+    def __init__(self, compression: float = 100):
+        self.compression = compression
+        self._means: List[float] = []
+        self._weights: List[float] = []
+        self._buffer: List[Tuple[float, float]] = []
+        self.count = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float, weight: float = 1.0) -> None:
+        self._buffer.append((value, weight))
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _k_inv(self, k: float) -> float:
+        return (math.sin(min(k, self.compression / 4) * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self) -> None:
+        if not self._buffer:
+            return
+        points = sorted(list(zip(self._means, self._weights)) + self._buffer)
+        self._buffer = []
+        means: List[float] = []
+        weights: List[float] = []
+        q0 = 0.0
+        q_limit = self._k_inv(self._k(q0) + 1)
+        cur_m, cur_w = points[0]
+        for m, w in points[1:]:
+            if q0 + (cur_w + w) / self.count <= q_limit:
+                cur_m += (m - cur_m) * w / (cur_w + w)
+                cur_w += w
+            else:
+                means.append(cur_m)
+                weights.append(cur_w)
+                q0 += cur_w / self.count
+                q_limit = self._k_inv(self._k(q0) + 1)
+                cur_m, cur_w = m, w
+        means.append(cur_m)
+        weights.append(cur_w)
+        self._means, self._weights = means, weights
+
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+        if not self._means:
+            return None
+        target = q * self.count
+        cumulative = 0.0
+        prev_center, prev_mean = 0.0, self.min
+        for m, w in zip(self._means, self._weights):
+            center = cumulative + w / 2
+            if target <= center:
+                if center == prev_center:
+                    return m
+                return prev_mean + (m - prev_mean) * (target - prev_center) / (center - prev_center)
+            prev_center, prev_mean = center, m
+            cumulative += w
+        if self.count == prev_center:
+            return self.max
+        return prev_mean + (self.max - prev_mean) * (target - prev_center) / (self.count - prev_center)
+
+    def rank_error(self, q: float) -> float:
+        """Approximate bound on the rank error (as a fraction) of `quantile(q)`."""
+        return math.pi * math.sqrt(q * (1 - q)) / self.compression
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)) -> Dict[str, Any]:
+        if not self.count:
+            return {"count": 0}
+        out: Dict[str, Any] = {"count": int(self.count), "min": round(self.min, 2), "max": round(self.max, 2)}
+        for q in quantiles:
+            label = f"p{int(q * 100)}"
+            out[label] = round(self.quantile(q), 2)
+            out[f"{label}RankError"] = round(self.rank_error(q), 4)
+        return out
+
+
+class CountMinSketch:
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+        self._rows = np.arange(depth)
+
+    def _indexes(self, item: str) -> np.ndarray:
+        h1, h2 = _hash128(item)
+        return np.array([((h1 + i * h2) & _MASK64) % self.width for i in range(self.depth)])
+
+    def add(self, item: str, count: int = 1) -> int:
+        """Add `count` occurrences of `item` and return its updated estimate."""
+        idx = self._indexes(item)
+        self.table[self._rows, idx] += count
+        self.total += count
+        return int(self.table[self._rows, idx].min())
+
+    def estimate(self, item: str) -> int:
+        return int(self.table[self._rows, self._indexes(item)].min())
+
+    @property
+    def error_bound(self) -> float:
+        """Overestimate bound (e / width * total), holding with probability 1 - e^-depth."""
+        return math.e / self.width * self.total
+
+
+class HeavyHitters:
+    """Top-k frequent items: Count-Min estimates plus a min-heap of the current candidates."""
+
+    def __init__(self, k: int = 20, width: int = 2048, depth: int = 4):
+        self.k = k
+        self.cms = CountMinSketch(width, depth)
+        self._top: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []
+
+    def add(self, item: str, count: int = 1) -> None:
+        est = self.cms.add(item, count)
+        if item in self._top:
+            self._top[item] = est
+            heapq.heappush(self._heap, (est, item))
+        elif len(self._top) < self.k:
+            self._top[item] = est
+            heapq.heappush(self._heap, (est, item))
+        else:
+            floor = self._min_entry()
+            if floor is not None and est > floor[0]:
+                heapq.heappop(self._heap)
+                del self._top[floor[1]]
+                self._top[item] = est
+                heapq.heappush(self._heap, (est, item))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(c, i) for i, c in self._top.items()]
+            heapq.heapify(self._heap)
+
+    def _min_entry(self) -> Optional[Tuple[int, str]]:
+        # drop heap entries made stale by later updates of the same item
+        while self._heap and self._top.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def top(self, n: Optional[int] = None) -> List[Tuple[str, int]]:
+        return sorted(self._top.items(), key=lambda x: x[1], reverse=True)[: n or self.k]
+
+
+class MetricSketches:
+    """The sketches maintained per scope (all shops, or one shop) at event ingest."""
+
+    def __init__(self, hll_precision: int = 12, compression: float = 100, cms_width: int = 2048,
+                 cms_depth: int = 4, top_k: int = 20):
+        self._lock = threading.Lock()
+        self.unique_products = HyperLogLog(hll_precision)
+        self.unique_visitors = HyperLogLog(hll_precision)
+        self.revenue = TDigest(compression)
+        self.time_saved = TDigest(compression)
+        self.heavy_products = HeavyHitters(top_k, cms_width, cms_depth)
+
+    def add_event(self, event: Dict[str, Any]) -> None:
+        product_id = event.get("product_id")
+        visitor_id = event.get("visitor_id")
+        revenue = event.get("revenue")
+        time_saved = event.get("time_saved_minutes")
+        with self._lock:
+            if product_id:
+                self.unique_products.add(product_id)
+                self.heavy_products.add(product_id)
+            if visitor_id:
+                self.unique_visitors.add(visitor_id)
+            if revenue is not None:
+                self.revenue.add(float(revenue))
+            if time_saved is not None:
+                self.time_saved.add(float(time_saved))
+
+    def summary(self, top_n: int = 10) -> Dict[str, Any]:
+        with self._lock:
+            error = self.heavy_products.cms.error_bound
+            return {
+                "uniqueProducts": self.unique_products.summary(),
+                "uniqueVisitors": self.unique_visitors.summary(),
+                "revenue": self.revenue.summary(),
+                "timeSavedMinutes": self.time_saved.summary(),
+                "heavyHitterProducts": [
+                    {"product_id": pid, "events": count, "maxOverestimate": round(error, 1)}
+                    for pid, count in self.heavy_products.top(top_n)
+                ],
+            }
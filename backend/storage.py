@@ -0,0 +1,448 @@
+"""Document storage shared by the billing, catalog and metrics services.
+
+Each service keeps one document: top-level lists of records ("collections",
+such as catalog `items` or legacy billing `usage`) plus a few plain values
+(billing `accounts`, metrics `merchant_profiles`). Two engines implement the
+same interface:
+
+- `JSONStore` (default): the whole document in one JSON file, as before.
+- `SQLiteStore`: an embedded SQLite database in WAL mode. Records are rows with
+  indexed `shop_id`, `product_id`, `feature` and timestamp columns next to the
+  JSON body, so lookups by key and filtered or time-range queries use an index
+  instead of scanning the list; batches are written in one transaction.
+
+The engine is chosen with `DIGICLOSET_STORAGE_ENGINE=json|sqlite`. A SQLite
+database lives next to the JSON file (`<name>.sqlite3`) and imports the JSON
+document the first time it is opened; `python -m backend.storage migrate`
+does the same import explicitly and reports what was copied.
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional
+
+from .util import to_timestamp
+
+ENGINE_ENV = "DIGICLOSET_STORAGE_ENGINE"
+ENGINES = ("json", "sqlite")
+
+# per service: collections (record lists) with their key field, if records have one,
+# and the document returned when nothing is stored yet
+SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "billing": {
+        "collections": {"usage": None},
+        "defaults": {"accounts": {}, "usage": []},
+    },
+    "catalog": {
+        "collections": {"items": "id", "jobs": "job_id", "deliveries": "delivery_id", "events": None},
+        "defaults": {"jobs": [], "items": []},
+    },
+    "metrics": {
+        "collections": {"events": None, "ratings": None, "edits": None, "monthly_summaries": None},
+        "defaults": {"events": []},
+    },
+}
+
+
+def _epoch(value: Any) -> Optional[float]:
+    """Epoch seconds of a stored timestamp (datetime, ISO string or number), None if unparseable."""
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    ts = to_timestamp(value, default=math.nan) if value is not None else math.nan
+    return None if ts != ts else ts
+
+
+def _matches(record: Dict[str, Any], ts: Optional[float], shop_id, product_id, product_prefix, feature, since, until) -> bool:
+    if shop_id is not None and record.get("shop_id") != shop_id:
+        return False
+    if product_id is not None and record.get("product_id") != product_id:
+        return False
+    if product_prefix is not None and not str(record.get("product_id") or "").startswith(product_prefix):
+        return False
+    if feature is not None and record.get("feature") != feature:
+        return False
+    if since is not None and (ts is None or ts < since):
+        return False
+    if until is not None and (ts is None or ts >= until):
+        return False
+    return True
+
+
+class DocumentStore(ABC):
+    """Interface shared by the storage engines.
+
+    `load`/`save` read and replace the whole document. The record-level methods
+    work on one collection: `get`/`get_many` look records up by the collection's
+    key field, `find` filters (and optionally orders by timestamp), `put`/`put_many`
+    upsert by key (records without a key are appended). `put_batch` upserts into
+    several collections in a single write.
+    """
+
+    def __init__(self, path: str, collections: Dict[str, Optional[str]], defaults: Dict[str, Any]):
+        self.path = path
+        self.collections = collections
+        self.defaults = defaults
+
+    def _key_field(self, collection: str) -> Optional[str]:
+        if collection not in self.collections:
+            raise KeyError(f"unknown collection {collection!r}")
+        return self.collections[collection]
+
+    @abstractmethod
+    def load(self) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def save(self, document: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def version(self) -> Hashable:
+        """Changes whenever the stored document changes (for caches of derived values)."""
+
+    def get(self, collection: str, key: str) -> Optional[Dict[str, Any]]:
+        return self.get_many(collection, [key]).get(key)
+
+    @abstractmethod
+    def get_many(self, collection: str, keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def find(self, collection: str, shop_id: Optional[str] = None, product_id: Optional[str] = None,
+             product_prefix: Optional[str] = None, feature: Optional[str] = None,
+             since: Any = None, until: Any = None, limit: Optional[int] = None,
+             newest_first: bool = False) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def count(self, collection: str) -> int:
+        ...
+
+    def put(self, collection: str, record: Dict[str, Any]) -> None:
+        self.put_batch({collection: [record]})
+
+    def put_many(self, collection: str, records: List[Dict[str, Any]]) -> None:
+        self.put_batch({collection: records})
+
+    @abstractmethod
+    def put_batch(self, updates: Dict[str, List[Dict[str, Any]]]) -> None:
+        """Upsert records into several collections (collection -> records) in one write."""
+
+    def close(self) -> None:
+        pass
+
+
+class JSONStore(DocumentStore):
+    """The whole document in one JSON file; record operations load and rewrite it."""
+
+    def __init__(self, path: str, collections: Dict[str, Optional[str]], defaults: Dict[str, Any]):
+        super().__init__(path, collections, defaults)
+        self._lock = threading.RLock()
+
+    def load(self) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return copy.deepcopy(self.defaults)
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def save(self, document: Dict[str, Any]) -> None:
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".store-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(document, f, default=str)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def version(self) -> Hashable:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return (self.path, None, None)
+        return (self.path, st.st_mtime_ns, st.st_size)
+
+    def get_many(self, collection: str, keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        field = self._key_field(collection)
+        wanted = set(keys)
+        return {r.get(field): r for r in self.load().get(collection, []) if field and r.get(field) in wanted}
+
+    def find(self, collection: str, shop_id: Optional[str] = None, product_id: Optional[str] = None,
+             product_prefix: Optional[str] = None, feature: Optional[str] = None,
+             since: Any = None, until: Any = None, limit: Optional[int] = None,
+             newest_first: bool = False) -> List[Dict[str, Any]]:
+        self._key_field(collection)
+        since, until = _epoch(since) if since is not None else None, _epoch(until) if until is not None else None
+        rows = []
+        for i, record in enumerate(self.load().get(collection, [])):
+            ts = _epoch(record.get("timestamp"))
+            if _matches(record, ts, shop_id, product_id, product_prefix, feature, since, until):
+                rows.append((ts, i, record))
+        if newest_first:
+            rows.sort(key=lambda r: (r[0] is not None, r[0] or 0.0, r[1]), reverse=True)
+        records = [r[2] for r in rows]
+        return records[:limit] if limit is not None else records
+
+    def count(self, collection: str) -> int:
+        self._key_field(collection)
+        return len(self.load().get(collection, []))
+
+    def put_batch(self, updates: Dict[str, List[Dict[str, Any]]]) -> None:
+        fields = {collection: self._key_field(collection) for collection in updates}
+        with self._lock:
+            document = self.load()
+            for collection, records in updates.items():
+                field = fields[collection]
+                existing = document.setdefault(collection, [])
+                positions = {r.get(field): i for i, r in enumerate(existing) if field and r.get(field) is not None}
+                for record in records:
+                    key = record.get(field) if field else None
+                    if key is not None and key in positions:
+                        existing[positions[key]] = record
+                    else:
+                        if key is not None:
+                            positions[key] = len(existing)
+                        existing.append(record)
+            self.save(document)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    key TEXT,
+    shop_id TEXT,
+    product_id TEXT,
+    feature TEXT,
+    ts REAL,
+    data TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS records_key ON records (collection, key) WHERE key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS records_shop ON records (collection, shop_id, ts);
+CREATE INDEX IF NOT EXISTS records_product ON records (collection, product_id, ts);
+CREATE INDEX IF NOT EXISTS records_feature ON records (collection, feature, ts);
+CREATE INDEX IF NOT EXISTS records_ts ON records (collection, ts);
+CREATE TABLE IF NOT EXISTS doc_values (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('version', 0);
+"""
+
+# statements are constant strings so each connection's statement cache prepares them once
+_UPSERT = """
+INSERT INTO records (collection, key, shop_id, product_id, feature, ts, data) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (collection, key) WHERE key IS NOT NULL DO UPDATE SET
+    shop_id = excluded.shop_id, product_id = excluded.product_id, feature = excluded.feature,
+    ts = excluded.ts, data = excluded.data
+"""
+_BUMP_VERSION = "UPDATE meta SET value = value + 1 WHERE name = 'version'"
+
+
+class SQLiteStore(DocumentStore):
+    """Records as indexed rows in an embedded SQLite database (WAL mode, one connection per thread)."""
+
+    def __init__(self, path: str, collections: Dict[str, Optional[str]], defaults: Dict[str, Any],
+                 busy_timeout: float = 5.0):
+        super().__init__(path, collections, defaults)
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _row(self, collection: str, field: Optional[str], record: Dict[str, Any]):
+        key = record.get(field) if field else None
+        return (collection, None if key is None else str(key), record.get("shop_id"), record.get("product_id"),
+                record.get("feature"), _epoch(record.get("timestamp")), json.dumps(record, default=str))
+
+    @property
+    def is_empty(self) -> bool:
+        conn = self._conn()
+        return (conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0] == 0)
+
+    def load(self) -> Dict[str, Any]:
+        conn = self._conn()
+        document = copy.deepcopy(self.defaults)
+        for name, data in conn.execute("SELECT name, data FROM doc_values"):
+            document[name] = json.loads(data)
+        for collection in self.collections:
+            rows = conn.execute("SELECT data FROM records WHERE collection = ? ORDER BY id", (collection,)).fetchall()
+            if rows or collection in document:
+                document[collection] = [json.loads(r[0]) for r in rows]
+        return document
+
+    def save(self, document: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM records")
+            conn.execute("DELETE FROM doc_values")
+            for name, value in document.items():
+                if name in self.collections and isinstance(value, list):
+                    field = self.collections[name]
+                    conn.executemany(_UPSERT, (self._row(name, field, r) for r in value))
+                else:
+                    conn.execute("INSERT INTO doc_values (name, data) VALUES (?, ?)",
+                                 (name, json.dumps(value, default=str)))
+            conn.execute(_BUMP_VERSION)
+
+    def version(self) -> Hashable:
+        return (self.path, self._conn().execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0])
+
+    def get_many(self, collection: str, keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        if self._key_field(collection) is None:
+            return {}
+        conn = self._conn()
+        found = {}
+        for key in keys:
+            row = conn.execute("SELECT data FROM records WHERE collection = ? AND key = ?", (collection, str(key))).fetchone()
+            if row is not None:
+                found[key] = json.loads(row[0])
+        return found
+
+    def find(self, collection: str, shop_id: Optional[str] = None, product_id: Optional[str] = None,
+             product_prefix: Optional[str] = None, feature: Optional[str] = None,
+             since: Any = None, until: Any = None, limit: Optional[int] = None,
+             newest_first: bool = False) -> List[Dict[str, Any]]:
+        self._key_field(collection)
+        clauses, params = ["collection = ?"], [collection]
+        for column, value in (("shop_id", shop_id), ("product_id", product_id), ("feature", feature)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if product_prefix is not None:
+            # a range on the indexed column rather than LIKE, which cannot use the index
+            clauses.append("product_id >= ? AND product_id < ?")
+            params += [product_prefix, product_prefix + "\uffff"]
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(_epoch(since))
+        if until is not None:
+            clauses.append("ts < ?")
+            params.append(_epoch(until))
+        order = "ts IS NOT NULL DESC, ts DESC, id DESC" if newest_first else "id"
+        sql = f"SELECT data FROM records WHERE {' AND '.join(clauses)} ORDER BY {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return [json.loads(r[0]) for r in self._conn().execute(sql, params)]
+
+    def count(self, collection: str) -> int:
+        self._key_field(collection)
+        return self._conn().execute("SELECT COUNT(*) FROM records WHERE collection = ?", (collection,)).fetchone()[0]
+
+    def put_batch(self, updates: Dict[str, List[Dict[str, Any]]]) -> None:
+        fields = {collection: self._key_field(collection) for collection in updates}
+        with self._transaction() as conn:
+            for collection, records in updates.items():
+                conn.executemany(_UPSERT, (self._row(collection, fields[collection], r) for r in records))
+            conn.execute(_BUMP_VERSION)
+
+    def explain(self, sql: str, params: Iterable[Any] = ()) -> List[str]:
+        """Query plan details, to check which index a query uses."""
+        return [row[-1] for row in self._conn().execute("EXPLAIN QUERY PLAN " + sql, tuple(params))]
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def sqlite_path(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + ".sqlite3"
+
+
+def migrate(json_path: str, service: str, db_path: Optional[str] = None) -> Dict[str, int]:
+    """Import a JSON store into a SQLite store in one transaction; returns record counts
+    per collection (plus `values` for the plain document values)."""
+    schema = SCHEMAS[service]
+    source = JSONStore(json_path, schema["collections"], schema["defaults"])
+    target = SQLiteStore(db_path or sqlite_path(json_path), schema["collections"], schema["defaults"])
+    try:
+        document = source.load()
+        target.save(document)
+        counts = {c: target.count(c) for c in schema["collections"]}
+        counts["values"] = sum(1 for name in document if name not in schema["collections"])
+        return counts
+    finally:
+        target.close()
+
+
+_stores: Dict[Any, DocumentStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(json_path: str, service: str, engine: Optional[str] = None) -> DocumentStore:
+    """The store for `service` at `json_path`, using `engine` (default: `DIGICLOSET_STORAGE_ENGINE`).
+
+    Stores are cached per path and engine. A new SQLite database is seeded from the
+    JSON file if there is one.
+    """
+    engine = engine or os.getenv(ENGINE_ENV, "json")
+    if engine not in ENGINES:
+        raise ValueError(f"unknown storage engine {engine!r}; expected one of {', '.join(ENGINES)}")
+    cache_key = (engine, os.path.abspath(json_path), service)
+    with _stores_lock:
+        store = _stores.get(cache_key)
+        if store is None:
+            schema = SCHEMAS[service]
+            if engine == "json":
+                store = JSONStore(json_path, schema["collections"], schema["defaults"])
+            else:
+                store = SQLiteStore(sqlite_path(json_path), schema["collections"], schema["defaults"])
+                if store.is_empty and os.path.exists(json_path):
+                    store.save(JSONStore(json_path, schema["collections"], schema["defaults"]).load())
+            _stores[cache_key] = store
+        return store
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Service document storage maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mig = sub.add_parser("migrate", help="import a JSON store into SQLite")
+    mig.add_argument("service", choices=sorted(SCHEMAS))
+    mig.add_argument("json_path")
+    mig.add_argument("--db", default=None, help="target database (default: next to the JSON file)")
+    args = parser.parse_args(argv)
+    if args.command == "migrate":
+        counts = migrate(args.json_path, args.service, args.db)
+        summary = ", ".join(f"{n} {name}" for name, n in counts.items())
+        print(f"migrated {args.json_path} -> {args.db or sqlite_path(args.json_path)}: {summary}")
+
+
+if __name__ == "__main__":
+    main()
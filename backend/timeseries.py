@@ -0,0 +1,133 @@
+"""Pre-bucketed event rollups for time-series charts.
+
+Every ingested event is added to hourly and daily buckets for each scope it
+belongs to (all shops, its shop, its product), both per event type and across
+types. Queries slice the requested range out of the sorted bucket keys and
+merge adjacent buckets when the range would exceed `max_points`. Responses
+covering only closed buckets are cached until a late event lands in that
+series.
+"""
+import bisect
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from .product_index import shop_of
+from .util import to_timestamp
+
+BUCKET_SECONDS = {"1h": 3600, "1d": 86400}
+DEFAULT_MAX_POINTS = 500
+_CACHE_SIZE = 256
+
+SeriesKey = Tuple[str, str, str]  # (bucket, scope, type)
+
+
+class _Series:
+    __slots__ = ("starts", "values", "late_version")
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.values: Dict[int, List[float]] = {}  # start -> [count, revenue, time_saved]
+        self.late_version = 0
+
+
+class RollupIndex:
+    def __init__(self, max_cache: int = _CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._series: Dict[SeriesKey, _Series] = {}
+        self._cache: "OrderedDict[tuple, Tuple[int, List[Dict[str, Any]]]]" = OrderedDict()
+        self._max_cache = max_cache
+
+    @staticmethod
+    def _scopes(product_id: Optional[str]) -> List[str]:
+        scopes = ["*"]
+        if product_id:
+            scopes.append(f"product:{product_id}")
+            shop = shop_of(product_id)
+            if shop is not None:
+                scopes.append(f"shop:{shop}")
+        return scopes
+
+    def add_event(self, event: Dict[str, Any], now: Optional[float] = None) -> None:
+        ts = to_timestamp(event.get("timestamp"))
+        now = datetime.utcnow().timestamp() if now is None else now
+        revenue = float(event.get("revenue") or 0)
+        time_saved = float(event.get("time_saved_minutes") or 0)
+        types = ("*", event.get("type") or "unknown")
+        with self._lock:
+            for bucket, width in BUCKET_SECONDS.items():
+                start = int(ts // width) * width
+                late = start + width <= int(now // width) * width
+                for scope in self._scopes(event.get("product_id")):
+                    for etype in types:
+                        series = self._series.get((bucket, scope, etype))
+                        if series is None:
+                            series = self._series[(bucket, scope, etype)] = _Series()
+                        vals = series.values.get(start)
+                        if vals is None:
+                            vals = series.values[start] = [0, 0.0, 0.0]
+                            if not series.starts or start > series.starts[-1]:
+                                series.starts.append(start)
+                            else:
+                                bisect.insort(series.starts, start)
+                        vals[0] += 1
+                        vals[1] += revenue
+                        vals[2] += time_saved
+                        if late:
+                            series.late_version += 1
+
+    def query(self, bucket: str, start: float, end: float, shop_id: Optional[str] = None,
+              product_id: Optional[str] = None, event_type: Optional[str] = None,
+              max_points: int = DEFAULT_MAX_POINTS, now: Optional[float] = None) -> Dict[str, Any]:
+        """Return dense, zero-filled points for `[start, end)` at `bucket` or a coarser multiple of it."""
+        width = BUCKET_SECONDS[bucket]
+        scope = f"product:{product_id}" if product_id else (f"shop:{shop_id}" if shop_id else "*")
+        key = (bucket, scope, event_type or "*")
+        first = int(start // width) * width
+        last = int(math.ceil(end / width)) * width
+        slots = max(0, (last - first) // width)
+        factor = max(1, math.ceil(slots / max(1, max_points)))
+        step = width * factor
+        now = datetime.utcnow().timestamp() if now is None else now
+        closed = last <= int(now // width) * width
+        cache_key = (key, first, last, factor)
+
+        with self._lock:
+            series = self._series.get(key)
+            late_version = series.late_version if series else 0
+            if closed:
+                cached = self._cache.get(cache_key)
+                if cached and cached[0] == late_version:
+                    self._cache.move_to_end(cache_key)
+                    return self._response(bucket, step, cached[1], cached=True)
+            n_points = math.ceil((last - first) / step) if last > first else 0
+            points = [[0, 0.0, 0.0] for _ in range(n_points)]
+            if series is not None:
+                lo = bisect.bisect_left(series.starts, first)
+                hi = bisect.bisect_left(series.starts, last)
+                for s in series.starts[lo:hi]:
+                    vals = series.values[s]
+                    p = points[(s - first) // step]
+                    p[0] += vals[0]
+                    p[1] += vals[1]
+                    p[2] += vals[2]
+            result = [
+                {
+                    "t": datetime.fromtimestamp(first + i * step, tz=timezone.utc).isoformat(),
+                    "count": int(c),
+                    "revenue": round(r, 2),
+                    "time_saved_minutes": round(m, 1),
+                }
+                for i, (c, r, m) in enumerate(points)
+            ]
+            if closed:
+                self._cache[cache_key] = (late_version, result)
+                if len(self._cache) > self._max_cache:
+                    self._cache.popitem(last=False)
+        return self._response(bucket, step, result, cached=False)
+
+    @staticmethod
+    def _response(bucket: str, step: int, points: List[Dict[str, Any]], cached: bool) -> Dict[str, Any]:
+        return {"bucket": bucket, "resolution_seconds": step, "cached": cached, "points": points}
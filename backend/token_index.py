@@ -0,0 +1,167 @@
+"""Inverted token statistics for description-style benchmarks.
+
+Ratings and edits are tokenized once, when they are recorded, into per-token
+per-day buckets. Benchmark queries then only walk the vocabulary instead of
+re-tokenizing the full rating and edit history. Rising-token trends are kept
+as exponentially decayed counters with a small candidate set, so reading them
+does not depend on the vocabulary size at all.
+"""
+import math
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .util import to_timestamp
+
+DAY_SECONDS = 24 * 3600
+# Score credited to every token of a merchant-edited text (edits signal preferred wording).
+EDIT_TOKEN_SCORE = 3.0
+# Decay time constants for trend counters; a query uses an adjacent (short, long) pair.
+TREND_TIME_CONSTANTS_DAYS = (1, 7, 30, 90, 365)
+# Forward-decay weights grow as exp(age / tau); rebase the landmark before they overflow.
+_RENORMALIZE_EXPONENT = 50.0
+
+
+def tokenize(text: Optional[str], min_len: int) -> List[str]:
+    if not text:
+        return []
+    return [t.strip('.,!?:;').lower() for t in text.split() if len(t) > min_len]
+
+
+class TokenStatsIndex:
+    """Per-token score sums/counts and edit frequencies, bucketed by UTC day."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # token -> day -> [score_sum, count]
+        self._scores: Dict[str, Dict[int, List[float]]] = {}
+
+    def _add_scores(self, tokens: List[str], score: float, day: int) -> None:
+        for t in tokens:
+            bucket = self._scores.setdefault(t, {}).setdefault(day, [0.0, 0])
+            bucket[0] += score
+            bucket[1] += 1
+
+    def add_rating(self, notes: Optional[str], rating: Optional[float], timestamp: Any = None) -> None:
+        tokens = tokenize(notes, 2)
+        if not tokens:
+            return
+        day = int(to_timestamp(timestamp, default=time.time()) // DAY_SECONDS)
+        with self._lock:
+            self._add_scores(tokens, float(rating or 0), day)
+
+    def add_edit(self, edited: Optional[str], timestamp: Any = None) -> None:
+        day = int(to_timestamp(timestamp, default=time.time()) // DAY_SECONDS)
+        with self._lock:
+            self._add_scores(tokenize(edited, 2), EDIT_TOKEN_SCORE, day)
+
+    def top_styles(self, since: float, top_n: int) -> List[Dict[str, Any]]:
+        """Highest average-score tokens among ratings/edits recorded on or after `since`."""
+        first_day = int(since // DAY_SECONDS)
+        token_avg = []
+        with self._lock:
+            for t, days in self._scores.items():
+                total = 0.0
+                cnt = 0
+                for day, (s, c) in days.items():
+                    if day >= first_day:
+                        total += s
+                        cnt += c
+                if cnt:
+                    token_avg.append((t, total / cnt, cnt))
+        token_avg.sort(key=lambda x: x[1], reverse=True)
+        return [{"token": t, "avg_score": round(avg, 2), "count": cnt} for t, avg, cnt in token_avg[:top_n]]
+
+
+class DecayedTokenTrends:
+    """Exponentially decayed edit-token frequencies at several time constants.
+
+    Counters use forward decay: an occurrence at time `t` adds `exp((t - L) / tau)`
+    for a landmark `L`, so updates never touch other tokens and decayed values are
+    computed only when read. A token is rising when its short-horizon count exceeds
+    what its long-horizon rate predicts. For each (short, long) pair a bounded
+    candidate set keeps the tokens with the highest trend score at their last update;
+    queries rescore only those candidates, so results are approximate top-K.
+    """
+
+    def __init__(self, time_constants_days=TREND_TIME_CONSTANTS_DAYS, top_k: int = 20,
+                 candidates_factor: int = 4, min_recent: float = 0.5, min_score: float = 1.25):
+        self.taus = [float(d) * DAY_SECONDS for d in sorted(time_constants_days)]
+        if len(self.taus) < 2:
+            raise ValueError("at least two time constants are required")
+        self.capacity = top_k * candidates_factor
+        self.min_recent = min_recent
+        # ratios just above 1 are noise from discrete arrivals of steady tokens
+        self.min_score = min_score
+        self._lock = threading.Lock()
+        self._landmark: Optional[float] = None
+        # token -> forward-decayed count per time constant
+        self._counts: Dict[str, List[float]] = {}
+        # one candidate map (token -> score at last update) per adjacent (short, long) pair
+        self._candidates: List[Dict[str, float]] = [{} for _ in self.taus[1:]]
+
+    def _renormalize(self, landmark: float) -> None:
+        factors = [math.exp((self._landmark - landmark) / tau) for tau in self.taus]
+        for counts in self._counts.values():
+            for i, f in enumerate(factors):
+                counts[i] *= f
+        self._landmark = landmark
+
+    def _score(self, counts: List[float], pair: int, now: float):
+        short_tau, long_tau = self.taus[pair], self.taus[pair + 1]
+        recent = counts[pair] * math.exp((self._landmark - now) / short_tau)
+        baseline = counts[pair + 1] * math.exp((self._landmark - now) / long_tau)
+        # count expected over the short horizon at the long-horizon rate, smoothed so
+        # that one-off tokens do not outrank steadily growing ones
+        expected = baseline * short_tau / long_tau
+        return (recent + 1.0) / (expected + 1.0), recent
+
+    def add(self, text: Optional[str], timestamp: Any = None) -> None:
+        tokens = tokenize(text, 3)
+        if not tokens:
+            return
+        ts = to_timestamp(timestamp, default=time.time())
+        with self._lock:
+            if self._landmark is None:
+                self._landmark = ts
+            elif (ts - self._landmark) / self.taus[0] > _RENORMALIZE_EXPONENT:
+                self._renormalize(ts)
+            weights = [math.exp((ts - self._landmark) / tau) for tau in self.taus]
+            for t in tokens:
+                counts = self._counts.get(t)
+                if counts is None:
+                    counts = self._counts[t] = [0.0] * len(self.taus)
+                for i, w in enumerate(weights):
+                    counts[i] += w
+            for t in set(tokens):
+                counts = self._counts[t]
+                for pair, candidates in enumerate(self._candidates):
+                    candidates[t] = self._score(counts, pair, ts)[0]
+                    if len(candidates) > self.capacity:
+                        del candidates[min(candidates, key=candidates.get)]
+
+    def pair_for(self, period_days: float):
+        """(short, long) time constants in days for a trend period: the long constant is the
+        smallest one covering the period, the short one its predecessor."""
+        pair = len(self.taus) - 2
+        for i in range(1, len(self.taus)):
+            if self.taus[i] >= period_days * DAY_SECONDS:
+                pair = i - 1
+                break
+        return pair, self.taus[pair] / DAY_SECONDS, self.taus[pair + 1] / DAY_SECONDS
+
+    def rising(self, period_days: float = 90, limit: int = 20, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Tokens whose recent edit frequency is above their longer-term rate, highest ratio first."""
+        now = datetime.utcnow().timestamp() if now is None else now
+        pair = self.pair_for(period_days)[0]
+        rising = []
+        with self._lock:
+            if self._landmark is None:
+                return []
+            for t in self._candidates[pair]:
+                score, recent = self._score(self._counts[t], pair, now)
+                if score >= self.min_score and recent >= self.min_recent:
+                    rising.append((t, score, recent))
+        rising.sort(key=lambda x: x[1], reverse=True)
+        return [{"token": t, "score": round(score, 3), "recent_count": round(recent, 2)} for t, score, recent in rising[:limit]]
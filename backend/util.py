@@ -0,0 +1,37 @@
+"""Small helpers shared across the backend services: filesystem-safe names for
+shop ids and tolerant timestamp parsing."""
+import hashlib
+import re
+import time
+from datetime import datetime
+from typing import Any, Optional
+
+_PLAIN_NAME = re.compile(r"[A-Za-z0-9._-]{1,100}")
+
+
+def safe_name(shop_id: str) -> str:
+    """Filesystem name for a shop (or shard) id that stays inside its directory.
+
+    Plain ids (`[A-Za-z0-9._-]`, at most 100 chars, not `.` or `..`) are used as-is.
+    Anything else is sanitized and suffixed with `~` and a hash of the original id;
+    `~` never occurs in plain ids, so distinct ids never share a name.
+    """
+    if _PLAIN_NAME.fullmatch(shop_id) and shop_id not in (".", ".."):
+        return shop_id
+    digest = hashlib.sha1(shop_id.encode("utf-8")).hexdigest()[:12]
+    return f"{re.sub(r'[^A-Za-z0-9_-]', '_', shop_id)[:64]}~{digest}"
+
+
+def to_timestamp(value: Any, default: Optional[float] = None) -> float:
+    """Best-effort conversion of a stored timestamp (datetime or ISO string) to epoch seconds.
+    Missing or unparseable values become `default`, or the current time if it is None."""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value:
+        try:
+            return datetime.fromisoformat(str(value)).timestamp()
+        except ValueError:
+            pass
+    return time.time() if default is None else default
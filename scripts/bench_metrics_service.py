@@ -0,0 +1,237 @@
+"""Load benchmark for the metrics service.
+
+Seeds a synthetic, skewed history (Zipf-distributed shops and products,
+ratings and edits alongside events) directly into the sharded metrics
+store, then drives the FastAPI app in-process and reports per-endpoint
+latency percentiles, throughput and peak RSS as JSON.
+
+Usage:
+  python scripts/bench_metrics_service.py --sizes 10000,100000,1000000 --out bench.json
+
+Peak RSS is process-wide and only grows, so run one size per invocation for
+isolated memory figures. Requires `httpx` (for FastAPI's TestClient) and numpy.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend import metrics_service  # noqa: E402
+from backend.benchmark_snapshots import SnapshotStore  # noqa: E402
+from backend.metrics_shards import ShardedMetricsStore  # noqa: E402
+from backend.profile_store import ProfileStore  # noqa: E402
+from backend.similarity_index import SimilarityRegistry  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+EVENT_TYPES = np.array(["view", "tryon", "conversion", "revenue"])
+EVENT_TYPE_WEIGHTS = [0.70, 0.20, 0.06, 0.04]
+WORDS = (
+    "linen cotton relaxed oversized classic slim breathable organic soft cropped vintage tailored silk "
+    "denim summer winter layered minimal bold floral striped knit cozy premium lightweight sustainable"
+).split()
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _zipf_ids(rng: np.random.Generator, n: int, cardinality: int, a: float) -> np.ndarray:
+    return (rng.zipf(a, n) - 1) % cardinality
+
+
+class SyntheticHistory:
+    """Deterministic generator of shops, products, events, ratings and edits."""
+
+    def __init__(self, events: int, shops: int, products_per_shop: int, days: int = 180, seed: int = 7):
+        self.events = events
+        self.shops = shops
+        self.products_per_shop = products_per_shop
+        self.days = days
+        self.rng = np.random.default_rng(seed)
+        self.end = datetime.utcnow().replace(microsecond=0)
+
+    def _timestamps(self, n: int) -> List[str]:
+        # more recent days are busier
+        offsets = self.rng.power(2.0, n) * self.days * 86400
+        return [(self.end - timedelta(seconds=float(self.days * 86400 - o))).isoformat() for o in offsets]
+
+    def _products(self, n: int):
+        shops = _zipf_ids(self.rng, n, self.shops, 1.3)
+        products = _zipf_ids(self.rng, n, self.products_per_shop, 1.1)
+        return shops, products
+
+    def iter_events(self, chunk: int = 50_000):
+        for start in range(0, self.events, chunk):
+            n = min(chunk, self.events - start)
+            shops, products = self._products(n)
+            types = self.rng.choice(EVENT_TYPES, n, p=EVENT_TYPE_WEIGHTS)
+            revenue = np.round(self.rng.lognormal(3.5, 0.8, n), 2)
+            visitors = self.rng.integers(0, max(1, self.events // 5), n)
+            for i, ts in enumerate(self._timestamps(n)):
+                etype = str(types[i])
+                yield {
+                    "timestamp": ts,
+                    "type": etype,
+                    "revenue": float(revenue[i]) if etype in ("conversion", "revenue") else None,
+                    "time_saved_minutes": 2.0 if etype == "tryon" else None,
+                    "product_id": f"shop{shops[i]}:p{products[i]}",
+                    "visitor_id": f"v{visitors[i]}",
+                    "session_id": f"s{visitors[i]}-{ts[:10]}",
+                    "idempotency_key": None,
+                }
+
+    def _text(self, k: int) -> str:
+        return " ".join(self.rng.choice(WORDS, k))
+
+    def iter_ratings(self, n: int):
+        shops, products = self._products(n)
+        for i, ts in enumerate(self._timestamps(n)):
+            yield {
+                "shop_id": f"shop{shops[i]}", "product_id": f"shop{shops[i]}:p{products[i]}",
+                "output_type": "description", "rating": int(self.rng.integers(1, 6)),
+                "notes": self._text(3), "timestamp": ts,
+            }
+
+    def iter_edits(self, n: int):
+        shops, products = self._products(n)
+        for i, ts in enumerate(self._timestamps(n)):
+            yield {
+                "shop_id": f"shop{shops[i]}", "product_id": f"shop{shops[i]}:p{products[i]}",
+                "field": "description", "original": self._text(6), "edited": self._text(6),
+                "time_saved_minutes": 3.0, "timestamp": ts,
+            }
+
+
+def seed_store(shards: ShardedMetricsStore, history: SyntheticHistory, ratings: int, edits: int) -> None:
+    """Write records straight into shard segments, bypassing the HTTP layer."""
+    for kind, records in (("events", history.iter_events()), ("ratings", history.iter_ratings(ratings)),
+                          ("edits", history.iter_edits(edits))):
+        batch: Dict[str, List[Dict[str, Any]]] = {}
+        for i, rec in enumerate(records, 1):
+            batch.setdefault(metrics_service._shard_key(kind, rec), []).append(rec)
+            if i % 50_000 == 0:
+                for sid, recs in batch.items():
+                    shards.shard(sid).append_many(kind, recs)
+                batch = {}
+        for sid, recs in batch.items():
+            shards.shard(sid).append_many(kind, recs)
+
+
+def reset_service(base_dir: str) -> ShardedMetricsStore:
+    """Point the service module at a fresh data directory, as a new process would see it."""
+    shards = ShardedMetricsStore(os.path.join(base_dir, "metrics_shards"))
+    metrics_service.STORE_PATH = os.path.join(base_dir, "metrics_store.json")
+    metrics_service.EMBEDDINGS_DIR = os.path.join(base_dir, "embeddings")
+    metrics_service._shards = shards
+    metrics_service._profiles = ProfileStore(os.path.join(base_dir, "merchant_profiles"))
+    metrics_service._similarity = SimilarityRegistry()
+    metrics_service._snapshots = SnapshotStore()
+    metrics_service._derived = metrics_service._DerivedState()
+    return shards
+
+
+def measure(name: str, call: Callable[[int], Any], requests: int) -> Dict[str, Any]:
+    latencies = np.empty(requests)
+    started = time.perf_counter()
+    for i in range(requests):
+        t0 = time.perf_counter()
+        resp = call(i)
+        latencies[i] = time.perf_counter() - t0
+        if resp.status_code != 200:
+            raise RuntimeError(f"{name}: HTTP {resp.status_code} {resp.text[:200]}")
+    elapsed = time.perf_counter() - started
+    return {
+        "endpoint": name,
+        "requests": requests,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3),
+        "throughput_rps": round(requests / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_size(events: int, args) -> Dict[str, Any]:
+    shops = max(10, events // 1000)
+    with tempfile.TemporaryDirectory(prefix="bench-metrics-") as base_dir:
+        shards = reset_service(base_dir)
+        history = SyntheticHistory(events, shops, args.products_per_shop, seed=args.seed)
+        t0 = time.perf_counter()
+        seed_store(shards, history, ratings=max(100, events // 20), edits=max(100, events // 20))
+        seed_seconds = time.perf_counter() - t0
+        # the first request rebuilds the in-memory indexes from the shards
+        t0 = time.perf_counter()
+        metrics_service._ensure_derived()
+        rebuild_seconds = time.perf_counter() - t0
+
+        client = TestClient(metrics_service.app)
+        now = datetime.utcnow().isoformat()
+        n, scans = args.requests, args.scan_requests
+        results = [
+            measure("POST /metrics/record", lambda i: client.post("/metrics/record", json={
+                "timestamp": now, "type": "view", "product_id": f"shop{i % shops}:p{i % 50}",
+                "visitor_id": f"bench-{i}", "idempotency_key": f"bench-{events}-{i}"}), n),
+            measure("GET /metrics/summary", lambda i: client.get("/metrics/summary"), scans),
+            measure("GET /metrics/summary?product_id", lambda i: client.get(
+                "/metrics/summary", params={"product_id": "shop0:p0"}), scans),
+            measure("GET /merchant/{shop_id}/best_products", lambda i: client.get(
+                f"/merchant/shop{i % shops}/best_products"), n),
+            measure("GET /benchmarks/description_styles (refresh)", lambda i: client.get(
+                "/benchmarks/description_styles", params={"refresh": True}), scans),
+            measure("GET /benchmarks/description_styles", lambda i: client.get("/benchmarks/description_styles"), n),
+            measure("GET /benchmarks/industry_trends (refresh)", lambda i: client.get(
+                "/benchmarks/industry_trends", params={"refresh": True}), scans),
+            measure("GET /benchmarks/industry_trends", lambda i: client.get("/benchmarks/industry_trends"), n),
+        ]
+        return {
+            "events": events,
+            "shops": shops,
+            "seed_seconds": round(seed_seconds, 2),
+            "index_rebuild_seconds": round(rebuild_seconds, 2),
+            "peak_rss_mb": peak_rss_mb(),
+            "endpoints": results,
+        }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark metrics service endpoints against synthetic history")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated event counts")
+    parser.add_argument("--requests", type=int, default=200, help="requests per cheap endpoint")
+    parser.add_argument("--scan-requests", type=int, default=5, help="requests per endpoint that scans history")
+    parser.add_argument("--products-per-shop", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {
+        "generated_at": datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "runs": [run_size(int(s), args) for s in args.sizes.split(",") if s],
+    }
+    data = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
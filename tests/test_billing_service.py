@@ -0,0 +1,361 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import billing_service, credit_ledger
+from backend.credit_ledger import CreditLedger, InsufficientCredits
+from backend.invoices import InvoiceJob, invoice_path
+from backend.rate_limits import HierarchicalLimiter, RateLimited
+
+
+@pytest.fixture
+def billing_client(tmp_path, monkeypatch):
+    monkeypatch.setattr(billing_service, "STORE_PATH", str(tmp_path / "billing_store.json"))
+    monkeypatch.setattr(billing_service, "_ledger", CreditLedger(str(tmp_path / "billing_ledger")))
+    monkeypatch.setattr(billing_service, "_limiter", HierarchicalLimiter())
+    return TestClient(billing_service.app)
+
+
+def _set_plan(limits):
+    store = billing_service.load_store()
+    store.setdefault("accounts", {})["s1"] = {"credits": 1000.0, "plan": {"name": "pro", "limits": limits}, "hourly_rate": 60.0}
+    billing_service.save_store(store)
+
+
+def test_feature_limits_use_monthly_counters(billing_client):
+    _set_plan({"descriptions": 10})
+    usage = {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 4, "timestamp": "2026-03-05T10:00:00"}
+    assert billing_client.post("/billing/usage", json=usage).status_code == 200
+    assert billing_client.post("/billing/usage", json={**usage, "timestamp": "2026-03-20T10:00:00"}).status_code == 200
+    # a new month starts from zero
+    assert billing_client.post("/billing/usage", json={**usage, "timestamp": "2026-04-01T00:00:00"}).status_code == 200
+    resp = billing_client.post("/billing/usage", json={**usage, "timestamp": "2026-03-28T10:00:00"})
+    assert resp.status_code == 402
+
+    ledger = billing_service._ledger
+    assert ledger.usage_total("s1", "descriptions", "2026-03") == 12.0
+    assert ledger.usage_total("s1", "descriptions", "2026-04") == 4.0
+    assert billing_client.get("/billing/credits", params={"shop_id": "s1"}).json()["credits"] == 988.0
+
+
+def test_legacy_store_is_imported_and_counters_rebuilt(billing_client, capsys):
+    store = {"accounts": {"s1": {"credits": 50.0, "plan": {"name": "free", "limits": {}}}}, "usage": [
+        {"shop_id": "s1", "type": "ai_credit", "feature": "titles", "amount": 2, "timestamp": "2026-01-03 09:00:00"},
+        {"shop_id": "s1", "type": "ai_credit", "feature": "titles", "amount": 3, "timestamp": "2026-01-30 09:00:00"},
+        {"shop_id": "s2", "type": "ai_credit", "feature": "titles", "amount": 1, "timestamp": "not a date"},
+        {"shop_id": "s1", "type": "ai_credit_charge", "amount": 9, "timestamp": "2026-01-04 09:00:00"},
+    ]}
+    billing_service.save_store(store)
+
+    assert billing_client.get("/billing/credits", params={"shop_id": "s1"}).json()["credits"] == 50.0
+    assert len(billing_client.get("/billing/usage").json()["usage"]) == 4
+    legacy = billing_service.load_store()
+    assert "usage" not in legacy and "credits" not in legacy["accounts"]["s1"]
+
+    billing_service.main(["rebuild-counters"])
+    assert "1 shops" in capsys.readouterr().out
+    assert billing_service._ledger.usage_total("s1", "titles", "2026-01") == 5.0
+
+
+def test_charges_are_journaled_and_reject_overdraft(billing_client):
+    assert billing_client.post("/billing/charge", json={"shop_id": "s1", "amount": 400}).json()["credits"] == 600.0
+    assert billing_client.post("/billing/charge", json={"shop_id": "s1", "amount": 700}).status_code == 402
+    usage = billing_client.get("/billing/usage", params={"shop_id": "s1"}).json()["usage"]
+    assert [u["type"] for u in usage] == ["ai_credit_charge"]
+
+    # a new worker process sees the same balance from the journal
+    reopened = CreditLedger(billing_service._ledger.base_dir)
+    assert reopened.balance("s1") == 600.0
+
+
+def test_concurrent_charges_from_two_workers_never_lose_deductions(tmp_path):
+    workers = [CreditLedger(str(tmp_path / "ledger"), snapshot_every=25) for _ in range(2)]
+    rejected = []
+
+    def charge(ledger):
+        for _ in range(40):
+            try:
+                ledger.submit("s1", "charge", -10.0, require_funds=True)
+            except InsufficientCredits:
+                rejected.append(1)
+
+    threads = [threading.Thread(target=charge, args=(w,)) for w in workers for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # 240 attempts of 10 against 1000 credits: exactly 100 succeed
+    assert len(rejected) == 140
+    assert all(w.balance("s1") == 0.0 for w in workers)
+    assert sum(w.commits for w in workers) <= 100
+    # checkpoints rolled the journal; a fresh reader replays only the snapshot and live segment
+    segments = sorted(n for n in os.listdir(tmp_path / "ledger") if n.startswith("journal-"))
+    assert len(segments) >= 2
+    assert CreditLedger(str(tmp_path / "ledger")).balance("s1") == 0.0
+
+
+def test_torn_journal_tail_is_dropped(tmp_path):
+    ledger = CreditLedger(str(tmp_path / "ledger"))
+    ledger.submit("s1", "grant", 5.0)
+    with open(tmp_path / "ledger" / "journal-000001.jsonl", "a") as f:
+        f.write('{"seq": 2, "shop_id": "s1", "delta": -999')
+    fresh = CreditLedger(str(tmp_path / "ledger"))
+    assert fresh.submit("s1", "charge", -1.0)["balance"] == 1004.0
+    with open(tmp_path / "ledger" / "journal-000001.jsonl") as f:
+        assert [json.loads(line)["seq"] for line in f] == [1, 2]
+
+
+def test_failed_checkpoint_does_not_fail_committed_charges(tmp_path, monkeypatch):
+    ledger = CreditLedger(str(tmp_path / "ledger"), snapshot_every=1)
+
+    def broken_snapshot():
+        raise OSError("disk full")
+    monkeypatch.setattr(ledger, "_write_snapshot", broken_snapshot)
+    assert ledger.submit("s1", "charge", -1.0)["balance"] == 999.0
+    assert ledger.submit("s1", "charge", -1.0)["balance"] == 998.0
+    monkeypatch.undo()
+    assert CreditLedger(str(tmp_path / "ledger")).balance("s1") == 998.0
+
+
+def test_reservation_commit_refunds_unused_credits(billing_client):
+    res = billing_client.post("/billing/reserve", json={"shop_id": "s1", "amount": 300}).json()
+    assert res["credits"] == 700.0
+    assert billing_client.post("/billing/reserve", json={"shop_id": "s1", "amount": 800}).status_code == 402
+
+    rid = res["reservation_id"]
+    assert billing_client.post(f"/billing/reserve/{rid}/commit", json={"amount": 301}).status_code == 422
+    body = billing_client.post(f"/billing/reserve/{rid}/commit", json={"amount": 120, "feature": "descriptions"}).json()
+    assert body == {"status": "ok", "committed": 120, "released": 180.0, "credits": 880.0}
+    assert billing_client.post(f"/billing/reserve/{rid}/release").status_code == 404
+
+    usage = billing_client.get("/billing/usage", params={"shop_id": "s1"}).json()["usage"]
+    assert usage[0]["amount"] == 120 and usage[0]["feature"] == "descriptions"
+
+    other = billing_client.post("/billing/reserve", json={"shop_id": "s1", "amount": 50}).json()["reservation_id"]
+    assert billing_client.post(f"/billing/reserve/{other}/release").json()["credits"] == 880.0
+
+
+def test_expired_reservations_are_released(billing_client, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(credit_ledger, "time", SimpleNamespace(time=lambda: now[0]))
+    rid = billing_client.post("/billing/reserve", json={"shop_id": "s1", "amount": 100, "ttl_seconds": 60}).json()["reservation_id"]
+    assert billing_client.get("/billing/credits", params={"shop_id": "s1"}).json()["credits"] == 900.0
+
+    now[0] += 61
+    assert billing_client.get("/billing/credits", params={"shop_id": "s1"}).json()["credits"] == 1000.0
+    assert billing_client.post(f"/billing/reserve/{rid}/commit", json={"amount": 10}).status_code == 404
+    assert billing_client.post("/billing/reserve", json={"shop_id": "s1", "amount": 1, "ttl_seconds": 10**6}).status_code == 422
+
+
+def test_usage_batch_enforces_limits_per_row(billing_client):
+    _set_plan({"descriptions": 10})
+    row = {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 4, "timestamp": "2026-03-05T10:00:00"}
+    before = billing_service._ledger.commits
+    body = billing_client.post("/billing/usage_batch", json=[row, row, row, {**row, "feature": "titles"}]).json()
+    assert [r["status"] for r in body["results"]] == ["ok", "ok", "limit_exceeded", "ok"]
+    assert body["accepted"] == 3
+    assert billing_service._ledger.commits == before + 1
+    assert billing_client.get("/billing/credits", params={"shop_id": "s1"}).json()["credits"] == 988.0
+    assert billing_client.post("/billing/usage_batch", json=[row] * (billing_service.MAX_USAGE_BATCH + 1)).status_code == 413
+
+
+def test_usage_pages_follow_cursor_newest_first(billing_client):
+    rows = [{"shop_id": f"s{i % 2}", "type": "subscription", "amount": i, "timestamp": "2026-03-05T10:00:00"} for i in range(25)]
+    billing_client.post("/billing/usage_batch", json=rows)
+
+    seen, cursor = [], None
+    while True:
+        params = {"shop_id": "s1", "limit": 5, **({"cursor": cursor} if cursor else {})}
+        page = billing_client.get("/billing/usage", params=params).json()
+        seen += [u["amount"] for u in page["usage"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == list(range(23, 0, -2))
+
+    # entries committed after the index was built are picked up
+    billing_client.post("/billing/usage", json={**rows[1], "amount": 99})
+    assert billing_client.get("/billing/usage", params={"shop_id": "s1", "limit": 1}).json()["usage"][0]["amount"] == 99
+    # a fresh worker builds the index from the journal
+    reopened = CreditLedger(billing_service._ledger.base_dir)
+    assert [u["amount"] for u in reopened.usage_page(None, 3)[0]] == [99, 24, 23]
+
+    first = billing_client.get("/billing/usage", params={"shop_id": "s1", "limit": 5}).json()["next_cursor"]
+    assert billing_client.get("/billing/usage", params={"shop_id": "s0", "cursor": first}).status_code == 422
+    assert billing_client.get("/billing/usage", params={"cursor": "not-a-cursor"}).status_code == 422
+
+
+def test_feature_aggregates_are_maintained_per_shop_and_month(billing_client):
+    _set_plan({})
+    rows = [
+        {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 2, "time_saved_minutes": 30, "timestamp": "2026-03-05T10:00:00"},
+        {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 3, "time_saved_minutes": 15, "timestamp": "2026-04-02T10:00:00"},
+        {"shop_id": "s1", "type": "ai_credit", "amount": 1, "timestamp": "2026-04-03T10:00:00"},
+        {"shop_id": "s2", "type": "ai_credit", "feature": "descriptions", "amount": 7, "time_saved_minutes": 60, "timestamp": "2026-04-04T10:00:00"},
+    ]
+    billing_client.post("/billing/usage_batch", json=rows)
+
+    per_feature = billing_client.get("/billing/usage_per_feature", params={"shop_id": "s1"}).json()["per_feature"]
+    assert per_feature == {"descriptions": {"count": 2, "credits": 5.0, "time_saved_minutes": 45.0},
+                           "unknown": {"count": 1, "credits": 1.0, "time_saved_minutes": 0.0}}
+    april = billing_client.get("/billing/usage_per_feature", params={"month": "2026-04"}).json()["per_feature"]
+    assert april["descriptions"] == {"count": 2, "credits": 10.0, "time_saved_minutes": 75.0}
+    assert billing_client.get("/billing/usage_per_feature", params={"month": "April"}).status_code == 422
+
+    savings = billing_client.get("/billing/savings_estimate", params={"shop_id": "s1"}).json()
+    assert savings["hourly_rate"] == 60.0 and savings["estimated_savings"] == 45.0
+    assert savings["per_feature"]["descriptions"] == {"time_saved_minutes": 45.0, "credits_spent": 5.0}
+
+    # aggregates survive checkpoints, and snapshots written before they existed are backfilled
+    ledger = billing_service._ledger
+    ledger.checkpoint()
+    with open(os.path.join(ledger.base_dir, "snapshot.json")) as f:
+        snapshot = json.load(f)
+    del snapshot["state"]["feature_stats"]
+    with open(os.path.join(ledger.base_dir, "snapshot.json"), "w") as f:
+        json.dump(snapshot, f)
+    assert CreditLedger(ledger.base_dir).feature_totals("s1") == per_feature
+
+
+def test_invoice_job_closes_months_and_only_recomputes_open_ones(billing_client, tmp_path, monkeypatch):
+    _set_plan({})
+    rows = [
+        {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 2, "time_saved_minutes": 10, "timestamp": "2026-03-05T10:00:00"},
+        {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 3, "time_saved_minutes": 5, "timestamp": "2026-03-20T10:00:00"},
+        {"shop_id": "s1", "type": "subscription", "amount": 29, "timestamp": "2026-03-01T00:00:00"},
+        {"shop_id": "s2", "type": "ai_credit", "feature": "titles", "amount": 1, "timestamp": "2026-04-02T10:00:00"},
+    ]
+    billing_client.post("/billing/usage_batch", json=rows)
+    now = [datetime(2026, 4, 10, tzinfo=timezone.utc).timestamp()]
+    job = InvoiceJob(billing_service._ledger, str(tmp_path / "invoices"), clock=lambda: now[0])
+
+    result = job.run()
+    assert result["records"] == 4 and result["closed_months"] == ["2026-03"] and result["open_months"] == ["2026-04"]
+    with open(tmp_path / "invoices" / "2026-03" / "s1.json") as f:
+        march = json.load(f)
+    assert march["status"] == "closed" and march["totals"] == {"quantity": 3, "amount": 34.0, "time_saved_minutes": 15.0}
+    assert [(l["type"], l["feature"], l["quantity"]) for l in march["lines"]] == [("ai_credit", "descriptions", 2), ("subscription", None, 1)]
+    with open(tmp_path / "invoices" / "2026-03" / "s1.csv") as f:
+        assert f.readline().strip() == "type,feature,service_month,quantity,amount,time_saved_minutes"
+
+    # the next run reads only new entries; a late March row lands on the open April invoice
+    billing_client.post("/billing/usage_batch", json=[{**rows[0], "amount": 4}, {**rows[3], "shop_id": "s1"}])
+    result = job.run()
+    assert result["records"] == 2 and result["late_records"] == 1 and result["closed_months"] == []
+    with open(tmp_path / "invoices" / "2026-03" / "s1.json") as f:
+        assert json.load(f)["totals"]["amount"] == 34.0
+    with open(tmp_path / "invoices" / "2026-04" / "s1.json") as f:
+        april = json.load(f)
+    assert april["status"] == "open"
+    assert {(l["feature"], l["service_month"], l["amount"]) for l in april["lines"]} == {("descriptions", "2026-03", 4.0), ("titles", "2026-04", 1.0)}
+
+    monkeypatch.setattr(billing_service, "INVOICES_DIR", str(tmp_path / "invoices"))
+    assert billing_client.get("/billing/invoices/s1/2026-04").json()["invoice_id"] == "s1-2026-04"
+    assert billing_client.get("/billing/invoices/s1/2026-04", params={"format": "csv"}).text.startswith("type,feature")
+    assert billing_client.get("/billing/invoices/s3/2026-04").status_code == 404
+
+
+def test_invoices_skip_refused_rows_and_accept_any_feature_name(billing_client, tmp_path):
+    _set_plan({"descriptions": 5})
+    usage = {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 4, "timestamp": "2026-03-05T10:00:00"}
+    assert billing_client.post("/billing/usage", json=usage).status_code == 200
+    assert billing_client.post("/billing/usage", json=usage).status_code == 402
+    assert billing_client.post("/billing/usage", json={**usage, "feature": "a|b", "amount": 1}).status_code == 200
+    assert billing_service._ledger.balance("s1") == 995.0
+
+    job = InvoiceJob(billing_service._ledger, str(tmp_path / "invoices"), clock=lambda: datetime(2026, 4, 10, tzinfo=timezone.utc).timestamp())
+    assert job.run()["records"] == 2
+    with open(tmp_path / "invoices" / "2026-03" / "s1.json") as f:
+        march = json.load(f)
+    assert march["totals"]["amount"] == 5.0
+    assert {(l["feature"], l["amount"]) for l in march["lines"]} == {("descriptions", 4.0), ("a|b", 1.0)}
+
+
+def test_invoice_paths_stay_inside_out_dir(billing_client, tmp_path, monkeypatch):
+    _set_plan({})
+    shops = ["../../escape", "..", "a/b"]
+    billing_client.post("/billing/usage_batch", json=[
+        {"shop_id": shop, "type": "ai_credit", "amount": 1, "timestamp": "2026-03-05T10:00:00"} for shop in shops])
+    out_dir = tmp_path / "invoices"
+    job = InvoiceJob(billing_service._ledger, str(out_dir), clock=lambda: datetime(2026, 4, 10, tzinfo=timezone.utc).timestamp())
+    assert job.run()["invoices_written"] == 3
+
+    written = sorted(p.name for p in (out_dir / "2026-03").iterdir())
+    assert len(written) == 6 and not (tmp_path / "escape.json").exists()
+    for shop in shops:
+        path = invoice_path(str(out_dir), shop, "2026-03", "json")
+        assert os.path.dirname(path) == str(out_dir / "2026-03")
+        with open(path) as f:
+            assert json.load(f)["shop_id"] == shop
+
+    monkeypatch.setattr(billing_service, "INVOICES_DIR", str(out_dir))
+    assert billing_client.get("/billing/invoices/%2E%2E/2026-03").json()["shop_id"] == ".."
+
+
+def test_token_buckets_limit_bursts_at_every_level(tmp_path):
+    now = [1_000.0]
+    limiter = HierarchicalLimiter(clock=lambda: now[0])
+    limits = {"second": 5, "hour": 12}
+    limiter.acquire("s1", "descriptions", 5, limits)
+    with pytest.raises(RateLimited) as exc:
+        limiter.acquire("s1", "descriptions", 1, limits)
+    assert exc.value.level == "second" and exc.value.retry_after == pytest.approx(0.2)
+    limiter.acquire("s1", "titles", 5, limits)  # features have separate buckets
+
+    now[0] += 1
+    limiter.acquire("s1", "descriptions", 5, limits)
+    now[0] += 1
+    with pytest.raises(RateLimited) as exc:  # the second level has refilled, the hour has not
+        limiter.acquire("s1", "descriptions", 5, limits)
+    assert exc.value.level == "hour"
+    assert limiter.remaining("s1", "descriptions")["second"] == 5.0
+
+    # a restarted process keeps the drawn-down quota; downtime counts as refill
+    limiter.checkpoint(str(tmp_path / "limits.json"))
+    restored = HierarchicalLimiter(clock=lambda: now[0] + 600)
+    assert restored.restore(str(tmp_path / "limits.json"))
+    assert restored.remaining("s1", "descriptions")["hour"] == pytest.approx(2 + 600 * 12 / 3600, abs=0.01)
+
+
+def test_plan_rate_limits_reject_usage_before_it_is_recorded(billing_client):
+    store = billing_service.load_store()
+    store["accounts"] = {"s1": {"plan": {"name": "pro", "limits": {}, "rate_limits": {"*": {"second": 5}}}}}
+    billing_service.save_store(store)
+    usage = {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 4}
+    assert billing_client.post("/billing/usage", json=usage).status_code == 200
+    resp = billing_client.post("/billing/usage", json=usage)
+    assert resp.status_code == 429 and resp.headers["Retry-After"] == "1"
+
+    body = billing_client.post("/billing/usage_batch", json=[{**usage, "shop_id": "s2"}, {**usage, "amount": 40}]).json()
+    assert [r["status"] for r in body["results"]] == ["ok", "rate_limited"]
+    assert billing_client.post("/billing/reserve", json={"shop_id": "s1", "amount": 9}).status_code == 429
+    assert len(billing_client.get("/billing/usage", params={"shop_id": "s1"}).json()["usage"]) == 1
+
+
+def test_rejected_charges_return_rate_limit_tokens(billing_client, monkeypatch):
+    monkeypatch.setattr(billing_service, "_limiter", HierarchicalLimiter(clock=lambda: 1000.0))
+    store = billing_service.load_store()
+    store["accounts"] = {"s1": {"plan": {"name": "pro", "limits": {}, "rate_limits": {"*": {"hour": 5000}}}}}
+    billing_service.save_store(store)
+    assert billing_client.post("/billing/reserve", json={"shop_id": "s1", "amount": 2000}).status_code == 402
+    assert billing_service._limiter.remaining("s1", None)["hour"] == 5000
+
+    usage = {"shop_id": "s1", "type": "ai_credit", "feature": "descriptions", "amount": 0}
+    assert billing_client.post("/billing/usage", json=usage).status_code == 422
+    assert billing_client.post("/billing/usage", json={**usage, "amount": -5}).status_code == 422
+    assert billing_client.post("/billing/charge", json={"shop_id": "s1", "amount": -5}).status_code == 422
+    body = billing_client.post("/billing/usage_batch", json=[{**usage, "amount": -1}, {**usage, "amount": 3}]).json()
+    assert [r["status"] for r in body["results"]] == ["error", "ok"]
+    assert billing_service._limiter.remaining("s1", "descriptions")["hour"] == 4997
+
+    store = billing_service.load_store()
+    store["accounts"]["s1"]["plan"]["limits"] = {"descriptions": 4}
+    billing_service.save_store(store)
+    assert billing_client.post("/billing/usage", json={**usage, "amount": 2}).status_code == 402
+    assert billing_service._limiter.remaining("s1", "descriptions")["hour"] == 4997
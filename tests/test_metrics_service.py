@@ -0,0 +1,478 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import catalog_service, metrics_service
+from backend.benchmark_snapshots import SnapshotScheduler, SnapshotStore
+from backend.embeddings import batch_text_embeddings
+from backend.util import safe_name
+from backend.event_table import EventTable
+from backend.metrics_shards import ShardedMetricsStore
+from backend.profile_store import ProfileStore
+from backend.similarity_index import ExactIndex, IVFIndex, SimilarityRegistry
+from backend.token_index import DecayedTokenTrends
+
+
+@pytest.fixture
+def metrics_client(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics_service, "STORE_PATH", str(tmp_path / "metrics_store.json"))
+    monkeypatch.setattr(metrics_service, "EMBEDDINGS_DIR", str(tmp_path / "embeddings"))
+    monkeypatch.setattr(metrics_service, "_similarity", SimilarityRegistry())
+    monkeypatch.setattr(metrics_service, "_derived", metrics_service._DerivedState())
+    monkeypatch.setattr(metrics_service, "_profiles", ProfileStore(str(tmp_path / "merchant_profiles"), legacy_store=str(tmp_path / "metrics_store.json")))
+    monkeypatch.setattr(metrics_service, "_shards", ShardedMetricsStore(str(tmp_path / "metrics_shards")))
+    monkeypatch.setattr(metrics_service, "_snapshots", SnapshotStore())
+    return TestClient(metrics_service.app)
+
+
+def test_batch_embeddings_match_single_text_embedding():
+    texts = ["Soft cotton tee", "", "linen summer dress linen"]
+    mat = batch_text_embeddings(texts, dim=32)
+    assert mat.dtype == np.float32
+    assert mat.shape == (3, 32)
+    assert not mat[1].any()
+    np.testing.assert_allclose(np.linalg.norm(mat[[0, 2]], axis=1), 1.0, rtol=1e-5)
+    np.testing.assert_allclose(mat[2], metrics_service.simple_text_embedding(texts[2], dim=32), rtol=1e-6)
+
+
+def test_compute_embeddings_writes_sidecar_not_profile_lists(metrics_client):
+    resp = metrics_client.post("/merchant/shop-1/compute_embeddings?dim=16", json=["red silk scarf", "blue denim jacket"])
+    assert resp.status_code == 200
+    assert resp.json()["count"] == 2
+
+    profile = metrics_client.get("/merchant/shop-1/profile").json()
+    assert "style_embeddings" not in profile
+    assert profile["style_embeddings_count"] == 2
+    assert len(profile["store_style_embedding"]) == 16
+
+    mat = metrics_service.load_style_embeddings("shop-1")
+    assert isinstance(mat, np.memmap)
+    assert mat.shape == (2, 16)
+
+
+def test_similar_endpoint_ranks_closest_description_first(metrics_client):
+    descriptions = ["red silk scarf", "blue denim jacket", "black leather boots"]
+    metrics_client.post("/merchant/shop-1/compute_embeddings", json=descriptions)
+
+    resp = metrics_client.get("/merchant/shop-1/similar", params={"text": "denim jacket", "k": 2})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["approximate"] is False
+    assert [r["index"] for r in body["results"]][0] == 1
+    assert len(body["results"]) == 2
+
+    assert metrics_client.get("/merchant/unknown/similar", params={"text": "x"}).status_code == 404
+
+
+def test_ivf_index_recall_against_exact():
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(20, 32)).astype(np.float32)
+    vectors = centers[rng.integers(0, 20, size=4000)] + 0.05 * rng.normal(size=(4000, 32)).astype(np.float32)
+    exact = ExactIndex(vectors)
+    ivf = IVFIndex(vectors, n_lists=40, n_probe=8)
+    hits = 0
+    for q in vectors[:50]:
+        truth = {i for i, _ in exact.search(q, 10)}
+        hits += len(truth & {i for i, _ in ivf.search(q, 10)})
+    assert hits / 500 >= 0.9
+
+
+def test_token_index_serves_benchmarks_and_rebuilds_from_store(metrics_client, monkeypatch):
+    metrics_client.post("/metrics/rate_output", json={"shop_id": "s1", "product_id": "s1:p1", "output_type": "description", "rating": 5, "notes": "Breathable linen"})
+    metrics_client.post("/metrics/rate_output", json={"shop_id": "s2", "product_id": "s2:p1", "output_type": "description", "rating": 1, "notes": "bland copy"})
+    now = datetime.utcnow()
+    for days_ago, text in [(200, "classic cotton"), (150, "classic cotton"), (100, "classic cotton"), (2, "relaxed oversized"), (1, "relaxed oversized")]:
+        ts = (now - timedelta(days=days_ago)).isoformat()
+        metrics_client.post("/metrics/record_edit", json={"shop_id": "s1", "product_id": "s1:p1", "field": "description", "original": "x", "edited": text, "timestamp": ts})
+
+    styles = metrics_client.get("/benchmarks/description_styles", params={"top_n": 2, "recent_days": 100000}).json()["top_styles"]
+    assert styles[0] == {"token": "breathable", "avg_score": 5.0, "count": 1}
+
+    trends = metrics_client.get("/benchmarks/industry_trends").json()
+    assert trends["trend_window_days"] == {"short": 30, "long": 90}
+    rising = {r["token"]: r for r in trends["rising_tokens"]}
+    assert set(rising) == {"relaxed", "oversized"}
+    assert rising["relaxed"]["score"] > 1.5
+    assert 1.8 < rising["relaxed"]["recent_count"] <= 2
+
+    # a fresh process rebuilds the same index from the persisted history
+    monkeypatch.setattr(metrics_service, "_derived", metrics_service._DerivedState())
+    rebuilt = metrics_client.get("/benchmarks/industry_trends", params={"refresh": True}).json()["rising_tokens"]
+    assert [r["token"] for r in rebuilt] == [r["token"] for r in trends["rising_tokens"]]
+
+
+def test_benchmarks_are_served_from_snapshots_until_refreshed(metrics_client):
+    edit = {"shop_id": "s1", "product_id": "s1:p1", "field": "description", "original": "x", "edited": "breezy linen"}
+    metrics_client.post("/metrics/record_edit", json=edit)
+    first = metrics_client.get("/benchmarks/description_styles", params={"top_n": 1}).json()
+    assert len(first["top_styles"]) == 1
+    assert first["snapshot"]["age_seconds"] >= 0
+
+    metrics_client.post("/metrics/record_edit", json={**edit, "edited": "crisp poplin"})
+    tokens = lambda body: {s["token"] for s in body["top_styles"]}
+    assert tokens(metrics_client.get("/benchmarks/description_styles", params={"top_n": 10}).json()) == {"breezy", "linen"}
+    refreshed = metrics_client.get("/benchmarks/description_styles", params={"top_n": 10, "refresh": True}).json()
+    assert tokens(refreshed) == {"breezy", "linen", "crisp", "poplin"}
+
+    metrics_client.get("/benchmarks/industry_trends")
+    assert metrics_service._snapshots.computations == 3
+    assert metrics_service._snapshots.refresh_all() == 2
+
+
+def test_snapshot_refreshes_are_single_flight_and_scheduled():
+    store = SnapshotStore()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return {"value": store.computations}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.refresh("k", slow))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    time.sleep(0.1)  # let the followers reach the in-flight computation
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert store.computations == 1
+    assert len({id(r[1]) for r in results}) == 1
+
+    scheduler = SnapshotScheduler(store, interval=0.01)
+    scheduler.start()
+    deadline = time.time() + 5
+    while store.computations < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    scheduler.stop(timeout=5)
+    assert store.computations >= 3
+
+
+def test_ratings_and_edits_without_timestamp_count_as_current():
+    from backend.token_index import TokenStatsIndex
+
+    index = TokenStatsIndex()
+    index.add_rating("cozy knit", 5)
+    index.add_edit("cozy knit")
+    since = time.time() - 3600
+    assert {r["token"]: r["count"] for r in index.top_styles(since, 5)} == {"cozy": 2, "knit": 2}
+
+
+def test_decayed_trends_use_the_time_constants_covering_the_period():
+    trends = DecayedTokenTrends(top_k=2, candidates_factor=2)
+    day = 24 * 3600
+    now = 1000 * day
+    for d in range(0, 300, 10):
+        trends.add("steady", now - d * day)
+    for d in range(5):
+        trends.add("seasonal", now - d * day)
+    trends.add("stale", now - 200 * day)
+
+    assert trends.pair_for(7)[1:] == (1, 7)
+    assert trends.pair_for(1000)[1:] == (90, 365)
+    assert [r["token"] for r in trends.rising(90, now=now)] == ["seasonal"]
+    assert trends.rising(90, now=now + 120 * day) == []
+    # candidate sets stay bounded by top_k * candidates_factor
+    for i in range(20):
+        trends.add(f"noise{i:02d}", now)
+    assert all(len(c) <= 4 for c in trends._candidates)
+
+
+def test_best_products_reads_index_without_writing_store(metrics_client):
+    for pid, revenue in [("s1:red-shirt", 10), ("s1:blue-shirt", 30), ("s1:red-hat", 5), ("s2:other", 100), ("s1:red-shirt", 15)]:
+        metrics_client.post("/metrics/record", json={"timestamp": "2026-01-01T00:00:00", "type": "revenue", "revenue": revenue, "product_id": pid})
+    segment = os.path.join(metrics_service._shards.shard("s1").dir, "events-000000.jsonl")
+    mtime = os.path.getmtime(segment)
+
+    body = metrics_client.get("/merchant/s1/best_products", params={"top_n": 2}).json()
+    assert body["topProducts"] == [{"product_id": "s1:blue-shirt", "revenue": 30.0}, {"product_id": "s1:red-shirt", "revenue": 25.0}]
+    assert body["patterns"][:2] == [{"token": "red", "count": 2}, {"token": "shirt", "count": 2}]
+    assert os.path.getmtime(segment) == mtime
+
+    metrics_client.post("/metrics/record", json={"timestamp": "2026-01-01T00:00:00", "type": "view", "product_id": "s1:green-hat"})
+    patterns = {p["token"]: p["count"] for p in metrics_client.get("/merchant/s1/best_products").json()["patterns"]}
+    assert patterns["hat"] == 2
+
+
+def test_summary_exposes_sketch_estimates_with_error_bounds(metrics_client):
+    for i in range(40):
+        metrics_client.post("/metrics/record", json={"timestamp": "2026-01-01T00:00:00", "type": "revenue", "revenue": float(i), "product_id": f"s1:p{i % 8}", "visitor_id": f"v{i % 5}"})
+
+    approx = metrics_client.get("/metrics/summary").json()["approximate"]
+    assert approx["scope"] == "all"
+    assert approx["uniqueProducts"]["estimate"] == 8
+    assert approx["uniqueVisitors"]["estimate"] == 5
+    assert approx["revenue"]["count"] == 40
+    assert 15 <= approx["revenue"]["p50"] <= 24
+    assert approx["heavyHitterProducts"][0]["events"] == 5
+
+    metrics_client.post("/metrics/record", json={"timestamp": "2026-01-01T00:00:00", "type": "view", "product_id": "s2:p1"})
+    shop = metrics_client.get("/metrics/summary", params={"shop_id": "s1"}).json()
+    assert shop["approximate"]["uniqueProducts"]["estimate"] == 8
+    assert shop["raw"] == {"views": 0, "tryons": 0, "conversions": 0, "revenue": sum(range(40))}
+    assert metrics_client.get("/metrics/summary", params={"shop_id": "s2"}).json()["raw"]["views"] == 1
+    assert metrics_client.get("/metrics/summary", params={"shop_id": "s3"}).json()["raw"]["revenue"] == 0
+    assert metrics_client.get("/metrics/summary", params={"shop_id": "s2", "product_id": "s1:p1"}).json()["raw"]["revenue"] == 0
+    assert "heavyHitterProducts" not in metrics_client.get("/benchmarks/industry_trends").json()["approximate"]
+
+
+def test_timeseries_buckets_downsamples_and_caches_closed_ranges(metrics_client):
+    for day in range(1, 11):
+        metrics_client.post("/metrics/record", json={"timestamp": f"2026-01-{day:02d}T12:00:00+00:00", "type": "revenue", "revenue": 10, "product_id": "s1:p1"})
+    metrics_client.post("/metrics/record", json={"timestamp": "2026-01-03T12:00:00+00:00", "type": "view", "product_id": "s2:p9"})
+
+    params = {"bucket": "1d", "shop_id": "s1", "from": "2026-01-01T00:00:00+00:00", "to": "2026-01-11T00:00:00+00:00"}
+    body = metrics_client.get("/metrics/timeseries", params=params).json()
+    assert body["cached"] is False
+    assert len(body["points"]) == 10
+    assert all(p["count"] == 1 and p["revenue"] == 10 for p in body["points"])
+    assert metrics_client.get("/metrics/timeseries", params=params).json()["cached"] is True
+
+    coarse = metrics_client.get("/metrics/timeseries", params={**params, "max_points": 3}).json()
+    assert coarse["resolution_seconds"] == 4 * 86400
+    assert [p["count"] for p in coarse["points"]] == [4, 4, 2]
+
+    views = metrics_client.get("/metrics/timeseries", params={"bucket": "1d", "type": "view", "from": params["from"], "to": params["to"]}).json()
+    assert sum(p["count"] for p in views["points"]) == 1
+
+    # a late event invalidates the cached closed range
+    metrics_client.post("/metrics/record", json={"timestamp": "2026-01-02T01:00:00+00:00", "type": "revenue", "revenue": 5, "product_id": "s1:p2"})
+    again = metrics_client.get("/metrics/timeseries", params=params).json()
+    assert again["cached"] is False
+    assert again["points"][1]["revenue"] == 15
+    assert metrics_client.get("/metrics/timeseries", params={**params, "bucket": "5m"}).status_code == 422
+
+
+def test_event_table_aggregates_match_dict_scan_in_a_fraction_of_the_memory():
+    rng = np.random.default_rng(3)
+    table = EventTable(chunk_size=1000)
+    events = []
+    for i in range(2500):
+        e = {"timestamp": f"2026-01-{1 + i % 28:02d}T00:00:00", "type": ["view", "tryon", "conversion"][i % 3],
+             "revenue": round(float(rng.uniform(0, 50)), 2) if i % 3 == 2 else None, "product_id": f"s{i % 4}:p{i % 7}"}
+        events.append(e)
+        table.append(e)
+    table.append({"timestamp": None, "type": "refund", "revenue": -5})
+
+    assert len(table) == 2501
+    assert table.nbytes <= 21 * 3000
+    totals = table.totals(product_id="s1:p1")
+    selected = [e for e in events if e["product_id"] == "s1:p1"]
+    assert totals["counts"]["view"] == sum(e["type"] == "view" for e in selected)
+    assert totals["revenue"] == pytest.approx(sum(e["revenue"] or 0 for e in selected), abs=0.01)
+
+    since = datetime(2026, 1, 20).timestamp()
+    recent = table.totals(since=since)
+    assert recent["counts"]["refund"] == 1  # undated events count as current
+    assert sum(recent["counts"].values()) == 1 + sum(datetime.fromisoformat(e["timestamp"]).timestamp() >= since for e in events)
+    assert table.totals(product_id="unknown")["counts"] == {"view": 0, "tryon": 0, "conversion": 0, "refund": 0}
+
+
+def test_legacy_store_migrates_into_per_shop_shards(metrics_client):
+    legacy = {
+        "events": [
+            {"timestamp": "2026-01-01T00:00:00", "type": "tryon", "product_id": "s1:p1"},
+            {"timestamp": "2026-01-01T00:00:00", "type": "conversion", "revenue": 40, "product_id": "s1:p1"},
+            {"timestamp": "2026-01-01T00:00:00", "type": "view", "product_id": "s2:p1"},
+            {"timestamp": "2026-01-01T00:00:00", "type": "view"},
+        ],
+        "ratings": [{"shop_id": "s2", "product_id": "s2:p1", "output_type": "title", "rating": 3}],
+        "monthly_summaries": [{"month": "2025-12", "impressions": 10}],
+        "merchant_profiles": {"s1": {"shop_id": "s1"}},
+    }
+    with open(metrics_service.STORE_PATH, "w") as f:
+        json.dump(legacy, f)
+
+    summary = metrics_client.get("/metrics/summary").json()
+    assert summary["raw"] == {"views": 2, "tryons": 1, "conversions": 1, "revenue": 40}
+    assert summary["monthlyAiSummary"][0]["month"] == "2025-12"
+    assert metrics_service.load_store() == {"merchant_profiles": {"s1": {"shop_id": "s1"}}}
+
+    shards = metrics_service._shards
+    assert shards.shard_ids() == ["s1", "s2", "~global"]
+    assert [e["type"] for e in metrics_service.iter_records("events", "s1")] == ["tryon", "conversion"]
+    assert len(list(shards.iter("ratings", "s2"))) == 1
+
+    metrics_client.post("/metrics/record", json={"timestamp": "2026-01-02T00:00:00", "type": "view", "product_id": "s1:p1"})
+    assert metrics_client.get("/metrics/summary", params={"product_id": "s1:p1"}).json()["raw"]["views"] == 1
+    assert metrics_client.get("/benchmarks/industry_trends", params={"period_days": 100000}).json()["conversions"] == 1
+
+
+def test_profiles_migrate_out_of_metrics_store_and_are_shared_with_catalog(metrics_client, monkeypatch):
+    with open(metrics_service.STORE_PATH, "w") as f:
+        json.dump({"events": [], "merchant_profiles": {"s1": {"shop_id": "s1", "brand_tone": "playful"}}}, f)
+
+    assert metrics_client.get("/merchant/s1/profile").json()["brand_tone"] == "playful"
+    assert "merchant_profiles" not in metrics_service.load_store()
+
+    metrics_client.post("/merchant/s1/settings", json={"improve_future_outputs": True})
+    metrics_client.post("/metrics/record_edit", json={"shop_id": "s1", "product_id": "s1:p1", "field": "title", "original": "shirt", "edited": "organic shirt"})
+    metrics_client.post("/metrics/rate_output", json={"shop_id": "s1", "product_id": "s1:p1", "output_type": "title", "rating": 4})
+
+    profile = metrics_client.get("/merchant/s1/profile").json()
+    assert profile["learning_adjustments"] == {"organic": 1}
+    assert profile["ratings"]["title"] == {"count": 1, "sum": 4, "avg": 4.0}
+
+    monkeypatch.setattr(catalog_service, "profiles", metrics_service._profiles)
+    variants = catalog_service.generate_description_variants({"id": "s1:p1", "description": "Tee"}, n=1)
+    assert variants[0]["description"].endswith("organic")
+
+
+def test_catalog_profile_store_migrates_legacy_profiles_on_first_access(tmp_path):
+    legacy = tmp_path / "metrics_store.json"
+    legacy.write_text(json.dumps({"events": [], "merchant_profiles": {"s1": {"shop_id": "s1", "brand_tone": "calm"}}}))
+    profiles = ProfileStore(str(tmp_path / "merchant_profiles"), legacy_store=str(legacy))
+    assert profiles.get("s1")["brand_tone"] == "calm"
+    assert profiles.migrated and "merchant_profiles" not in json.loads(legacy.read_text())
+
+
+def test_record_event_drops_retried_idempotency_keys(metrics_client):
+    event = {"timestamp": "2026-01-01T00:00:00", "type": "conversion", "revenue": 20, "product_id": "s1:p1", "idempotency_key": "evt-1"}
+    assert metrics_client.post("/metrics/record", json=event).json() == {"status": "ok"}
+    assert metrics_client.post("/metrics/record", json=event).json() == {"status": "duplicate", "match": "exact"}
+    metrics_client.post("/metrics/record", json={**event, "idempotency_key": "evt-2"})
+
+    assert metrics_client.get("/metrics/summary").json()["raw"]["conversions"] == 2
+    stats = metrics_client.get("/metrics/dedupe_stats").json()
+    assert stats["accepted"] == 2
+    assert stats["duplicates_exact"] == 1
+
+
+def test_idempotency_filter_falls_back_to_bloom_after_recent_set_overflows():
+    from backend.dedupe import IdempotencyFilter
+
+    f = IdempotencyFilter(window_seconds=100, capacity=1000, recent_size=2)
+    for key in ("a", "b", "c"):
+        assert f.check_and_add(key, now=10) is None
+    assert f.check_and_add("a", now=20) == "probable"
+    assert f.check_and_add("c", now=20) == "exact"
+    assert f.check_and_add("a", now=400) is None
+
+
+def test_failed_append_does_not_mark_idempotency_key_seen(metrics_client, monkeypatch):
+    event = {"timestamp": "2026-01-01T00:00:00", "type": "view", "product_id": "s1:p1", "idempotency_key": "evt-9"}
+
+    def failing_append(kind, record):
+        raise OSError("disk full")
+    append = metrics_service._append
+    monkeypatch.setattr(metrics_service, "_append", failing_append)
+    with pytest.raises(OSError):
+        metrics_client.post("/metrics/record", json=event)
+    monkeypatch.setattr(metrics_service, "_append", append)
+    assert metrics_client.post("/metrics/record", json=event).json() == {"status": "ok"}
+
+
+def test_indexes_catch_up_with_appends_from_other_workers(metrics_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics_service, "SYNC_SECONDS", 0.0)
+    metrics_client.post("/metrics/record", json={"timestamp": "2026-01-01T00:00:00", "type": "view", "product_id": "s1:p1"})
+    other_worker = ShardedMetricsStore(str(tmp_path / "metrics_shards"))
+    now = datetime.now().isoformat()
+    other_worker.shard("s1").append("events", {"timestamp": now, "type": "conversion", "product_id": "s1:p1", "revenue": 25, "idempotency_key": "evt-1"})
+
+    raw = metrics_client.get("/metrics/summary", params={"shop_id": "s1"}).json()["raw"]
+    assert raw["views"] == 1 and raw["conversions"] == 1 and raw["revenue"] == 25
+    duplicate = {"timestamp": now, "type": "conversion", "product_id": "s1:p1", "idempotency_key": "evt-1"}
+    assert metrics_client.post("/metrics/record", json=duplicate).json()["status"] == "duplicate"
+
+
+def test_funnel_attributes_conversions_to_tryons_in_the_same_session(metrics_client):
+    def record(ts, etype, session, pid="s1:dress", revenue=None):
+        metrics_client.post("/metrics/record", json={"timestamp": ts, "type": etype, "product_id": pid, "session_id": session, "revenue": revenue})
+
+    record("2026-01-01T10:00:00", "view", "a")
+    record("2026-01-01T10:01:00", "tryon", "a")
+    record("2026-01-01T10:05:00", "conversion", "a", revenue=80)
+    record("2026-01-01T11:00:00", "view", "b")
+    record("2026-01-01T11:05:00", "conversion", "b", revenue=50)  # no try-on: not attributed
+    record("2026-01-01T12:00:00", "tryon", "c")
+    record("2026-01-03T12:00:00", "conversion", "c", revenue=30)  # outside the 24h window
+
+    live = metrics_client.get("/metrics/funnel", params={"shop_id": "s1"}).json()
+    dress = live["products"][0]
+    assert dress["product_id"] == "s1:dress"
+    assert (dress["views"], dress["tryons"], dress["conversions"], dress["tryon_conversions"]) == (2, 2, 3, 1)
+    assert dress["attributed_revenue"] == 80
+
+    replayed = metrics_client.post("/metrics/funnel/replay", params={"shop_id": "s1", "window_seconds": 7 * 86400}).json()
+    assert replayed["totals"]["tryon_conversions"] == 2
+    assert replayed["totals"]["attributed_revenue"] == 110
+
+
+def test_export_streams_columnar_files_filtered_by_shop_and_date(metrics_client, tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    from backend import metrics_export
+
+    for day, pid in [(1, "s1:p1"), (2, "s1:p2"), (2, "s2:p1"), (5, "s1:p3")]:
+        metrics_client.post("/metrics/record", json={"timestamp": f"2026-01-0{day}T08:00:00+00:00", "type": "revenue", "revenue": day, "product_id": pid})
+    metrics_client.post("/metrics/record_edit", json={"shop_id": "s1", "product_id": "s1:p1", "field": "title", "original": "a", "edited": "b", "timestamp": "2026-01-01T09:00:00+00:00"})
+
+    resp = metrics_client.get("/metrics/export", params={"shop_id": "s1", "from": "2026-01-01T00:00:00+00:00", "to": "2026-01-03T00:00:00+00:00"})
+    assert resp.status_code == 200
+    table = pq.read_table(pa.BufferReader(resp.content))
+    assert table.column("product_id").to_pylist() == ["s1:p1", "s1:p2"]
+    assert table.column("shop_id").to_pylist() == ["s1", "s1"]
+
+    resp = metrics_client.get("/metrics/export", params={"kind": "edits", "format": "arrow"})
+    assert ipc.open_stream(resp.content).read_all().column("edited").to_pylist() == ["b"]
+
+    counts = metrics_export.export_partitioned(str(tmp_path / "out"), metrics_service.iter_records, batch_size=1)
+    assert counts == {"events": 4, "ratings": 0, "edits": 1}
+    assert (tmp_path / "out" / "events" / "shop_id=s1" / "date=2026-01-05" / "part-0.parquet").exists()
+    assert pq.read_table(str(tmp_path / "out" / "events" / "shop_id=s1")).num_rows == 3
+
+
+def test_export_partitions_stay_inside_out_dir(tmp_path):
+    pytest.importorskip("pyarrow")
+    from backend import metrics_export
+
+    edits = [{"shop_id": "../../escape", "product_id": "x", "field": "title", "original": "a", "edited": "b",
+              "timestamp": "2026-01-01T09:00:00+00:00"}]
+    source = lambda kind, shop_id: iter(edits if kind == "edits" else [])
+    assert metrics_export.export_partitioned(str(tmp_path / "out"), source, kinds=["edits"]) == {"edits": 1}
+    assert sorted(os.listdir(tmp_path)) == ["out"]
+    assert os.listdir(tmp_path / "out" / "edits") == [f"shop_id={safe_name('../../escape')}"]
+
+
+def test_shard_dirs_stay_inside_base_and_never_collide(tmp_path):
+    base = tmp_path / "shards"
+    store = ShardedMetricsStore(str(base))
+    for shard_id in ("..", ".", "a/b", "a_b", "../../x", "/abs"):
+        store.shard(shard_id).append("events", {"shard": shard_id})
+    dirs = os.listdir(base)
+    assert len([d for d in dirs if not d.startswith(".migrated")]) == 6
+    assert os.listdir(tmp_path) == ["shards"]
+    assert [r["shard"] for r in store.iter("events", "a/b")] == ["a/b"]
+    assert [r["shard"] for r in store.iter("events", "a_b")] == ["a_b"]
+    assert sorted(r["shard"] for r in store.iter("events")) == sorted(["..", ".", "a/b", "a_b", "../../x", "/abs"])
+
+
+def test_global_shard_name_is_reserved(tmp_path):
+    base = tmp_path / "shards"
+    (base / "_global").mkdir(parents=True)
+    (base / "_global" / "monthly_summaries-000000.jsonl").write_text('{"month": "2025-12"}\n')
+    store = ShardedMetricsStore(str(base))
+    assert [r["month"] for r in store.global_shard().iter("monthly_summaries")] == ["2025-12"]
+    for shop in ("_global", "~global"):
+        store.shard(shop).append("events", {"shop": shop})
+    assert list(store.shard(None).iter("events")) == []
+    assert sorted(os.listdir(base)) == sorted(["_global", safe_name("~global"), "~global"])
+    assert safe_name("shop-1") == "shop-1"
+
+
+def test_iter_by_time_merges_shards_by_timestamp(tmp_path):
+    store = ShardedMetricsStore(str(tmp_path / "shards"))
+    store.shard("a").append_many("events", [{"n": 1, "timestamp": "2026-01-01T00:00:00"}, {"n": 4, "timestamp": "2026-01-04T00:00:00"}])
+    store.shard("b").append_many("events", [{"n": 2, "timestamp": "2026-01-02T00:00:00"}, {"n": 3, "timestamp": "2026-01-03T00:00:00"}])
+    assert [e["n"] for e in store.iter_by_time("events")] == [1, 2, 3, 4]
+    assert [e["n"] for e in store.iter_by_time("events", "b")] == [2, 3]
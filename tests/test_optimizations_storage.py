@@ -0,0 +1,69 @@
+import json
+import os
+import time
+
+from app.optimizations.storage import JSONStore
+
+
+def test_writes_are_buffered_and_flushed_compactly(tmp_path):
+    s = JSONStore(base_dir=str(tmp_path), flush_delay=60)
+    for i in range(1000):
+        s.log_ai_credit_usage("store-1", 1.0, f"run {i}")
+    s.save_user({"api_key": "k1", "roles": ["admin"]})
+    assert not os.path.exists(tmp_path / "ai_credits.json")
+    # other instances over the same directory see unflushed writes
+    assert JSONStore(base_dir=str(tmp_path)).get_user_by_api_key("k1")["roles"] == ["admin"]
+    assert s.summarize_ai_credits() == {"store-1": 1000.0}
+
+    s.flush()
+    raw = (tmp_path / "ai_credits.json").read_text()
+    assert "\n" not in raw and len(json.loads(raw)) == 1000
+    assert not [n for n in os.listdir(tmp_path) if n.endswith(".tmp")]
+
+
+def test_debounced_flush_and_returned_copies(tmp_path):
+    s = JSONStore(base_dir=str(tmp_path), flush_delay=0.05)
+    s.save_store({"store_id": "store-1", "name": "One"})
+    s.get_store("store-1")["name"] = "changed"
+    assert s.get_store("store-1")["name"] == "One"
+
+    deadline = time.time() + 5
+    while not os.path.exists(tmp_path / "stores.json") and time.time() < deadline:
+        time.sleep(0.01)
+    with open(tmp_path / "stores.json") as f:
+        assert json.load(f) == [{"store_id": "store-1", "name": "One"}]
+
+
+def test_id_lookups_use_indexes_built_on_load(tmp_path):
+    (tmp_path / "records.json").write_text(json.dumps(
+        [{"product_id": "p-1", "changes": {"n": i}} for i in range(3)] + [{"product_id": "p-2", "changes": {}}]))
+    (tmp_path / "users.json").write_text(json.dumps([{"api_key": "k1", "roles": ["viewer"]}]))
+    s = JSONStore(base_dir=str(tmp_path))
+    assert [r["changes"]["n"] for r in s.list_records_for_product("p-1")] == [0, 1, 2]
+
+    s.save_record({"product_id": "p-1", "changes": {"n": 3}})
+    assert len(s.list_records_for_product("p-1")) == 4 and len(s.list_records_for_product("p-3")) == 0
+    s.save_user({"api_key": "k1", "roles": ["admin"]})
+    assert s.get_user_by_api_key("k1")["roles"] == ["admin"] and len(s.list_users()) == 1
+
+    s.save_snapshot({"snapshot_id": "snap-1", "product_id": "p-1"})
+    s.save_store_memory({"store_id": "store-1", "notes": ["a"]})
+    assert s.get_snapshot("snap-1")["product_id"] == "p-1"
+    assert s.get_store_memory("store-1")["notes"] == ["a"]
+    assert s._collections.indexes["users"] == {"k1": [{"api_key": "k1", "roles": ["admin"]}]}
+
+
+def test_shared_collections_use_shortest_delay_and_warn_on_foreign_writes(tmp_path, caplog):
+    slow = JSONStore(base_dir=str(tmp_path), flush_delay=60)
+    fast = JSONStore(base_dir=str(tmp_path), flush_delay=0.01)
+    assert slow._collections is fast._collections and slow._collections.flush_delay == 0.01
+
+    slow.save_user({"api_key": "k1", "roles": []})
+    slow.flush()
+    assert not caplog.records
+    (tmp_path / "users.json").write_text(json.dumps([{"api_key": "other", "roles": []}]))
+    slow.save_user({"api_key": "k2", "roles": []})
+    with caplog.at_level("WARNING"):
+        slow.flush()
+    assert "changed by another writer" in caplog.text
+    assert [u["api_key"] for u in json.loads((tmp_path / "users.json").read_text())] == ["k1", "k2"]
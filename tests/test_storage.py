@@ -0,0 +1,100 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import catalog_service, storage
+from backend.storage import JSONStore, SQLiteStore
+
+COLLECTIONS = storage.SCHEMAS["catalog"]["collections"]
+DEFAULTS = storage.SCHEMAS["catalog"]["defaults"]
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "json":
+        s = JSONStore(str(tmp_path / "store.json"), COLLECTIONS, DEFAULTS)
+    else:
+        s = SQLiteStore(str(tmp_path / "store.sqlite3"), COLLECTIONS, DEFAULTS)
+    yield s
+    s.close()
+
+
+def test_engines_upsert_and_filter_the_same_way(store):
+    assert store.load() == {"jobs": [], "items": []}
+    store.put_many("items", [{"id": "a:1", "price": 5}, {"id": "a:2", "price": 7}])
+    store.put("items", {"id": "a:1", "price": 6})
+    assert [i["price"] for i in store.find("items")] == [6, 7]
+    assert store.get("items", "a:2") == {"id": "a:2", "price": 7}
+    assert store.get("items", "missing") is None
+
+    store.put_many("events", [
+        {"product_id": "a:1", "revenue": 10, "timestamp": "2026-03-01T10:00:00"},
+        {"product_id": "b:1", "revenue": 20, "timestamp": "2026-03-02T10:00:00"},
+        {"product_id": "a:2", "revenue": 30, "timestamp": "2026-03-03T10:00:00"},
+        {"product_id": "a:1", "revenue": 40},
+    ])
+    assert [e["revenue"] for e in store.find("events", product_prefix="a:")] == [10, 30, 40]
+    assert [e["revenue"] for e in store.find("events", since="2026-03-02T00:00:00")] == [20, 30]
+    assert [e["revenue"] for e in store.find("events", until="2026-03-02T00:00:00", product_id="a:1")] == [10]
+    assert [e["revenue"] for e in store.find("events", newest_first=True, limit=3)] == [30, 20, 10]
+
+    version = store.version()
+    store.put("deliveries", {"delivery_id": "d1", "shop_id": "a"})
+    assert store.version() != version
+    assert store.find("deliveries", shop_id="a") == [{"delivery_id": "d1", "shop_id": "a"}]
+    assert store.count("events") == 4
+
+    store.put_batch({"items": [{"id": "a:2", "price": 8}], "jobs": [{"job_id": "j1", "progress": 1}]})
+    assert store.get("items", "a:2")["price"] == 8 and store.get("jobs", "j1")["progress"] == 1
+
+    document = store.load()
+    store.save({"items": [], "accounts": {"a": {"plan": "pro"}}})
+    assert store.load()["accounts"] == {"a": {"plan": "pro"}}
+    store.save(document)
+    assert store.load() == document
+
+
+def test_document_store_is_abstract(tmp_path):
+    with pytest.raises(TypeError):
+        storage.DocumentStore(str(tmp_path / "store.json"), COLLECTIONS, DEFAULTS)
+
+
+def test_sqlite_queries_use_indexes(tmp_path):
+    store = SQLiteStore(str(tmp_path / "store.sqlite3"), COLLECTIONS, DEFAULTS)
+    plan = " ".join(store.explain(
+        "SELECT data FROM records WHERE collection = ? AND shop_id = ? AND ts >= ?", ("deliveries", "a", 0)))
+    assert "USING INDEX records_shop" in plan
+    assert store._conn().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    store.close()
+
+
+def test_migrate_imports_json_store(tmp_path, capsys):
+    source = tmp_path / "catalog_store.json"
+    source.write_text(json.dumps({
+        "items": [{"id": "a:1"}, {"id": "a:2"}],
+        "jobs": [{"job_id": "j1", "status": "completed"}],
+        "profiles_version": 3,
+    }))
+    storage.main(["migrate", "catalog", str(source)])
+    assert "2 items, 1 jobs" in capsys.readouterr().out
+
+    migrated = SQLiteStore(str(tmp_path / "catalog_store.sqlite3"), COLLECTIONS, DEFAULTS)
+    assert migrated.get("jobs", "j1")["status"] == "completed"
+    assert migrated.load()["profiles_version"] == 3
+    migrated.close()
+
+
+def test_catalog_runs_on_sqlite_engine(tmp_path, monkeypatch):
+    monkeypatch.setenv(storage.ENGINE_ENV, "sqlite")
+    monkeypatch.setattr(catalog_service, "STORE_PATH", str(tmp_path / "catalog_store.json"))
+    client = TestClient(catalog_service.app)
+
+    assert client.post("/catalog/items/load_sample").json() == {"count": 20}
+    assert client.get("/catalog/item/demo-shop:sku-3/quality").status_code == 200
+    body = client.post("/catalog/optimize_and_deliver", json={"action": "seo", "shop_id": "demo-shop",
+                                                              "item_ids": ["demo-shop:sku-1", "demo-shop:sku-2"]}).json()
+    assert body["monthlyAiSummary"]["productsProcessed"] == 2
+    assert [d["delivery_id"] for d in client.get("/catalog/deliveries/demo-shop").json()] == [body["delivery_id"]]
+    assert catalog_service._store().get("items", "demo-shop:sku-1")["seo_title"].endswith("Try it on")
+    assert (tmp_path / "catalog_store.sqlite3").exists() and not (tmp_path / "catalog_store.json").exists()